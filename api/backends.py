@@ -0,0 +1,161 @@
+"""모델 이름으로 추론 백엔드를 고르는 레지스트리와 백엔드 구현.
+
+백엔드는 stream(req) 하나만 제공한다. {"delta": ...} 이벤트를 흘려보내고 마지막에
+{"usage": {...}} 를 한 번 보내며, 실패하면 예외를 던진다. 업스트림이 rate limit 헤더를 주면
+맨 앞에 {"rate_limit": {...}} 를 한 번 보낸다(api.scheduler.rate_limit_headers 형식).
+"""
+import os
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+
+from api.chat_requeset_schema import ChatRequest
+from api.local_engine import LlamaCppRuntime, LocalInferenceEngine
+from api.scheduler import rate_limit_headers
+
+LOCAL_MODEL_DIR = os.environ.get("LOCAL_MODEL_DIR", "models")
+LOCAL_MODEL_CTX = int(os.environ.get("LOCAL_MODEL_CTX", 4096))
+LOCAL_MODEL_PARALLEL = int(os.environ.get("LOCAL_MODEL_PARALLEL", 4))
+LOCAL_MODEL_THREADS = int(os.environ.get("LOCAL_MODEL_THREADS", os.cpu_count() or 4))
+
+# 양자화된 GGUF 파일 이름. LOCAL_MODEL_DIR 아래에 둔다
+LOCAL_MODEL_FILES = {
+    "beomi/KoAlpaca-Polyglot-12.8B": "KoAlpaca-Polyglot-12.8B.Q4_K_M.gguf",
+    "beomi/LLaMA-2-ko-7b": "LLaMA-2-ko-7b.Q4_K_M.gguf",
+    "beomi/LLaMA-2-ko-13b": "LLaMA-2-ko-13b.Q4_K_M.gguf",
+}
+
+
+class OpenAIBackend:
+    def __init__(self, client):
+        self.client = client
+
+    async def stream(self, req: ChatRequest) -> AsyncIterator[dict]:
+        response = await self.client.chat.completions.with_raw_response.create(
+            model=req.model,
+            messages=req.message,
+            temperature=req.temperature,
+            max_tokens=req.max_tokens,
+            stream=True,
+            stream_options={"include_usage": True}
+        )
+        limits = rate_limit_headers(response.headers)
+        if limits:
+            yield {"rate_limit": limits}
+        stream = response.parse()
+
+        usage = None
+        async for chunk in stream:
+            if chunk.usage is not None:
+                usage = chunk.usage
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content
+            if delta:
+                yield {"delta": delta}
+
+        yield {"usage": {
+            "total_tokens": usage.total_tokens if usage else 0,
+            "prompt_tokens": usage.prompt_tokens if usage else 0,
+            "completion_tokens": usage.completion_tokens if usage else 0
+        }}
+
+    async def close(self):
+        await self.client.close()
+
+
+def build_local_prompt(messages) -> List[Tuple[str, bool]]:
+    # KoAlpaca 학습 형식. 시스템 메세지는 맨 앞에 그대로 두고 대화는 질문/답변 쌍으로 이어 붙인다
+    # 형식이 매 턴 같아야 이전 대화까지의 prefix 가 그대로 겹쳐서 KV 캐시를 다시 쓸 수 있다
+    # (텍스트, 템플릿 여부) 조각으로 나눠서 메세지 내용은 특수 토큰으로 해석되지 않게 한다
+    parts = []
+
+    def add(text, special):
+        if not text:
+            return
+        # 이웃한 템플릿 조각은 하나로 합쳐서 조각 경계를 줄인다
+        if parts and parts[-1][1] == special:
+            parts[-1] = (parts[-1][0] + text, special)
+        else:
+            parts.append((text, special))
+
+    for message in messages:
+        if message.role == "user":
+            add("### 질문: ", True)
+        elif message.role != "system":
+            add("### 답변: ", True)
+        add(message.content, False)
+        add("\n\n", True)
+    add("### 답변:", True)
+    return parts
+
+
+class LocalBackend:
+    """LOCAL_MODEL_FILES 의 GGUF 모델을 CPU 에서 직접 돌린다. 모델은 처음 요청이 올 때 읽는다."""
+
+    def __init__(self, model_dir: str = LOCAL_MODEL_DIR, model_files: Dict[str, str] = None,
+                 n_ctx: int = LOCAL_MODEL_CTX, n_parallel: int = LOCAL_MODEL_PARALLEL,
+                 n_threads: int = LOCAL_MODEL_THREADS):
+        self.model_dir = model_dir
+        self.model_files = model_files or LOCAL_MODEL_FILES
+        self.n_ctx = n_ctx
+        self.n_parallel = n_parallel
+        self.n_threads = n_threads
+        self.engines = {}
+
+    def supports(self, model: str) -> bool:
+        return model in self.model_files
+
+    def get_engine(self, model: str) -> LocalInferenceEngine:
+        engine = self.engines.get(model)
+        if engine is None:
+            path = os.path.join(self.model_dir, self.model_files[model])
+            engine = LocalInferenceEngine(
+                lambda: LlamaCppRuntime(path, self.n_ctx, self.n_parallel, self.n_threads),
+                n_seq_max=self.n_parallel
+            )
+            self.engines[model] = engine
+        return engine
+
+    async def stream(self, req: ChatRequest) -> AsyncIterator[dict]:
+        engine = self.get_engine(req.model)
+        async for event in engine.generate(build_local_prompt(req.message), req.max_tokens, req.temperature):
+            if "error" in event:
+                raise RuntimeError(event["error"])
+            if "usage" in event:
+                usage = event["usage"]
+                yield {"usage": {
+                    "total_tokens": usage["total_tokens"],
+                    "prompt_tokens": usage["prompt_tokens"],
+                    "completion_tokens": usage["completion_tokens"]
+                }}
+                return
+            yield event
+
+    def stats(self) -> dict:
+        return {model: dict(engine.stats) for model, engine in self.engines.items()}
+
+    async def close(self):
+        for engine in self.engines.values():
+            engine.close()
+
+
+class BackendRegistry:
+    """모델 이름 prefix 를 백엔드에 연결한다. 가장 길게 맞는 prefix 가 이긴다."""
+
+    def __init__(self):
+        self._backends = {}
+
+    def register(self, prefix: str, backend):
+        self._backends[prefix] = backend
+
+    def get(self, model: str) -> Optional[object]:
+        matches = [prefix for prefix in self._backends if model.startswith(prefix)]
+        if not matches:
+            return None
+        backend = self._backends[max(matches, key=len)]
+        if hasattr(backend, "supports") and not backend.supports(model):
+            return None
+        return backend
+
+    async def close(self):
+        for backend in set(self._backends.values()):
+            await backend.close()
@@ -0,0 +1,255 @@
+"""JSONL 파일의 ChatRequest 들을 게이트웨이로 일괄 실행하는 배치 러너.
+
+입력은 한 줄에 ChatRequest 하나(선택적으로 "id" 필드 포함)이고, 결과와 usage 는
+완료되는 대로 출력 JSONL 에 한 줄씩 쓴다. 진행 상황은 <output>.checkpoint 에 남겨서
+중단된 실행을 같은 명령으로 다시 돌리면 이어서 처리한다.
+
+    python -m api.batch_runner requests.jsonl results.jsonl --concurrency 8 --rpm 500 --tpm 90000
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import time
+from typing import Optional
+
+import httpx
+from pydantic import ValidationError
+
+from api.chat_requeset_schema import ChatRequest
+from api.wire import JSON_TYPE, dumps
+from context_window import count_message_tokens
+
+GATEWAY_URL = 'http://localhost:8000/chat/gpt3'
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+# 게이트웨이 스케줄러가 UI 요청을 먼저 내보내도록 배치 요청임을 알린다
+REQUEST_HEADERS = {"X-Priority": "batch", "Content-Type": JSON_TYPE}
+
+
+class RateLimiter:
+    """분당 요청 수와 분당 토큰 수를 함께 지키는 토큰 버킷. 한도가 0 이면 그 항목은 제한하지 않는다."""
+
+    def __init__(self, requests_per_minute: float, tokens_per_minute: float):
+        self.capacity = {
+            name: limit for name, limit in (("requests", requests_per_minute), ("tokens", tokens_per_minute))
+            if limit
+        }
+        self.available = dict(self.capacity)
+        self.updated_at = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self.updated_at
+        self.updated_at = now
+        for name, capacity in self.capacity.items():
+            self.available[name] = min(capacity, self.available[name] + elapsed * capacity / 60)
+
+    async def acquire(self, tokens: int):
+        if "tokens" in self.capacity:
+            tokens = min(tokens, self.capacity["tokens"])
+        async with self._lock:
+            while True:
+                self._refill()
+                need = {name: amount for name, amount in (("requests", 1), ("tokens", tokens))
+                        if name in self.capacity}
+                wait = max(
+                    ((need[name] - self.available[name]) * 60 / self.capacity[name] for name in need),
+                    default=0
+                )
+                if wait <= 0:
+                    for name in need:
+                        self.available[name] -= need[name]
+                    return
+                await asyncio.sleep(wait)
+
+
+class Checkpoint:
+    """처리 위치를 기록한다. next_line 이전 줄은 모두 끝났고, done 은 그 뒤에서 먼저 끝난 줄들이다.
+
+    읽기 창(window) 크기만큼만 앞서 나가므로 done 의 크기도 창 크기로 묶인다.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.next_line = 0
+        self.done = set()
+        if os.path.exists(path):
+            with open(path) as f:
+                state = json.load(f)
+            self.next_line = state["next_line"]
+            self.done = set(state["done"])
+
+    def is_done(self, line_no: int) -> bool:
+        return line_no < self.next_line or line_no in self.done
+
+    def mark(self, line_no: int):
+        self.done.add(line_no)
+        while self.next_line in self.done:
+            self.done.remove(self.next_line)
+            self.next_line += 1
+        self._save()
+
+    def _save(self):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({"next_line": self.next_line, "done": sorted(self.done)}, f)
+        os.replace(tmp_path, self.path)
+
+
+def backoff_delay(attempt: int, base: float = 1.0, cap: float = 60.0, retry_after: Optional[float] = None) -> float:
+    # 게이트웨이가 Retry-After 를 주면 그만큼 기다리고, 아니면 full jitter: 0 ~ min(cap, base * 2^attempt)
+    if retry_after is not None:
+        return min(cap, retry_after)
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+def parse_retry_after(response: httpx.Response) -> Optional[float]:
+    try:
+        return float(response.headers["retry-after"])
+    except (KeyError, ValueError):
+        return None
+
+
+async def run_request(http: httpx.AsyncClient, url: str, req: ChatRequest, limiter: RateLimiter,
+                      max_retries: int) -> dict:
+    estimated_tokens = count_message_tokens(req.model, [m.model_dump() for m in req.message]) + req.max_tokens
+    error = None
+    retry_after = None
+    for attempt in range(max_retries + 1):
+        if attempt:
+            await asyncio.sleep(backoff_delay(attempt - 1, retry_after=retry_after))
+        await limiter.acquire(estimated_tokens)
+        started = time.perf_counter()
+        try:
+            response = await http.post(url, content=dumps(req.model_dump(exclude_none=True)), headers=REQUEST_HEADERS)
+        except httpx.TransportError as e:
+            error = f"{type(e).__name__}: {e}"
+            retry_after = None
+            continue
+
+        try:
+            body = response.json()
+        except ValueError:
+            body = {}
+        if response.status_code != 200 or "error" in body:
+            error = f"HTTP {response.status_code}: {body.get('error') or body.get('detail') or response.text[:200]}"
+            retry_after = parse_retry_after(response)
+            if response.status_code in RETRY_STATUS_CODES:
+                continue
+            # 400 같은 나머지 실패는 다시 보내도 같으므로 바로 실패로 남긴다
+            return {"status": "failed", "attempts": attempt + 1, "error": error}
+
+        return {
+            "status": "ok",
+            "attempts": attempt + 1,
+            "latency_ms": (time.perf_counter() - started) * 1000,
+            "message": body["message"],
+            "usage": {
+                "total_tokens": body["total_tokens"],
+                "prompt_tokens": body["prompt_tokens"],
+                "completion_tokens": body["completion_tokens"],
+            },
+            "cache_hit": body.get("cache_hit", False),
+        }
+
+    return {"status": "failed", "attempts": max_retries + 1, "error": error}
+
+
+async def run_batch(input_path: str, output_path: str, url: str = GATEWAY_URL, concurrency: int = 8,
+                    requests_per_minute: float = 500, tokens_per_minute: float = 90000, max_retries: int = 5,
+                    window: Optional[int] = None) -> dict:
+    checkpoint = Checkpoint(output_path + '.checkpoint')
+    limiter = RateLimiter(requests_per_minute, tokens_per_minute)
+    window = window or concurrency * 4
+    slots = asyncio.Semaphore(concurrency)
+    window_moved = asyncio.Event()
+    counts = {"ok": 0, "failed": 0, "invalid": 0, "skipped": 0}
+    pending = set()
+
+    timeout = httpx.Timeout(connect=5.0, read=300.0, write=30.0, pool=None)
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(timeout=timeout, limits=limits) as http:
+        with open(input_path, encoding='utf-8') as input_file, \
+                open(output_path, 'a', encoding='utf-8') as output_file:
+
+            def write_result(line_no: int, record_id, result: dict):
+                output_file.write(json.dumps({"line": line_no, "id": record_id, **result}, ensure_ascii=False) + "\n")
+                output_file.flush()
+                counts[result["status"]] += 1
+                checkpoint.mark(line_no)
+                window_moved.set()
+
+            async def process(line_no: int, req: ChatRequest, record_id):
+                try:
+                    result = await run_request(http, url, req, limiter, max_retries)
+                except Exception as e:
+                    result = {"status": "failed", "error": f"{type(e).__name__}: {e}"}
+                try:
+                    write_result(line_no, record_id, result)
+                finally:
+                    slots.release()
+
+            for line_no, line in enumerate(input_file):
+                if checkpoint.is_done(line_no):
+                    counts["skipped"] += 1
+                    continue
+
+                # 오래 걸리는 줄 하나 때문에 done 집합이 끝없이 커지지 않도록 창 밖으로는 읽지 않는다
+                while line_no - checkpoint.next_line >= window:
+                    window_moved.clear()
+                    await window_moved.wait()
+
+                record_id = None
+                try:
+                    record = json.loads(line)
+                    record_id = record.get("id") if isinstance(record, dict) else None
+                    req = ChatRequest(**record)
+                except (json.JSONDecodeError, TypeError, ValidationError) as e:
+                    write_result(line_no, record_id, {"status": "invalid", "error": str(e)})
+                    continue
+
+                await slots.acquire()
+                task = asyncio.create_task(process(line_no, req, record_id))
+                pending.add(task)
+                task.add_done_callback(pending.discard)
+
+            if pending:
+                await asyncio.gather(*pending)
+
+    return counts
+
+
+def rate_limit(value: str) -> float:
+    limit = float(value)
+    if limit < 0:
+        raise argparse.ArgumentTypeError("must be 0 (unlimited) or positive")
+    return limit
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("input")
+    parser.add_argument("output")
+    parser.add_argument("--url", default=GATEWAY_URL)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--rpm", type=rate_limit, default=500, help="분당 최대 요청 수 (0 이면 제한하지 않는다)")
+    parser.add_argument("--tpm", type=rate_limit, default=90000,
+                        help="분당 최대 토큰 수 (프롬프트 추정치 + max_tokens, 0 이면 제한하지 않는다)")
+    parser.add_argument("--max-retries", type=int, default=5)
+    args = parser.parse_args()
+
+    counts = asyncio.run(run_batch(
+        args.input, args.output,
+        url=args.url,
+        concurrency=args.concurrency,
+        requests_per_minute=args.rpm,
+        tokens_per_minute=args.tpm,
+        max_retries=args.max_retries,
+    ))
+    print(json.dumps(counts))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,272 @@
+import asyncio
+import hashlib
+import json
+import sqlite3
+import time
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, List, Optional, Tuple
+
+import numpy as np
+
+from api.state_backend import StateBackend
+
+EMBEDDING_DIM = 512
+
+
+def canonical_messages(messages) -> List[dict]:
+    return [
+        {"role": message["role"], "content": message["content"]} if isinstance(message, dict)
+        else {"role": message.role, "content": message.content}
+        for message in messages
+    ]
+
+
+def cache_key(model: str, messages, temperature: float, max_tokens: int) -> str:
+    payload = json.dumps(
+        {
+            "model": model,
+            "messages": canonical_messages(messages),
+            "temperature": round(float(temperature), 4),
+            "max_tokens": max_tokens,
+        },
+        sort_keys=True,
+        ensure_ascii=False,
+        separators=(",", ":"),
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def embed(text: str, dim: int = EMBEDDING_DIM) -> np.ndarray:
+    # 외부 모델 없이 글자 3-gram 을 부호 있는 해싱으로 고정 길이 벡터에 담는다.
+    # 띄어쓰기와 문장부호 차이는 무시한다
+    text = "".join(ch for ch in text.lower() if ch.isalnum())
+    vector = np.zeros(dim, dtype=np.float32)
+    for i in range(max(1, len(text) - 2)):
+        h = zlib.crc32(text[i:i + 3].encode("utf-8"))
+        vector[h % dim] += 1.0 if (h >> 31) & 1 else -1.0
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+class LRUTTLCache:
+    """max_entries 개까지 두는 LRU. weigh 를 주면 값 크기의 합도 max_weight 아래로 유지한다."""
+
+    def __init__(self, max_entries: int, ttl: float, max_weight: int = 0,
+                 weigh: Optional[Callable[[Any], int]] = None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_weight = max_weight
+        self.weigh = weigh
+        self.weight = 0
+        self._entries = OrderedDict()
+
+    def get(self, key: str) -> Optional[dict]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, value, _ = entry
+        if expires_at < time.monotonic():
+            self.delete(key)
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def set(self, key: str, value: dict):
+        self.delete(key)
+        weight = self.weigh(value) if self.weigh is not None else 0
+        self._entries[key] = (time.monotonic() + self.ttl, value, weight)
+        self.weight += weight
+        while len(self._entries) > self.max_entries or (self.max_weight and self.weight > self.max_weight):
+            _, (_, _, evicted) = self._entries.popitem(last=False)
+            self.weight -= evicted
+
+    def delete(self, key: str):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.weight -= entry[2]
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class SQLiteResponseStore:
+    """프로세스를 다시 띄워도 남아 있는 영속 캐시 계층.
+
+    쓰기 잠금을 기다리면 이벤트 루프 전체가 멈추므로 이벤트 루프에서는 a 로 시작하는 짝(aget, aset, ...)을 쓴다.
+    커넥션 하나를 함께 쓰므로 호출은 전용 스레드 하나에서 차례로 돈다.
+    """
+
+    def __init__(self, path: str, ttl: float):
+        self.ttl = ttl
+        self._executor = ThreadPoolExecutor(1, thread_name_prefix="response-cache")
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS response_cache ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL)"
+        )
+
+    def get(self, key: str) -> Optional[dict]:
+        row = self._conn.execute(
+            "SELECT value FROM response_cache WHERE key = ? AND expires_at >= ?", (key, time.time())
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set(self, key: str, value: dict):
+        self._conn.execute(
+            "INSERT OR REPLACE INTO response_cache (key, value, expires_at) VALUES (?, ?, ?)",
+            (key, json.dumps(value, ensure_ascii=False), time.time() + self.ttl)
+        )
+
+    def purge_expired(self):
+        self._conn.execute("DELETE FROM response_cache WHERE expires_at < ?", (time.time(),))
+
+    async def _offload(self, method, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, method, *args)
+
+    async def aget(self, key: str) -> Optional[dict]:
+        return await self._offload(self.get, key)
+
+    async def aset(self, key: str, value: dict):
+        await self._offload(self.set, key, value)
+
+    async def apurge_expired(self):
+        await self._offload(self.purge_expired)
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        self._conn.close()
+
+
+class SemanticIndex:
+    """temperature 0 요청의 비슷한 질문을 코사인 유사도로 찾는 고정 크기 인덱스."""
+
+    def __init__(self, max_entries: int, threshold: float, dim: int = EMBEDDING_DIM):
+        self.threshold = threshold
+        self._vectors = np.zeros((max_entries, dim), dtype=np.float32)
+        self._scopes = np.zeros(max_entries, dtype=np.int64)
+        self._keys = [None] * max_entries
+        self._size = 0
+        self._next = 0
+
+    def add(self, scope: int, text: str, key: str):
+        # 가득 차면 가장 오래된 자리부터 덮어쓴다
+        self._vectors[self._next] = embed(text, self._vectors.shape[1])
+        self._scopes[self._next] = scope
+        self._keys[self._next] = key
+        self._next = (self._next + 1) % len(self._keys)
+        self._size = min(self._size + 1, len(self._keys))
+
+    def search(self, scope: int, text: str) -> Optional[str]:
+        if self._size == 0:
+            return None
+        similarities = self._vectors[:self._size] @ embed(text, self._vectors.shape[1])
+        similarities[self._scopes[:self._size] != scope] = -1.0
+        best = int(np.argmax(similarities))
+        if similarities[best] < self.threshold:
+            return None
+        return self._keys[best]
+
+
+class ResponseCache:
+    """(model, messages, temperature, max_tokens) 정규화 해시를 키로 하는 응답 캐시.
+
+    메모리 LRU+TTL 계층이 먼저이고, 워커끼리 공유하는 state 가 있으면 그 다음에 보고(이벤트 루프 밖에서),
+    persist_path 가 있으면 SQLite 계층을 뒤에 둔다.
+    semantic=True 이면 temperature 0 이고 사용자 메세지가 하나뿐인(FAQ 형태) 요청에 한해
+    거의 같은 질문의 응답을 돌려준다.
+    """
+
+    def __init__(self, max_entries: int, ttl: float, persist_path: str = None,
+                 semantic: bool = False, semantic_threshold: float = 0.95, state: Optional[StateBackend] = None):
+        self.ttl = ttl
+        self.memory = LRUTTLCache(max_entries, ttl)
+        self.shared = state if state is not None and state.shared else None
+        self.store = SQLiteResponseStore(persist_path, ttl) if persist_path else None
+        self.semantic = SemanticIndex(max_entries, semantic_threshold) if semantic else None
+        self.hits = {"memory": 0, "shared": 0, "sqlite": 0, "semantic": 0}
+        self.misses = 0
+        self.saved_tokens = 0
+
+    def _semantic_target(self, model: str, messages: List[dict], temperature: float,
+                         max_tokens: int) -> Optional[Tuple[int, str]]:
+        if self.semantic is None or temperature != 0:
+            return None
+        user_messages = [message for message in messages if message["role"] == "user"]
+        if len(user_messages) != 1 or messages[-1]["role"] != "user":
+            return None
+        # 시스템 메세지, 모델, max_tokens 가 같은 요청끼리만 비교한다
+        context = [message for message in messages if message["role"] != "user"]
+        scope_key = cache_key(model, context, temperature, max_tokens)
+        return int(scope_key[:15], 16), user_messages[0]["content"]
+
+    async def _get(self, key: str) -> Tuple[Optional[dict], Optional[str]]:
+        value = self.memory.get(key)
+        if value is not None:
+            return value, "memory"
+        if self.shared is not None:
+            value = await self.shared.aget(f"cache:{key}")
+            if value is not None:
+                value = json.loads(value)
+                self.memory.set(key, value)
+                return value, "shared"
+        if self.store is not None:
+            value = await self.store.aget(key)
+            if value is not None:
+                self.memory.set(key, value)
+                return value, "sqlite"
+        return None, None
+
+    async def peek(self, key: str) -> Optional[dict]:
+        # 통계에 세지 않고 값만 본다. 다른 워커가 맡은 호출의 결과를 기다릴 때 쓴다
+        return (await self._get(key))[0]
+
+    async def lookup(self, model: str, messages, temperature: float,
+                     max_tokens: int) -> Tuple[Optional[dict], Optional[str]]:
+        messages = canonical_messages(messages)
+        value, tier = await self._get(cache_key(model, messages, temperature, max_tokens))
+
+        if value is None:
+            target = self._semantic_target(model, messages, temperature, max_tokens)
+            if target is not None:
+                similar_key = self.semantic.search(*target)
+                if similar_key is not None:
+                    value, _ = await self._get(similar_key)
+                    tier = "semantic" if value is not None else None
+
+        if value is None:
+            self.misses += 1
+            return None, None
+        self.hits[tier] += 1
+        self.saved_tokens += value.get("total_tokens", 0)
+        return value, tier
+
+    async def save(self, model: str, messages, temperature: float, max_tokens: int, value: dict):
+        messages = canonical_messages(messages)
+        key = cache_key(model, messages, temperature, max_tokens)
+        self.memory.set(key, value)
+        if self.shared is not None:
+            await self.shared.aset(f"cache:{key}", json.dumps(value, ensure_ascii=False), self.ttl)
+        if self.store is not None:
+            await self.store.aset(key, value)
+        target = self._semantic_target(model, messages, temperature, max_tokens)
+        if target is not None:
+            self.semantic.add(*target, key)
+
+    def stats(self) -> dict:
+        hits = sum(self.hits.values())
+        requests = hits + self.misses
+        return {
+            "hits": dict(self.hits),
+            "misses": self.misses,
+            "hit_rate": hits / requests if requests else 0.0,
+            "saved_tokens": self.saved_tokens,
+            "entries": len(self.memory),
+        }
+
+    def close(self):
+        if self.store is not None:
+            self.store.close()
@@ -1,10 +1,158 @@
-from openai import OpenAI
-from fastapi import FastAPI
+import asyncio
+import math
+import os
+import time
+from contextlib import asynccontextmanager
+from functools import lru_cache
+from typing import Literal
+
+import httpx
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+from fastapi import Depends, FastAPI, Header, HTTPException, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 
+from api.backends import BackendRegistry, LocalBackend, OpenAIBackend
+from api.cache import ResponseCache, cache_key, canonical_messages
 from api.chat_requeset_schema import ChatRequest
+from api.coalesce import Flight, SingleFlight
+from api.concurrency import ModelConcurrencyLimiter, Slot
+from api.scheduler import UpstreamError, UpstreamScheduler, classify_error
+from api.sessions import SessionStore
+from api.state_backend import create_state_backend
+from api.wire import ndjson_line, read_chat_request
+from context_window import count_message_tokens
+from database.setup_chat_db import SEARCH_PAGE_SIZE, ChatDatabase
+from database.usage import compute_cost
+from observability.logs import get_logger, log_event, new_trace_id
+from observability.metrics import CONTENT_TYPE, REGISTRY, counter, gauge, observe_stage, serve_metrics
+
+MAX_CONCURRENCY_PER_MODEL = int(os.environ.get("CHAT_MAX_CONCURRENCY_PER_MODEL", 32))
+MAX_QUEUE_PER_MODEL = int(os.environ.get("CHAT_MAX_QUEUE_PER_MODEL", 64))
+QUEUE_TIMEOUT = float(os.environ.get("CHAT_QUEUE_TIMEOUT", 10.0))
+UPSTREAM_MAX_CONNECTIONS = int(os.environ.get("CHAT_UPSTREAM_MAX_CONNECTIONS", 64))
+UPSTREAM_MAX_KEEPALIVE = int(os.environ.get("CHAT_UPSTREAM_MAX_KEEPALIVE", 32))
+CACHE_MAX_ENTRIES = int(os.environ.get("CHAT_CACHE_MAX_ENTRIES", 4096))
+CACHE_TTL = float(os.environ.get("CHAT_CACHE_TTL", 3600))
+CACHE_DB = os.environ.get("CHAT_CACHE_DB")  # 지정하면 SQLite 영속 계층을 켠다
+SEMANTIC_CACHE = os.environ.get("CHAT_SEMANTIC_CACHE", "0") == "1"
+SEMANTIC_CACHE_THRESHOLD = float(os.environ.get("CHAT_SEMANTIC_CACHE_THRESHOLD", 0.95))
+# 0 이면 첫 응답의 x-ratelimit-* 헤더를 받을 때까지 속도를 조절하지 않는다
+UPSTREAM_RPM = float(os.environ.get("CHAT_UPSTREAM_RPM", 0))
+UPSTREAM_TPM = float(os.environ.get("CHAT_UPSTREAM_TPM", 0))
+UPSTREAM_MAX_RETRIES = int(os.environ.get("CHAT_UPSTREAM_MAX_RETRIES", 3))
+SCHEDULER_TIMEOUT = float(os.environ.get("CHAT_SCHEDULER_TIMEOUT", 30.0))
+# 델타 프로토콜로 받은 대화 히스토리를 들고 있는 시간과 개수
+SESSION_TTL = float(os.environ.get("CHAT_SESSION_TTL", 3600))
+SESSION_MAX_ENTRIES = int(os.environ.get("CHAT_SESSION_MAX_ENTRIES", 4096))
+SESSION_MAX_BYTES = int(os.environ.get("CHAT_SESSION_MAX_BYTES", 256 * 1024 * 1024))  # 메모리에 두는 히스토리 크기 합
+CHAT_DB = os.environ.get("CHAT_DB", "chatbot.db")  # UI 와 같은 대화 DB. 검색 API 가 읽는다
+# 게이트웨이에는 인증이 없으므로 검색 API 는 기본으로 꺼 둔다. 켤 때는 앞단의 인증 프록시가 확인한 사용자 ID 를
+# 이 헤더에 실어 보내야 하고, 검색은 그 사용자의 대화로만 한정한다
+SEARCH_USER_HEADER = os.environ.get("CHAT_SEARCH_USER_HEADER", "")
+# 워커가 여럿이면 sqlite:///... 나 redis://... 로 슬롯, 캐시, 진행 중인 호출을 공유한다 (api/state_backend.py)
+STATE_BACKEND = os.environ.get("CHAT_STATE_BACKEND", "memory")
+API_HOST = os.environ.get("CHAT_API_HOST", "0.0.0.0")
+API_PORT = int(os.environ.get("CHAT_API_PORT", 8000))
+API_WORKERS = int(os.environ.get("CHAT_API_WORKERS", 1))
+API_DEBUG = os.environ.get("CHAT_API_DEBUG", "0") == "1"
+# /metrics 와 /stats/* 는 요청을 받은 워커 하나의 값이다. 워커가 여럿이면 이 값을 주어 워커마다
+# CHAT_METRICS_PORT 부터 CHAT_METRICS_PORT + 워커 수 - 1 중 빈 포트에 메트릭 서버를 띄우고, Prometheus 는 그 포트를 모두 긁는다
+METRICS_PORT = int(os.environ.get("CHAT_METRICS_PORT", 0))
+
+
+SYSTEM_MSG = "You are a helpful summation assistant"
+
+# 업스트림은 한 호스트뿐이므로 풀 전체 연결 수가 곧 호스트당 연결 상한이다.
+# 재시도는 SDK 대신 스케줄러가 rate limit 예산을 다시 받아 가며 한다
+client = AsyncOpenAI(
+    max_retries=0,
+    http_client=DefaultAsyncHttpxClient(
+        limits=httpx.Limits(
+            max_connections=UPSTREAM_MAX_CONNECTIONS,
+            max_keepalive_connections=UPSTREAM_MAX_KEEPALIVE
+        )
+    )
+)
+state = create_state_backend(STATE_BACKEND)
+limiter = ModelConcurrencyLimiter(
+    max_concurrency=MAX_CONCURRENCY_PER_MODEL,
+    max_queue=MAX_QUEUE_PER_MODEL,
+    queue_timeout=QUEUE_TIMEOUT,
+    state=state
+)
+response_cache = ResponseCache(
+    max_entries=CACHE_MAX_ENTRIES,
+    ttl=CACHE_TTL,
+    persist_path=CACHE_DB,
+    semantic=SEMANTIC_CACHE,
+    semantic_threshold=SEMANTIC_CACHE_THRESHOLD,
+    state=state
+)
+in_flight = SingleFlight(state)
+sessions = SessionStore(max_entries=SESSION_MAX_ENTRIES, ttl=SESSION_TTL, state=state, max_bytes=SESSION_MAX_BYTES)
+scheduler = UpstreamScheduler(
+    requests_per_minute=UPSTREAM_RPM,
+    tokens_per_minute=UPSTREAM_TPM,
+    queue_timeout=SCHEDULER_TIMEOUT,
+    max_retries=UPSTREAM_MAX_RETRIES
+)
+
+logger = get_logger(__name__)
+REQUESTS = counter("chat_requests_total", "Chat requests by outcome (ok, error, cache_hit)", ("model", "outcome"))
+RETRIES = counter("chat_upstream_retries_total", "Upstream calls retried after a retryable failure", ("model", "status"))
+TOKENS = counter("chat_tokens_total", "Tokens consumed by upstream calls", ("model", "kind"))
+COST = counter("chat_cost_dollars_total", "Estimated upstream cost", ("model",))
+SAVED_COST = counter("chat_saved_cost_dollars_total", "Upstream cost avoided by the response cache", ("model",))
+CACHE_LOOKUPS = counter("chat_cache_lookups_total", "Response cache lookups by tier (miss when not found)", ("tier",))
+UPSTREAM_IN_FLIGHT = gauge("chat_upstream_in_flight", "Upstream calls holding a concurrency slot", ("model",))
+UPSTREAM_WAITING = gauge("chat_upstream_waiting", "Requests waiting for a concurrency slot", ("model",))
+COALESCED = gauge("chat_coalesced_requests", "Requests served by joining an identical in-flight call")
+CACHE_HIT_RATE = gauge("chat_cache_hit_rate", "Response cache hit rate since start")
+
+local_backend = LocalBackend()
+backends = BackendRegistry()
+backends.register("gpt-", OpenAIBackend(client))
+backends.register("beomi/", local_backend)
+
+
+def collect_metrics():
+    # 상태성 값은 긁어 갈 때 현재 값으로 채운다
+    for model, stats in limiter.stats().items():
+        UPSTREAM_IN_FLIGHT.labels(model=model).set(stats["in_flight"])
+        UPSTREAM_WAITING.labels(model=model).set(stats["waiting"])
+    COALESCED.labels().set(in_flight.stats()["coalesced"])
+    CACHE_HIT_RATE.labels().set(response_cache.stats()["hit_rate"])
+
+
+def start_worker_metrics_server():
+    for port in range(METRICS_PORT, METRICS_PORT + API_WORKERS):
+        try:
+            server = serve_metrics(port, API_HOST, collect_metrics)
+        except OSError:
+            continue
+        log_event(logger, "info", "metrics_server_started", port=port, pid=os.getpid())
+        return server
+    log_event(logger, "warning", "metrics_port_unavailable", first_port=METRICS_PORT, workers=API_WORKERS)
+    return None
+
 
-app = FastAPI(debug=True)
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    metrics_server = start_worker_metrics_server() if METRICS_PORT else None
+    yield
+    if metrics_server is not None:
+        metrics_server.shutdown()
+    await backends.close()
+    response_cache.close()
+    state.close()
+    if get_chat_database.cache_info().currsize:
+        get_chat_database().close()
+
+
+Priority = Literal["interactive", "batch"]
+
+app = FastAPI(debug=API_DEBUG, lifespan=lifespan)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -14,40 +162,303 @@ app.add_middleware(
 )
 
 
-SYSTEM_MSG = "You are a helpful summation assistant"
+@app.exception_handler(UpstreamError)
+async def upstream_error_handler(request, error: UpstreamError):
+    return error_response(error.to_event())
 
-client = OpenAI()
 
-@app.post("/chat/gpt3")
-@app.post("/chat/gpt4")
-def chat_gpt3(req: ChatRequest):
-    try:
-        print(f"Received message: {req.message}")
-        completion = client.chat.completions.create(
-            model=req.model,
-            messages=req.message,
-            temperature=req.temperature,
-            max_tokens=req.max_tokens
+def error_response(event: dict) -> JSONResponse:
+    # 업스트림 실패를 HTTP 200 에 담지 않고 상태 코드(429/502/503/504)와 Retry-After 로 돌려준다
+    headers = {}
+    if event.get("retry_after") is not None:
+        headers["Retry-After"] = str(max(1, math.ceil(event["retry_after"])))
+    return JSONResponse({"error": event["error"]}, status_code=event.get("status", 502), headers=headers)
+
+
+@lru_cache(maxsize=None)
+def get_chat_database() -> ChatDatabase:
+    # 검색 요청이 처음 올 때 연다. 채팅만 중계하는 게이트웨이는 DB 파일을 건드리지 않는다
+    return ChatDatabase(CHAT_DB)
+
+
+def get_backend(model: str):
+    backend = backends.get(model)
+    if backend is None:
+        raise HTTPException(status_code=400, detail=f"Unsupported model: {model}")
+    return backend
+
+
+def estimate_tokens(req: ChatRequest) -> int:
+    return count_message_tokens(req.model, canonical_messages(req.message)) + req.max_tokens
+
+
+async def upstream_events(req: ChatRequest, estimated_tokens: int, priority: str, slot: Slot):
+    # 백엔드 delta를 이벤트로 흘려보내고, 마지막 이벤트에 usage를 담는다.
+    # 첫 delta 전에 난 429/5xx 는 backoff 뒤 스케줄러 예산을 다시 받아 재시도한다(첫 시도의 예산과 슬롯은 open_flight 가 받는다).
+    # backoff 와 예산을 기다리는 동안에는 슬롯을 놓아서 다른 요청이 쓰게 하고, 예산을 받은 뒤 다시 잡는다
+    log_event(logger, "debug", "upstream_call", model=req.model, messages=len(req.message), max_tokens=req.max_tokens)
+    backend = get_backend(req.model)
+    usage = {}
+    parts = []
+    started = time.perf_counter()
+    for attempt in range(scheduler.max_retries + 1):
+        try:
+            if attempt:
+                await scheduler.acquire(req.model, estimated_tokens, priority)
+                try:
+                    await slot.acquire()
+                except BaseException:
+                    scheduler.refund(req.model, estimated_tokens)
+                    raise
+            async for event in backend.stream(req):
+                if "rate_limit" in event:
+                    scheduler.update(req.model, event["rate_limit"])
+                    continue
+                if "usage" in event:
+                    usage = event["usage"]
+                    continue
+                if not parts:
+                    observe_stage("upstream_ttft", req.model, time.perf_counter() - started)
+                parts.append(event["delta"])
+                yield event
+            break
+        except HTTPException as e:
+            # 재시도할 슬롯을 다시 잡지 못했다(대기열이 가득 찼거나 시간 초과)
+            REQUESTS.labels(model=req.model, outcome="error").inc()
+            yield UpstreamError(e.detail, e.status_code, retry_after=1.0, retryable=False).to_event()
+            return
+        except Exception as e:
+            error = classify_error(e)
+            retry = error.retryable and not parts and attempt < scheduler.max_retries
+            log_event(logger, "warning", "upstream_error", model=req.model, status=error.status_code,
+                      attempt=attempt, retry=retry, error=str(e))
+            if not retry:
+                REQUESTS.labels(model=req.model, outcome="error").inc()
+                yield error.to_event()
+                return
+            RETRIES.labels(model=req.model, status=error.status_code).inc()
+            slot.release()
+            delay = scheduler.backoff_delay(attempt, error.retry_after)
+            if error.status_code == 429:
+                # 다른 요청도 같은 한도를 쓰므로 이 모델 전체를 잠시 멈춘다. 재시도는 acquire 에서 기다린다
+                scheduler.pause(req.model, delay)
+            else:
+                await asyncio.sleep(delay)
+    observe_stage("upstream_total", req.model, time.perf_counter() - started)
+
+    result = {
+        "message": "".join(parts),
+        "total_tokens": usage.get("total_tokens", 0),
+        "prompt_tokens": usage.get("prompt_tokens", 0),
+        "completion_tokens": usage.get("completion_tokens", 0)
+    }
+    await response_cache.save(req.model, req.message, req.temperature, req.max_tokens, result)
+    if result["total_tokens"]:
+        scheduler.reconcile(req.model, estimated_tokens, result["total_tokens"])
+    TOKENS.labels(model=req.model, kind="prompt").inc(result["prompt_tokens"])
+    TOKENS.labels(model=req.model, kind="completion").inc(result["completion_tokens"])
+    COST.labels(model=req.model).inc(compute_cost(req.model, result["prompt_tokens"], result["completion_tokens"]))
+    yield {"done": True, **result}
+
+
+async def lookup_cache(req: ChatRequest):
+    new_trace_id()
+    get_backend(req.model)
+    cached, cache_tier = await response_cache.lookup(req.model, req.message, req.temperature, req.max_tokens)
+    CACHE_LOOKUPS.labels(tier=cache_tier or "miss").inc()
+    if cached is not None:
+        REQUESTS.labels(model=req.model, outcome="cache_hit").inc()
+        SAVED_COST.labels(model=req.model).inc(
+            compute_cost(req.model, cached["prompt_tokens"], cached["completion_tokens"])
         )
+    log_event(logger, "debug", "chat_request", model=req.model, messages=len(req.message), cache_tier=cache_tier)
+    return cached, cache_tier
 
-        response_content = completion.choices[0].message.content
-        total_tokens = completion.usage.total_tokens
-        prompt_tokens = completion.usage.prompt_tokens
-        completion_tokens = completion.usage.completion_tokens
 
+async def open_flight(req: ChatRequest, priority: str) -> Flight:
+    # 같은 요청이 이미 업스트림에 나가 있으면 새로 호출하지 않고 그 결과를 같이 받는다
+    key = cache_key(req.model, req.message, req.temperature, req.max_tokens)
+    flight = in_flight.join(key)
+    if flight is not None:
+        return flight
+    if not await in_flight.claim(key):
+        # 맡은 워커가 lease 를 들고 있는 동안(최대 FLIGHT_LEASE_TTL) 기다린다. 업스트림 호출이 길어도 중복해서 부르지 않는다
+        flight = await in_flight.wait_remote(key, lambda: response_cache.peek(key))
+        if flight is not None:
+            return flight
+        # 맡았던 워커가 결과 없이 끝났으면 이어받는다. 그마저 놓치면 중복을 감수하고 직접 호출한다
+        await in_flight.claim(key)
+
+    # 슬롯은 응답을 돌려주기 전에 잡아야 대기열이 찼을 때 429/503을 상태 코드로 줄 수 있다
+    # rate limit 예산은 슬롯보다 먼저 기다린다. 그래야 예산을 기다리는 batch 요청이 슬롯을 차지해서
+    # 뒤에 온 interactive 요청을 막지 않는다
+    estimated_tokens = estimate_tokens(req)
+    started = time.perf_counter()
+    slot = limiter.slot(req.model)
+    try:
+        await scheduler.acquire(req.model, estimated_tokens, priority)
+        try:
+            await slot.acquire()
+        except BaseException:
+            # 업스트림을 부르지 않으므로 떼어 간 예산을 돌려준다
+            scheduler.refund(req.model, estimated_tokens)
+            raise
+    except BaseException:
+        in_flight.unclaim(key)
+        raise
+    observe_stage("queue_wait", req.model, time.perf_counter() - started, priority=priority)
+    flight = in_flight.join(key)
+    if flight is not None:
+        slot.release()
+        scheduler.refund(req.model, estimated_tokens)
+        return flight
+
+    flight = in_flight.start(key, upstream_events(req, estimated_tokens, priority, slot))
+    flight.task.add_done_callback(lambda _: slot.release())
+    return flight
+
+
+@app.post("/chat/gpt3")
+@app.post("/chat/gpt4")
+@app.post("/chat/local")
+async def chat_gpt3(req: ChatRequest = Depends(read_chat_request), x_priority: Priority = Header("interactive")):
+    req = await sessions.resolve(req)
+    cached, cache_tier = await lookup_cache(req)
+    if cached is not None:
         return {
-            "message": response_content,
-            "total_tokens": total_tokens,
-            "prompt_tokens": prompt_tokens,
-            "completion_tokens": completion_tokens
+            **cached, "cache_hit": True, "cache_tier": cache_tier,
+            "turn_id": await sessions.commit(req, cached["message"])
         }
-    except Exception as e:
-        print(f"Error during API call: {e}")
-        return {"error": str(e)}
+
+    flight = await open_flight(req, x_priority)
+    async for event in flight.subscribe():
+        if "error" in event:
+            return error_response(event)
+        if event.get("done"):
+            REQUESTS.labels(model=req.model, outcome="ok").inc()
+            return {
+                "message": event["message"],
+                "total_tokens": event["total_tokens"],
+                "prompt_tokens": event["prompt_tokens"],
+                "completion_tokens": event["completion_tokens"],
+                "cache_hit": False,
+                "turn_id": await sessions.commit(req, event["message"])
+            }
+    return error_response({"error": "Upstream call was cancelled"})
+
+
+@app.post("/chat/gpt3/stream")
+@app.post("/chat/gpt4/stream")
+@app.post("/chat/local/stream")
+async def chat_stream(req: ChatRequest = Depends(read_chat_request), x_priority: Priority = Header("interactive")):
+    req = await sessions.resolve(req)
+    cached, cache_tier = await lookup_cache(req)
+    if cached is not None:
+        async def cached_stream():
+            yield ndjson_line({"delta": cached["message"]})
+            yield ndjson_line({
+                "done": True,
+                "total_tokens": cached["total_tokens"],
+                "prompt_tokens": cached["prompt_tokens"],
+                "completion_tokens": cached["completion_tokens"],
+                "cache_hit": True,
+                "cache_tier": cache_tier,
+                "turn_id": await sessions.commit(req, cached["message"])
+            })
+
+        return StreamingResponse(cached_stream(), media_type="application/x-ndjson")
+
+    flight = await open_flight(req, x_priority)
+    events = flight.subscribe()
+    # 첫 이벤트가 오기 전에 실패했으면 스트림을 열지 않고 상태 코드로 돌려준다.
+    # 스트림 중간의 실패는 {"error": ..., "status": ...} 이벤트로 보낸다
+    first = await anext(events, None)
+    if first is None or "error" in first:
+        await events.aclose()
+        return error_response(first or {"error": "Upstream call was cancelled"})
+
+    async def encode(event: dict) -> bytes:
+        if event.get("done"):
+            REQUESTS.labels(model=req.model, outcome="ok").inc()
+            event = {
+                "done": True,
+                "total_tokens": event["total_tokens"],
+                "prompt_tokens": event["prompt_tokens"],
+                "completion_tokens": event["completion_tokens"],
+                "cache_hit": False,
+                "turn_id": await sessions.commit(req, event["message"])
+            }
+        return ndjson_line(event)
+
+    async def event_stream():
+        try:
+            yield await encode(first)
+            async for event in events:
+                yield await encode(event)
+        finally:
+            await events.aclose()
+
+    return StreamingResponse(event_stream(), media_type="application/x-ndjson")
+
+
+def search_messages(request: Request, q: str, limit: int = Query(SEARCH_PAGE_SIZE, ge=1, le=100),
+                    offset: int = Query(0, ge=0)):
+    # 사용자 ID 는 질의 인자로 받지 않는다. 인증 프록시가 붙인 헤더가 없으면 거절한다
+    try:
+        user_id = int(request.headers[SEARCH_USER_HEADER])
+    except (KeyError, ValueError):
+        raise HTTPException(status_code=401, detail=f"Missing or invalid {SEARCH_USER_HEADER} header")
+    # 동기 DB 호출이므로 async 가 아닌 함수로 두어 스레드풀에서 돌린다
+    return {"results": get_chat_database().search_messages(user_id, q, limit=limit, offset=offset)}
+
+
+if SEARCH_USER_HEADER:
+    app.add_api_route("/search", search_messages, methods=["GET"])
+
+
+@app.get("/metrics")
+async def metrics():
+    collect_metrics()
+    return PlainTextResponse(REGISTRY.render(), media_type=CONTENT_TYPE)
+
+
+@app.get("/stats/concurrency")
+async def concurrency_stats():
+    return limiter.stats()
+
+
+@app.get("/stats/cache")
+async def cache_stats():
+    return response_cache.stats()
+
+
+@app.get("/stats/coalescing")
+async def coalescing_stats():
+    return in_flight.stats()
+
+
+@app.get("/stats/sessions")
+async def session_stats():
+    return sessions.stats()
+
+
+@app.get("/stats/scheduler")
+async def scheduler_stats():
+    return scheduler.stats()
+
+
+@app.get("/stats/local")
+async def local_stats():
+    return local_backend.stats()
 
 
 if __name__ == "__main__":
     import uvicorn
 
-    uvicorn.run(app, host="0.0.0.0", port=8000)
-
+    # 워커는 각자 모듈을 import 하므로 앱을 import 문자열로 넘긴다
+    #   CHAT_API_WORKERS=4 CHAT_STATE_BACKEND=sqlite:///gateway_state.db python -m api.chat_api
+    if API_WORKERS > 1 and not state.shared:
+        log_event(logger, "warning", "state_not_shared", workers=API_WORKERS,
+                  detail="limits, cache and coalescing apply per worker; set CHAT_STATE_BACKEND")
+    uvicorn.run("api.chat_api:app", host=API_HOST, port=API_PORT, workers=API_WORKERS,
+                log_level="debug" if API_DEBUG else "info")
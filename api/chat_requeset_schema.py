@@ -1,4 +1,4 @@
-from typing import List
+from typing import List, Optional
 
 from pydantic import BaseModel
 
@@ -13,3 +13,6 @@ class ChatRequest(BaseModel):
     message: List[Message]
     max_tokens: int = 128
     temperature: float = 0.2
+    # 델타 프로토콜(api/sessions.py): last_turn_id 가 있으면 message 에는 그 턴 뒤에 생긴 메세지만 담는다
+    session_id: Optional[str] = None
+    last_turn_id: Optional[str] = None
@@ -0,0 +1,250 @@
+import asyncio
+import itertools
+import os
+import uuid
+from typing import AsyncIterator, Awaitable, Callable, Optional
+
+from api.state_backend import InProcessStateBackend, StateBackend
+from observability.logs import get_logger, log_event
+
+# 다른 워커가 맡은 호출을 기다릴 때 공유 저장소를 다시 보는 간격. 처음에는 짧게, 점점 길게 본다
+REMOTE_POLL_INTERVAL = 0.05
+REMOTE_POLL_MAX_INTERVAL = 0.5
+# 다른 워커가 기다리는 호출은 지금까지 받은 글을 이 간격으로 공유 저장소에 올리고, 기다리는 쪽도 이 간격으로 읽는다
+PARTIAL_INTERVAL = 0.2
+# 맡은 워커는 호출이 이만큼 길어진 뒤부터 기다리는 워커가 있는지 보고, 그 뒤로는 간격을 WATCH_POLL_MAX_INTERVAL 까지 늘린다
+WATCH_POLL_START = 0.5
+WATCH_POLL_MAX_INTERVAL = 1.0
+# 맡은 워커가 죽어도 이 시간이 지나면 lease 가 풀린다. 가장 긴 업스트림 호출보다 길어야 한다
+FLIGHT_LEASE_TTL = 300.0
+
+logger = get_logger(__name__)
+
+
+class Flight:
+    """업스트림 호출 하나의 이벤트를 버퍼에 쌓아 두고 여러 구독자에게 처음부터 흘려준다."""
+
+    def __init__(self, key: str, producer: AsyncIterator[dict], on_finish):
+        self.key = key
+        self.events = []
+        self.done = False
+        self.subscribers = 0
+        self._on_finish = on_finish
+        self._changed = asyncio.Event()
+        self.task = asyncio.create_task(self._run(producer))
+        self.task.add_done_callback(lambda _: self._on_finish(self))
+
+    def _notify(self):
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def _run(self, producer: AsyncIterator[dict]):
+        try:
+            async for event in producer:
+                self.events.append(event)
+                self._notify()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.events.append({"error": str(e)})
+        finally:
+            self.done = True
+            self._notify()
+
+    async def subscribe(self) -> AsyncIterator[dict]:
+        self.subscribers += 1
+        index = 0
+        try:
+            while True:
+                changed = self._changed
+                while index < len(self.events):
+                    yield self.events[index]
+                    index += 1
+                if self.done:
+                    return
+                await changed.wait()
+        finally:
+            # 마지막 구독자까지 떠나면 아무도 받지 않을 업스트림 호출을 멈춘다
+            self.subscribers -= 1
+            if self.subscribers == 0 and not self.done:
+                self.task.cancel()
+                self._on_finish(self)
+
+
+async def _replay(value: dict) -> AsyncIterator[dict]:
+    yield {"delta": value["message"]}
+    yield {"done": True, **value}
+
+
+class SingleFlight:
+    """같은 정규화 키로 동시에 들어온 요청들이 업스트림 호출 하나를 나눠 받게 한다.
+
+    state 가 워커끼리 공유되면 키마다 "flight:<key>" lease 로 호출할 워커 하나를 정한다.
+    나머지 워커는 lease 가 살아 있는 동안 기다린다. 기다리는 워커가 "flight-watch:<key>" 를 남기면
+    맡은 워커는 받은 글을 "flight-partial:<key>" 에 lease 값과 함께 주기적으로 올리고, 기다리는 쪽은 지금 lease 의
+    것인 중간 글만 흘려보내다가 결과가 공유 응답 캐시에 올라오면 나머지를 받는다.
+    """
+
+    def __init__(self, state: Optional[StateBackend] = None):
+        self.state = state or InProcessStateBackend()
+        self._owner = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self._tokens = itertools.count()
+        self._flights = {}
+        self._claims = {}
+        self._publishers = {}
+        self._partials = set()
+        self._tasks = set()
+        self.coalesced = 0
+        self.remote_coalesced = 0
+
+    def _spawn(self, coroutine: Awaitable) -> asyncio.Task:
+        task = asyncio.get_running_loop().create_task(coroutine)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    def start(self, key: str, producer: AsyncIterator[dict]) -> Flight:
+        flight = Flight(key, producer, self._finish)
+        self._flights[key] = flight
+        token = self._claims.get(key)
+        if token is not None:
+            self._publishers[key] = self._spawn(self._publish(flight, token))
+        return flight
+
+    def join(self, key: str) -> Optional[Flight]:
+        flight = self._flights.get(key)
+        if flight is not None:
+            self.coalesced += 1
+        return flight
+
+    async def claim(self, key: str) -> bool:
+        """이 키의 업스트림 호출을 이 워커가 맡는다. 다른 워커가 이미 맡고 있으면 False."""
+        if not self.state.shared:
+            return True
+        token = f"{self._owner}-{next(self._tokens)}"
+        if not await self.state.aadd(f"flight:{key}", token, FLIGHT_LEASE_TTL):
+            return False
+        self._claims[key] = token
+        return True
+
+    def unclaim(self, key: str):
+        token = self._claims.pop(key, None)
+        if token is not None:
+            self._spawn(self._release(key, token))
+
+    async def _release(self, key: str, token: str):
+        try:
+            await self.state.adelete(f"flight:{key}", token)
+            if key in self._partials:
+                self._partials.discard(key)
+                await self.state.adelete(f"flight-partial:{key}")
+        except Exception as e:
+            # 지우지 못한 lease 는 FLIGHT_LEASE_TTL 이 지나면 풀린다
+            log_event(logger, "warning", "flight_release_failed", error=str(e))
+
+    async def _publish(self, flight: Flight, token: str):
+        watch_key, partial_key = f"flight-watch:{flight.key}", f"flight-partial:{flight.key}"
+        watched = False
+        published = 0
+        delay = WATCH_POLL_START
+        try:
+            while not flight.done:
+                await asyncio.sleep(delay)
+                if not watched:
+                    watched = await self.state.aget(watch_key) is not None
+                    if not watched:
+                        delay = min(delay * 2, WATCH_POLL_MAX_INTERVAL)
+                        continue
+                    delay = PARTIAL_INTERVAL
+                text = "".join(event["delta"] for event in flight.events if "delta" in event)
+                if len(text) > published:
+                    self._partials.add(flight.key)
+                    await self.state.aset(partial_key, f"{token}\n{text}", FLIGHT_LEASE_TTL)
+                    published = len(text)
+        except Exception as e:
+            # 중간 글을 못 올려도 기다리는 워커는 결과가 캐시에 올라오면 한 번에 받는다
+            log_event(logger, "warning", "flight_publish_failed", error=str(e))
+
+    async def wait_remote(self, key: str, lookup: Callable[[], Awaitable[Optional[dict]]],
+                          timeout: float = FLIGHT_LEASE_TTL) -> Optional[Flight]:
+        """다른 워커(또는 슬롯을 기다리는 이 워커의 요청)가 맡은 호출을 lease 가 살아 있는 동안 기다린다.
+
+        결과가 올라와 있으면 그것을, 중간 글이 올라오기 시작하면 그것부터 흘려주는 Flight 를 돌려준다.
+        맡은 쪽이 결과 없이 lease 를 놓았거나 timeout 이 지나면 None 을 돌려주어 직접 호출하게 한다.
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        delay = REMOTE_POLL_INTERVAL
+        await self.state.aset(f"flight-watch:{key}", "1", FLIGHT_LEASE_TTL)
+        while loop.time() < deadline:
+            await asyncio.sleep(min(delay, max(deadline - loop.time(), 0)))
+            delay = min(delay * 2, REMOTE_POLL_MAX_INTERVAL)
+            flight = self.join(key)
+            if flight is not None:
+                return flight
+            value = await lookup()
+            if value is not None:
+                self.remote_coalesced += 1
+                return Flight(key, _replay(value), lambda _: None)
+            lease, partial = await self._remote_state(key)
+            if lease is None:
+                # lease 가 풀린 직후에 결과가 올라왔을 수 있으니 한 번 더 본다
+                value = await lookup()
+                if value is None:
+                    return None
+                self.remote_coalesced += 1
+                return Flight(key, _replay(value), lambda _: None)
+            if partial is not None:
+                self.remote_coalesced += 1
+                return Flight(key, self._follow(key, lookup, lease, partial, deadline), lambda _: None)
+        return None
+
+    async def _follow(self, key: str, lookup: Callable[[], Awaitable[Optional[dict]]], lease: str, text: str,
+                      deadline: float) -> AsyncIterator[dict]:
+        # 다른 워커가 올리는 중간 글을 흘려보내다가 결과가 캐시에 올라오면 남은 부분과 done 을 보낸다
+        loop = asyncio.get_running_loop()
+        sent = 0
+        while True:
+            if len(text) > sent:
+                yield {"delta": text[sent:]}
+                sent = len(text)
+            await asyncio.sleep(PARTIAL_INTERVAL)
+            value = await lookup()
+            if value is None:
+                current, partial = await self._remote_state(key)
+                if current == lease and loop.time() < deadline:
+                    if partial is not None and len(partial) > len(text):
+                        text = partial
+                    continue
+                value = await lookup()
+                if value is None:
+                    # 이미 일부를 보냈으므로 직접 다시 호출할 수 없다
+                    yield {"error": "The upstream call on another worker ended without a result", "status": 502}
+                    return
+            if len(value["message"]) > sent:
+                yield {"delta": value["message"][sent:]}
+            yield {"done": True, **value}
+            return
+
+    async def _remote_state(self, key: str):
+        """(lease 값, 그 lease 가 올린 중간 글). 앞서 맡았던 워커가 남긴 중간 글은 버린다."""
+        lease, partial = await self.state.aget_many([f"flight:{key}", f"flight-partial:{key}"])
+        if lease is None or partial is None:
+            return lease, None
+        owner, _, text = partial.partition("\n")
+        return lease, text if owner == lease and text else None
+
+    def _finish(self, flight: Flight):
+        if self._flights.get(flight.key) is flight:
+            del self._flights[flight.key]
+            publisher = self._publishers.pop(flight.key, None)
+            if publisher is not None:
+                publisher.cancel()
+            self.unclaim(flight.key)
+
+    def stats(self) -> dict:
+        return {
+            "in_flight": len(self._flights),
+            "coalesced": self.coalesced,
+            "remote_coalesced": self.remote_coalesced,
+        }
@@ -0,0 +1,169 @@
+import asyncio
+import itertools
+import os
+import random
+import uuid
+from collections import defaultdict
+from typing import Optional, Tuple
+
+from fastapi import HTTPException
+
+from api.state_backend import InProcessStateBackend, StateBackend
+from observability.logs import get_logger, log_event
+
+# 워커가 죽어도 잡고 있던 슬롯은 이 시간이 지나면 풀린다. 가장 긴 업스트림 호출보다 길어야 한다
+SLOT_LEASE_TTL = 300.0
+# 다른 워커의 슬롯이 풀렸는지는 알 수 없으므로 처음에는 짧게, 점점 길게 다시 본다
+SLOT_POLL_INTERVAL = 0.02
+SLOT_POLL_MAX_INTERVAL = 0.5
+# 슬롯 전체를 읽기 전에 아무 슬롯이나 이만큼 바로 잡아 본다. 슬롯이 남아 있으면 대부분 한 번에 잡힌다
+SLOT_PROBES = 2
+
+logger = get_logger(__name__)
+
+
+class Slot:
+    """한 요청이 잡은 limiter 슬롯. 재시도 backoff 동안 놓았다가 다시 잡을 수 있다."""
+
+    def __init__(self, limiter: "ModelConcurrencyLimiter", model: str):
+        self.limiter = limiter
+        self.model = model
+        self.held = False
+        self._lease = None
+
+    async def acquire(self):
+        self._lease = await self.limiter.acquire(self.model)
+        self.held = True
+
+    def release(self):
+        # 여러 번 불러도 한 번만 놓는다
+        if self.held:
+            self.held = False
+            self.limiter.release(self.model, self._lease)
+            self._lease = None
+
+
+class ModelConcurrencyLimiter:
+    """모델별 동시 업스트림 호출 수를 제한하고, 대기열이 가득 차면 바로 거절한다.
+
+    state 가 워커끼리 공유되는 저장소이면 max_concurrency 는 모든 워커를 합친 상한이 된다.
+    워커 안에서는 지금처럼 세마포어로 기다리고, 세마포어를 얻은 뒤 공유 저장소의 슬롯 lease 를 잡는다.
+    슬롯이 다 차 있으면 간격을 늘려 가며 다시 보고, 이 워커가 슬롯을 놓으면 바로 깨운다.
+    대기열 길이(max_queue)는 워커마다 센다.
+    """
+
+    def __init__(self, max_concurrency: int, max_queue: int, queue_timeout: float,
+                 state: Optional[StateBackend] = None):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.state = state or InProcessStateBackend()
+        self._owner = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self._tokens = itertools.count()
+        self._semaphores = {}
+        self._slot_keys = {}
+        self._waiting = defaultdict(int)
+        self._released = defaultdict(asyncio.Event)
+        self._releasing = set()
+
+    def _semaphore(self, model: str) -> asyncio.Semaphore:
+        if model not in self._semaphores:
+            self._semaphores[model] = asyncio.Semaphore(self.max_concurrency)
+        return self._semaphores[model]
+
+    def _timed_out(self, model: str) -> HTTPException:
+        return HTTPException(
+            status_code=503,
+            detail=f"Timed out waiting for a free slot for {model}",
+            headers={"Retry-After": "1"}
+        )
+
+    async def acquire(self, model: str) -> Optional[Tuple[str, str]]:
+        """슬롯을 잡고, 공유 저장소를 쓰면 release 에 넘길 lease (키, 값)을 돌려준다."""
+        semaphore = self._semaphore(model)
+        if semaphore.locked() and self._waiting[model] >= self.max_queue:
+            raise HTTPException(
+                status_code=429,
+                detail=f"Too many pending requests for {model}",
+                headers={"Retry-After": "1"}
+            )
+
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.queue_timeout
+        self._waiting[model] += 1
+        try:
+            await asyncio.wait_for(semaphore.acquire(), timeout=self.queue_timeout)
+        except asyncio.TimeoutError:
+            raise self._timed_out(model)
+        finally:
+            self._waiting[model] -= 1
+
+        if not self.state.shared:
+            return None
+        try:
+            return await self._acquire_lease(model, deadline)
+        except BaseException:
+            semaphore.release()
+            raise
+
+    async def _acquire_lease(self, model: str, deadline: float) -> Tuple[str, str]:
+        # 슬롯 키 max_concurrency 개 중 빈 것을 SET NX 로 잡는다. 값은 lease 마다 달라서 응답이 끊긴 SET 도 가려낼 수 있다
+        loop = asyncio.get_running_loop()
+        keys = self._slot_keys.get(model)
+        if keys is None:
+            keys = self._slot_keys[model] = [f"limiter:{model}:{slot}" for slot in range(self.max_concurrency)]
+        token = f"{self._owner}-{next(self._tokens)}"
+        for key in random.sample(keys, min(SLOT_PROBES, len(keys))):
+            if await self.state.aadd(key, token, SLOT_LEASE_TTL):
+                return key, token
+        delay = SLOT_POLL_INTERVAL
+        self._waiting[model] += 1
+        try:
+            while True:
+                released = self._released[model]
+                free = [key for key, owner in zip(keys, await self.state.aget_many(keys)) if owner is None]
+                random.shuffle(free)
+                for key in free:
+                    if await self.state.aadd(key, token, SLOT_LEASE_TTL):
+                        return key, token
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    raise self._timed_out(model)
+                try:
+                    await asyncio.wait_for(released.wait(), timeout=min(delay * random.uniform(0.5, 1.0), remaining))
+                except asyncio.TimeoutError:
+                    pass
+                delay = min(delay * 2, SLOT_POLL_MAX_INTERVAL)
+        finally:
+            self._waiting[model] -= 1
+
+    def slot(self, model: str) -> Slot:
+        return Slot(self, model)
+
+    def release(self, model: str, lease: Optional[Tuple[str, str]] = None):
+        if lease is None:
+            self._semaphore(model).release()
+            return
+        # lease 를 지우는 것도 공유 저장소 I/O 이므로 이벤트 루프를 막지 않게 태스크로 돌린다
+        task = asyncio.get_running_loop().create_task(self._release_lease(model, lease))
+        self._releasing.add(task)
+        task.add_done_callback(self._releasing.discard)
+
+    async def _release_lease(self, model: str, lease: Tuple[str, str]):
+        try:
+            await self.state.adelete(*lease)
+        except Exception as e:
+            # 지우지 못한 lease 는 SLOT_LEASE_TTL 이 지나면 풀린다
+            log_event(logger, "warning", "slot_release_failed", model=model, error=str(e))
+        finally:
+            self._semaphore(model).release()
+            self._released.pop(model, asyncio.Event()).set()
+
+    def stats(self) -> dict:
+        return {
+            model: {
+                "in_flight": self.max_concurrency - semaphore._value,
+                "waiting": self._waiting[model],
+            }
+            for model, semaphore in self._semaphores.items()
+        }
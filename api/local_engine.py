@@ -0,0 +1,403 @@
+"""llama.cpp(GGUF) 기반 로컬 CPU 추론 엔진.
+
+한 llama.cpp 컨텍스트를 여러 시퀀스가 나눠 쓴다. 매 스텝마다 진행 중인 모든 시퀀스의
+다음 토큰(또는 프롬프트 조각)을 하나의 batch 로 decode 하고, 시퀀스가 끝나는 즉시
+대기 중인 요청을 받아들이는 continuous batching 방식이다.
+
+끝난 시퀀스의 KV 캐시는 바로 지우지 않고 prefix 캐시로 남겨 두었다가, 새 요청의
+프롬프트와 앞부분이 겹치면 그만큼을 복사해 쓰고 나머지만 prefill 한다.
+같은 시스템 메세지나 이전 대화를 공유하는 채팅 요청은 대부분 이 경로를 탄다.
+"""
+import asyncio
+import codecs
+import ctypes
+import itertools
+import queue
+import threading
+from collections import OrderedDict
+from typing import AsyncIterator, List, Optional, Tuple
+
+import numpy as np
+
+from observability.logs import get_logger, log_event
+
+try:
+    import llama_cpp
+except ImportError:
+    llama_cpp = None
+
+PREFILL_CHUNK = 256  # 한 스텝에서 시퀀스 하나가 prefill 할 수 있는 최대 토큰 수
+TOP_K = 40
+
+logger = get_logger(__name__)
+
+
+class LlamaCppRuntime:
+    """llama.cpp 저수준 API 를 감싸는 얇은 어댑터. 스케줄러는 이 인터페이스만 쓴다."""
+
+    def __init__(self, model_path: str, n_ctx: int, n_seq_max: int, n_threads: int):
+        if llama_cpp is None:
+            raise RuntimeError("llama-cpp-python is not installed")
+        llama_cpp.llama_backend_init()
+
+        model_params = llama_cpp.llama_model_default_params()
+        self.model = llama_cpp.llama_model_load_from_file(model_path.encode('utf-8'), model_params)
+        if not self.model:
+            raise RuntimeError(f"Failed to load model: {model_path}")
+
+        ctx_params = llama_cpp.llama_context_default_params()
+        ctx_params.n_ctx = n_ctx
+        ctx_params.n_batch = n_ctx
+        ctx_params.n_seq_max = n_seq_max
+        ctx_params.n_threads = n_threads
+        ctx_params.n_threads_batch = n_threads
+        # 시퀀스끼리 KV 셀을 공유해야 prefix 재사용이 의미가 있다
+        ctx_params.kv_unified = True
+        self.ctx = llama_cpp.llama_init_from_model(self.model, ctx_params)
+        if not self.ctx:
+            raise RuntimeError("Failed to create llama.cpp context")
+
+        self.n_ctx = n_ctx
+        self.vocab = llama_cpp.llama_model_get_vocab(self.model)
+        self.n_vocab = llama_cpp.llama_vocab_n_tokens(self.vocab)
+        self.memory = llama_cpp.llama_get_memory(self.ctx)
+        self.batch = llama_cpp.llama_batch_init(n_ctx, 0, 1)
+
+    def tokenize(self, text: str, add_special: bool = True, parse_special: bool = False) -> List[int]:
+        data = text.encode('utf-8')
+        buffer = (llama_cpp.llama_token * (len(data) + 16))()
+        n = llama_cpp.llama_tokenize(self.vocab, data, len(data), buffer, len(buffer), add_special, parse_special)
+        if n < 0:
+            raise ValueError("Prompt could not be tokenized")
+        return list(buffer[:n])
+
+    def token_to_bytes(self, token: int) -> bytes:
+        buffer = ctypes.create_string_buffer(64)
+        n = llama_cpp.llama_token_to_piece(self.vocab, token, buffer, len(buffer), 0, False)
+        return buffer.raw[:max(n, 0)]
+
+    def is_end_of_generation(self, token: int) -> bool:
+        return llama_cpp.llama_vocab_is_eog(self.vocab, token)
+
+    def decode(self, entries) -> Optional[List[np.ndarray]]:
+        """entries 는 (token, pos, seq_id, want_logits) 목록. KV 캐시에 자리가 없으면 None 을 돌려준다."""
+        batch = self.batch
+        batch.n_tokens = len(entries)
+        for i, (token, pos, seq_id, want_logits) in enumerate(entries):
+            batch.token[i] = token
+            batch.pos[i] = pos
+            batch.n_seq_id[i] = 1
+            batch.seq_id[i][0] = seq_id
+            batch.logits[i] = want_logits
+
+        result = llama_cpp.llama_decode(self.ctx, batch)
+        if result == 1:
+            return None
+        if result != 0:
+            raise RuntimeError(f"llama_decode failed with {result}")
+
+        logits = []
+        for i, entry in enumerate(entries):
+            if entry[3]:
+                pointer = llama_cpp.llama_get_logits_ith(self.ctx, i)
+                logits.append(np.ctypeslib.as_array(pointer, shape=(self.n_vocab,)).copy())
+        return logits
+
+    def seq_rm(self, seq_id: int, p0: int = -1, p1: int = -1):
+        llama_cpp.llama_memory_seq_rm(self.memory, seq_id, p0, p1)
+
+    def seq_cp(self, src: int, dst: int, p0: int, p1: int):
+        llama_cpp.llama_memory_seq_cp(self.memory, src, dst, p0, p1)
+
+
+class Sequence:
+    def __init__(self, prompt_tokens: List[int], max_tokens: int, temperature: float, emit):
+        self.tokens = list(prompt_tokens)  # KV 에 들어갔거나 들어갈 토큰 전체
+        self.prompt_tokens = len(prompt_tokens)
+        self.n_past = 0  # KV 캐시에 이미 들어간 토큰 수
+        self.max_tokens = max_tokens
+        self.temperature = temperature
+        self.generated = 0
+        self.reused_tokens = 0
+        self.seq_id = None
+        self.cancelled = False
+        self.emit = emit
+        self.decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+
+
+def common_prefix_length(a: List[int], b: List[int]) -> int:
+    n = 0
+    for x, y in zip(a, b):
+        if x != y:
+            break
+        n += 1
+    return n
+
+
+class LocalInferenceEngine:
+    """전용 스레드 하나에서 스케줄링과 decode 를 돌리고, 결과는 asyncio 큐로 돌려준다."""
+
+    def __init__(self, runtime_factory, n_seq_max: int = 4, max_batch_tokens: int = 512):
+        self.runtime_factory = runtime_factory
+        self.n_seq_max = n_seq_max
+        self.max_batch_tokens = max_batch_tokens
+        self.runtime = None
+        self._inbox = queue.Queue()
+        self._waiting = []
+        self._active = {}
+        self._free_slots = list(range(n_seq_max))
+        self._prefix_slots = OrderedDict()  # seq_id -> KV 에 남아 있는 토큰 (LRU)
+        self._thread = None
+        self._lock = threading.Lock()
+        self.stats = {"requests": 0, "prompt_tokens": 0, "reused_prompt_tokens": 0, "steps": 0}
+
+    def start(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="local-inference", daemon=True)
+                self._thread.start()
+
+    def close(self):
+        thread = self._thread
+        if thread is not None:
+            self._inbox.put(None)
+            thread.join()
+
+    async def generate(self, prompt: List[Tuple[str, bool]], max_tokens: int,
+                       temperature: float) -> AsyncIterator[dict]:
+        """{"delta": ...} 이벤트를 흘려보내고 마지막에 {"usage": ...} 를 보낸다.
+
+        prompt 는 (텍스트, 템플릿 여부) 조각의 목록이다. 특수 토큰은 템플릿 조각에서만 해석하고
+        사용자/어시스턴트 내용은 글자 그대로 토큰화해서, 내용에 <|im_end|> 같은 제어 토큰을 넣어도 먹히지 않는다.
+        """
+        self.start()
+        loop = asyncio.get_running_loop()
+        events = asyncio.Queue()
+
+        def emit(event):
+            loop.call_soon_threadsafe(events.put_nowait, event)
+
+        request = {"prompt": prompt, "max_tokens": max_tokens, "temperature": temperature, "emit": emit,
+                   "sequence": None, "cancelled": False}
+        self._inbox.put(request)
+        try:
+            while True:
+                event = await events.get()
+                yield event
+                if "usage" in event or "error" in event:
+                    return
+        finally:
+            # 클라이언트가 떠나면 다음 스텝에서 시퀀스를 내려놓는다
+            request["cancelled"] = True
+            if request["sequence"] is not None:
+                request["sequence"].cancelled = True
+
+    def _run(self):
+        try:
+            try:
+                self.runtime = self.runtime_factory()
+            except Exception as e:
+                self._fail_pending(f"Failed to start local engine: {e}")
+                return
+
+            while True:
+                try:
+                    if not self._poll_inbox():
+                        return
+                    self._admit()
+                    if self._active:
+                        self._step()
+                except Exception as e:
+                    # decode 나 샘플링이 실패해도 스레드는 살려 두고, 걸려 있던 요청만 실패시킨다
+                    log_event(logger, "error", "local_engine_step_failed", error=str(e), exc_info=True)
+                    self._fail_sequences(f"Local engine error: {e}")
+        finally:
+            with self._lock:
+                if self._thread is threading.current_thread():
+                    self._thread = None
+
+    def _poll_inbox(self) -> bool:
+        """새 요청을 받아들인다. 종료 신호를 받으면 False 를 돌려준다."""
+        block = not self._active and not self._waiting
+        try:
+            request = self._inbox.get(block=block)
+            if request is None:
+                return False
+            self._accept(request)
+            while True:
+                request = self._inbox.get_nowait()
+                if request is None:
+                    return False
+                self._accept(request)
+        except queue.Empty:
+            return True
+
+    def _fail_sequences(self, message: str):
+        for sequence in itertools.chain(self._active.values(), self._waiting):
+            if not sequence.cancelled:
+                sequence.emit({"error": message})
+        # 실패한 decode 뒤의 KV 상태는 믿을 수 없으므로 prefix 캐시까지 모두 비운다
+        for slot in itertools.chain(self._active, self._prefix_slots):
+            try:
+                self.runtime.seq_rm(slot)
+            except Exception as e:
+                log_event(logger, "warning", "local_engine_seq_rm_failed", seq_id=slot, error=str(e))
+        self._active.clear()
+        self._waiting.clear()
+        self._prefix_slots.clear()
+        self._free_slots = list(range(self.n_seq_max))
+
+    def _fail_pending(self, message: str):
+        while True:
+            try:
+                request = self._inbox.get(timeout=1.0)
+            except queue.Empty:
+                continue
+            if request is None:
+                return
+            request["emit"]({"error": message})
+
+    def _accept(self, request: dict):
+        if request["cancelled"]:
+            return
+        try:
+            tokens = []
+            for i, (text, special) in enumerate(request["prompt"]):
+                # BOS 는 맨 앞 조각에만 붙인다
+                tokens += self.runtime.tokenize(text, add_special=(i == 0), parse_special=special)
+        except Exception as e:
+            request["emit"]({"error": str(e)})
+            return
+        if len(tokens) + request["max_tokens"] > self.runtime.n_ctx:
+            request["emit"]({"error": "Prompt and max_tokens exceed the local model context"})
+            return
+        sequence = Sequence(tokens, request["max_tokens"], request["temperature"], request["emit"])
+        request["sequence"] = sequence
+        self._waiting.append(sequence)
+
+    def _admit(self):
+        while self._waiting:
+            sequence = self._waiting[0]
+            if sequence.cancelled:
+                self._waiting.pop(0)
+                continue
+
+            # 가장 길게 겹치는 prefix 를 가진 시퀀스(진행 중이거나 캐시로 남은 것)를 찾는다
+            # 마지막 프롬프트 토큰은 logits 를 얻기 위해 항상 다시 decode 한다
+            limit = len(sequence.tokens) - 1
+            best_id, best_length = None, 0
+            for seq_id, tokens in itertools.chain(
+                self._prefix_slots.items(),
+                ((s.seq_id, s.tokens[:s.n_past]) for s in self._active.values())
+            ):
+                length = min(common_prefix_length(sequence.tokens, tokens), limit)
+                if length > best_length:
+                    best_id, best_length = seq_id, length
+
+            if best_id in self._prefix_slots:
+                # 캐시로 남은 슬롯을 그대로 이어받고 겹치지 않는 뒷부분만 지운다
+                del self._prefix_slots[best_id]
+                slot = best_id
+                self.runtime.seq_rm(slot, best_length, -1)
+            else:
+                slot = self._take_slot()
+                if slot is None:
+                    return
+                if best_id is not None:
+                    self.runtime.seq_cp(best_id, slot, 0, best_length)
+
+            self._waiting.pop(0)
+            sequence.seq_id = slot
+            sequence.n_past = best_length
+            sequence.reused_tokens = best_length
+            self._active[slot] = sequence
+            self.stats["requests"] += 1
+            self.stats["prompt_tokens"] += sequence.prompt_tokens
+            self.stats["reused_prompt_tokens"] += best_length
+
+    def _take_slot(self) -> Optional[int]:
+        if self._free_slots:
+            return self._free_slots.pop()
+        if self._prefix_slots:
+            slot, _ = self._prefix_slots.popitem(last=False)
+            self.runtime.seq_rm(slot)
+            return slot
+        return None
+
+    def _release(self, sequence: Sequence, keep_cache: bool):
+        del self._active[sequence.seq_id]
+        if keep_cache and sequence.n_past:
+            self._prefix_slots[sequence.seq_id] = sequence.tokens[:sequence.n_past]
+        else:
+            self.runtime.seq_rm(sequence.seq_id)
+            self._free_slots.append(sequence.seq_id)
+
+    def _step(self):
+        for sequence in [s for s in self._active.values() if s.cancelled]:
+            self._release(sequence, keep_cache=True)
+
+        entries, owners = [], []
+        budget = self.max_batch_tokens
+        for sequence in self._active.values():
+            if budget <= 0:
+                break
+            pending = sequence.tokens[sequence.n_past:sequence.n_past + min(PREFILL_CHUNK, budget)]
+            for offset, token in enumerate(pending):
+                pos = sequence.n_past + offset
+                want_logits = pos == len(sequence.tokens) - 1
+                entries.append((token, pos, sequence.seq_id, want_logits))
+                if want_logits:
+                    owners.append(sequence)
+            budget -= len(pending)
+            sequence.n_past += len(pending)
+
+        if not entries:
+            return
+
+        logits = self.runtime.decode(entries)
+        if logits is None:
+            # KV 캐시가 가득 찼다: prefix 캐시를 비우고, 그래도 안 되면 진행 중인 요청을 실패시킨다
+            for sequence in self._active.values():
+                sequence.n_past -= sum(1 for entry in entries if entry[2] == sequence.seq_id)
+            if self._prefix_slots:
+                while self._prefix_slots:
+                    slot, _ = self._prefix_slots.popitem(last=False)
+                    self.runtime.seq_rm(slot)
+                    self._free_slots.append(slot)
+                return
+            for sequence in list(self._active.values()):
+                sequence.emit({"error": "Local model context is full"})
+                self._release(sequence, keep_cache=False)
+            return
+
+        self.stats["steps"] += 1
+        for sequence, row in zip(owners, logits):
+            token = self._sample(row, sequence.temperature)
+            finished = self.runtime.is_end_of_generation(token)
+            if not finished:
+                sequence.tokens.append(token)
+                sequence.generated += 1
+                text = sequence.decoder.decode(self.runtime.token_to_bytes(token))
+                if text:
+                    sequence.emit({"delta": text})
+            if finished or sequence.generated >= sequence.max_tokens:
+                tail = sequence.decoder.decode(b"", final=True)
+                if tail:
+                    sequence.emit({"delta": tail})
+                sequence.emit({"usage": {
+                    "prompt_tokens": sequence.prompt_tokens,
+                    "completion_tokens": sequence.generated,
+                    "total_tokens": sequence.prompt_tokens + sequence.generated,
+                    "reused_prompt_tokens": sequence.reused_tokens,
+                }})
+                self._release(sequence, keep_cache=True)
+
+    @staticmethod
+    def _sample(logits: np.ndarray, temperature: float) -> int:
+        if temperature <= 0:
+            return int(np.argmax(logits))
+        top = np.argpartition(logits, -TOP_K)[-TOP_K:]
+        scaled = logits[top] / temperature
+        probs = np.exp(scaled - scaled.max())
+        probs /= probs.sum()
+        return int(np.random.choice(top, p=probs))
@@ -0,0 +1,262 @@
+"""업스트림 rate limit 을 지키며 호출을 내보내는 모델별 스케줄러.
+
+모델마다 분당 요청 수(RPM)와 분당 토큰 수(TPM) 버킷을 두고, 호출 전에 (프롬프트 추정 토큰 + max_tokens)
+만큼을 떼어 간다. 예산이 모자라면 우선순위(interactive 가 batch 보다 먼저) 순서로 기다린다.
+버킷 크기와 남은 양은 OpenAI 응답의 x-ratelimit-* 헤더로 계속 맞추고, 실제 usage 로 추정치를 정산한다.
+예산은 워커마다 따로 센다. 여러 워커가 같은 키를 쓰면 헤더의 remaining 값이 서로를 맞춰 준다.
+"""
+import asyncio
+import heapq
+import itertools
+import math
+import random
+import re
+import time
+from typing import Dict, Mapping, Optional
+
+PRIORITIES = {"interactive": 0, "batch": 1}
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+_DURATION = re.compile(r"(\d+(?:\.\d+)?)(ms|s|m|h)")
+_DURATION_SCALE = {"ms": 0.001, "s": 1.0, "m": 60.0, "h": 3600.0}
+
+
+class UpstreamError(Exception):
+    """클라이언트에게 그대로 돌려줄 상태 코드와 Retry-After 를 담은 업스트림 실패."""
+
+    def __init__(self, message: str, status_code: int = 502, retry_after: Optional[float] = None,
+                 retryable: Optional[bool] = None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+        self.retryable = status_code in RETRY_STATUS_CODES if retryable is None else retryable
+
+    def to_event(self) -> dict:
+        event = {"error": str(self), "status": self.status_code}
+        if self.retry_after is not None:
+            event["retry_after"] = self.retry_after
+        return event
+
+
+def parse_duration(value: str) -> Optional[float]:
+    # x-ratelimit-reset-* 는 "20ms", "1s", "6m0s" 같은 형식이다
+    parts = _DURATION.findall(value or "")
+    if not parts:
+        return None
+    return sum(float(amount) * _DURATION_SCALE[unit] for amount, unit in parts)
+
+
+def rate_limit_headers(headers: Mapping[str, str]) -> Dict[str, float]:
+    limits = {}
+    for kind in ("requests", "tokens"):
+        for field in ("limit", "remaining"):
+            value = headers.get(f"x-ratelimit-{field}-{kind}")
+            if value is not None:
+                limits[f"{field}_{kind}"] = float(value)
+        reset = parse_duration(headers.get(f"x-ratelimit-reset-{kind}"))
+        if reset is not None:
+            limits[f"reset_{kind}"] = reset
+    return limits
+
+
+def retry_after(headers: Mapping[str, str]) -> Optional[float]:
+    value = headers.get("retry-after-ms")
+    if value is not None:
+        return float(value) / 1000
+    value = headers.get("retry-after")
+    if value is not None:
+        try:
+            return float(value)
+        except ValueError:
+            return None
+    return None
+
+
+def classify_error(error: Exception) -> UpstreamError:
+    """백엔드가 던진 예외를 클라이언트에게 줄 상태 코드로 옮긴다."""
+    if isinstance(error, UpstreamError):
+        return error
+    status_code = getattr(error, "status_code", None)
+    response = getattr(error, "response", None)
+    headers = response.headers if response is not None else {}
+    if status_code == 429:
+        return UpstreamError(f"Upstream rate limit: {error}", 429, retry_after(headers))
+    if status_code is not None and 500 <= status_code < 600:
+        return UpstreamError(f"Upstream error: {error}", 503 if status_code == 503 else 502, retry_after(headers))
+    if status_code in (400, 404, 413, 422):
+        # 컨텍스트 길이 초과처럼 요청 자체가 잘못된 경우. 다시 보내도 똑같이 실패한다
+        return UpstreamError(str(error), 400)
+    if status_code is not None:
+        return UpstreamError(f"Upstream rejected the request: {error}", 502)
+    # SDK 마다 예외 계층이 달라서 타임아웃과 연결 실패는 이름으로도 알아본다
+    name = type(error).__name__
+    if isinstance(error, (asyncio.TimeoutError, TimeoutError)) or "Timeout" in name:
+        return UpstreamError(f"Upstream timed out: {error}", 504)
+    if isinstance(error, ConnectionError) or "Connection" in name or "Transport" in name:
+        return UpstreamError(f"Could not reach upstream: {error}", 502)
+    # 그 밖의 예외는 게이트웨이 쪽 문제일 가능성이 커서 다시 보내지 않는다
+    return UpstreamError(f"Upstream call failed: {name}: {error}", 502, retryable=False)
+
+
+class _Budget:
+    """분당 capacity 만큼 채워지는 버킷. capacity 가 0 이면 아직 한도를 모르는 것이므로 막지 않는다."""
+
+    def __init__(self, capacity: float):
+        self.capacity = capacity
+        self.available = capacity
+        self.updated_at = time.monotonic()
+
+    def refill(self, now: float):
+        if self.capacity:
+            self.available = min(self.capacity, self.available + (now - self.updated_at) * self.capacity / 60)
+        self.updated_at = now
+
+    def wait_time(self, amount: float) -> float:
+        if not self.capacity:
+            return 0.0
+        amount = min(amount, self.capacity)
+        return max(0.0, (amount - self.available) * 60 / self.capacity)
+
+    def take(self, amount: float):
+        if self.capacity:
+            self.available -= min(amount, self.capacity)
+
+    def update(self, limit: Optional[float], remaining: Optional[float], now: float):
+        self.refill(now)
+        if limit:
+            self.available = self.available if self.capacity else limit
+            self.capacity = limit
+        if remaining is not None and self.capacity:
+            # 업스트림이 센 남은 양이 더 정확하다. 다른 워커나 다른 클라이언트가 쓴 몫도 들어 있다
+            self.available = min(self.available, remaining)
+
+
+class _ModelSchedule:
+    def __init__(self, requests_per_minute: float, tokens_per_minute: float):
+        self.requests = _Budget(requests_per_minute)
+        self.tokens = _Budget(tokens_per_minute)
+        self.paused_until = 0.0
+        self.waiters = []
+        self.changed = asyncio.Event()
+        self.dispatched = 0
+        self.throttled = 0
+
+    def notify(self):
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+    def delay(self, tokens: int, now: float) -> float:
+        self.requests.refill(now)
+        self.tokens.refill(now)
+        return max(self.paused_until - now, self.requests.wait_time(1), self.tokens.wait_time(tokens))
+
+
+class UpstreamScheduler:
+    def __init__(self, requests_per_minute: float = 0, tokens_per_minute: float = 0, queue_timeout: float = 30.0,
+                 max_retries: int = 3, backoff: float = 0.5, max_backoff: float = 20.0):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.queue_timeout = queue_timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self._schedules: Dict[str, _ModelSchedule] = {}
+        self._sequence = itertools.count()
+
+    def _schedule(self, model: str) -> _ModelSchedule:
+        if model not in self._schedules:
+            self._schedules[model] = _ModelSchedule(self.requests_per_minute, self.tokens_per_minute)
+        return self._schedules[model]
+
+    async def acquire(self, model: str, tokens: int, priority: str = "interactive"):
+        """예산이 생길 때까지 우선순위 순서로 기다렸다가 요청 하나와 tokens 만큼을 떼어 간다."""
+        schedule = self._schedule(model)
+        waiter = (PRIORITIES.get(priority, PRIORITIES["interactive"]), next(self._sequence))
+        heapq.heappush(schedule.waiters, waiter)
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.queue_timeout
+        try:
+            while True:
+                changed = schedule.changed
+                if schedule.waiters[0] != waiter:
+                    # 앞선 요청이 나갈 때까지 기다린다
+                    timeout = None
+                else:
+                    delay = schedule.delay(tokens, time.monotonic())
+                    if delay <= 0:
+                        schedule.requests.take(1)
+                        schedule.tokens.take(tokens)
+                        schedule.dispatched += 1
+                        return
+                    timeout = delay
+                remaining = deadline - loop.time()
+                if remaining <= 0 or (timeout is not None and timeout > remaining and waiter[0] > 0):
+                    schedule.throttled += 1
+                    raise UpstreamError(
+                        f"Rate limit budget for {model} is exhausted", 429,
+                        retry_after=max(1.0, timeout or schedule.delay(tokens, time.monotonic())),
+                        retryable=False
+                    )
+                try:
+                    await asyncio.wait_for(changed.wait(), min(timeout or remaining, remaining))
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            if waiter in schedule.waiters:
+                schedule.waiters.remove(waiter)
+                heapq.heapify(schedule.waiters)
+            schedule.notify()
+
+    def update(self, model: str, limits: Dict[str, float]):
+        # 응답 헤더(rate_limit_headers)로 버킷을 맞춘다
+        schedule = self._schedule(model)
+        now = time.monotonic()
+        schedule.requests.update(limits.get("limit_requests"), limits.get("remaining_requests"), now)
+        schedule.tokens.update(limits.get("limit_tokens"), limits.get("remaining_tokens"), now)
+
+    def reconcile(self, model: str, estimated_tokens: int, actual_tokens: int):
+        # 추정보다 적게 썼으면 돌려주고 많이 썼으면 더 뗀다
+        budget = self._schedule(model).tokens
+        if budget.capacity:
+            budget.available = min(budget.capacity, budget.available + estimated_tokens - actual_tokens)
+
+    def refund(self, model: str, tokens: int):
+        # acquire 로 떼어 갔지만 업스트림을 부르지 않은 요청의 몫(요청 하나와 tokens)을 돌려준다
+        schedule = self._schedule(model)
+        now = time.monotonic()
+        for budget, amount in ((schedule.requests, 1), (schedule.tokens, tokens)):
+            budget.refill(now)
+            if budget.capacity:
+                budget.available = min(budget.capacity, budget.available + min(amount, budget.capacity))
+        schedule.dispatched -= 1
+        schedule.notify()
+
+    def pause(self, model: str, seconds: float):
+        # 429 를 받으면 Retry-After 동안 이 모델로는 아무것도 내보내지 않는다
+        schedule = self._schedule(model)
+        schedule.paused_until = max(schedule.paused_until, time.monotonic() + seconds)
+
+    def backoff_delay(self, attempt: int, retry_after: Optional[float] = None) -> float:
+        if retry_after is not None:
+            return min(self.max_backoff, retry_after)
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        stats = {}
+        for model, schedule in self._schedules.items():
+            schedule.delay(0, now)
+            stats[model] = {
+                "waiting": {
+                    name: sum(1 for priority, _ in schedule.waiters if priority == value)
+                    for name, value in PRIORITIES.items()
+                },
+                "requests_per_minute": schedule.requests.capacity,
+                "tokens_per_minute": schedule.tokens.capacity,
+                "available_requests": math.floor(schedule.requests.available),
+                "available_tokens": math.floor(schedule.tokens.available),
+                "paused_for": max(0.0, schedule.paused_until - now),
+                "dispatched": schedule.dispatched,
+                "throttled": schedule.throttled,
+            }
+        return stats
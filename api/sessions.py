@@ -0,0 +1,100 @@
+"""델타 프로토콜용 대화 히스토리 저장소.
+
+클라이언트는 session_id, 마지막으로 받은 turn_id, 그 뒤에 생긴 메세지만 보낸다. 게이트웨이는 그 턴까지의
+히스토리를 찾아 앞에 붙여서 전체 요청을 만들고, 응답이 끝나면 응답까지 붙인 히스토리를 새 turn_id 로 저장한다.
+turn_id 는 앞 턴의 turn_id 와 새로 붙은 메세지로 만든 해시라서 워커가 달라도 같은 값이 나오고 덮어쓰기 경쟁이 없다.
+저장소는 검증을 마친 Message 목록을 그대로 두는 메모리 LRU 가 먼저이고, 워커끼리 공유하는 state 가 있으면
+그 다음에 본다. 메모리 LRU 는 항목 수(max_entries)와 히스토리 크기의 합(max_bytes)으로 모두 제한한다.
+공유 state 호출은 이벤트 루프를 막지 않도록 a* 메서드로 한다. 히스토리가 만료되었거나 다른 노드의 메모리에만 있으면 409 를 돌려주고,
+클라이언트는 전체 히스토리를 다시 보낸다.
+"""
+import hashlib
+import sys
+from typing import List, Optional
+
+from fastapi import HTTPException
+
+from api.cache import LRUTTLCache, canonical_messages
+from api.chat_requeset_schema import ChatRequest, Message
+from api.state_backend import StateBackend
+from api.wire import dumps, loads
+
+
+# 메세지 하나에 본문 말고 드는 메모리(Message 객체, role 문자열, 리스트 칸)의 대략적인 크기
+MESSAGE_OVERHEAD = 200
+
+
+def history_size(history: List[Message]) -> int:
+    return sum(sys.getsizeof(message.content) + MESSAGE_OVERHEAD for message in history)
+
+
+def turn_id(parent: Optional[str], messages: List[dict]) -> str:
+    digest = hashlib.sha256((parent or "").encode("ascii"))
+    digest.update(dumps(messages))
+    return digest.hexdigest()[:32]
+
+
+class SessionStore:
+    def __init__(self, max_entries: int, ttl: float, state: Optional[StateBackend] = None, max_bytes: int = 0):
+        self.ttl = ttl
+        self.memory = LRUTTLCache(max_entries, ttl, max_weight=max_bytes, weigh=history_size)
+        self.shared = state if state is not None and state.shared else None
+        self.requests = {"full": 0, "delta": 0, "conflict": 0}
+
+    def _key(self, session_id: str, turn: str) -> str:
+        return f"session:{session_id}:{turn}"
+
+    async def _get(self, key: str) -> Optional[List[Message]]:
+        history = self.memory.get(key)
+        if history is None and self.shared is not None:
+            value = await self.shared.aget(key)
+            if value is not None:
+                # 공유 저장소의 히스토리는 이 게이트웨이가 검증한 뒤 넣은 것이므로 다시 검증하지 않는다
+                history = [Message.model_construct(**message) for message in loads(value)]
+                self.memory.set(key, history)
+        return history
+
+    async def resolve(self, req: ChatRequest) -> ChatRequest:
+        """델타 요청이면 저장해 둔 히스토리를 앞에 붙인 요청을 돌려준다."""
+        if req.session_id is None or req.last_turn_id is None:
+            if req.session_id is not None:
+                self.requests["full"] += 1
+            return req
+        history = await self._get(self._key(req.session_id, req.last_turn_id))
+        if history is None:
+            self.requests["conflict"] += 1
+            raise HTTPException(
+                status_code=409,
+                detail=f"Unknown turn {req.last_turn_id} for session {req.session_id}; resend the full history"
+            )
+        self.requests["delta"] += 1
+        return req.model_copy(update={"message": history + req.message})
+
+    async def commit(self, req: ChatRequest, reply: str) -> Optional[str]:
+        """응답까지 붙인 히스토리를 저장하고 다음 요청에 쓸 turn_id 를 돌려준다."""
+        if req.session_id is None:
+            return None
+        answer = Message.model_construct(role="assistant", content=reply)
+        history = req.message + [answer]
+
+        # 앞 턴이 메모리에 있으면 그 뒤에 붙은 메세지만 해시한다
+        parent_key = self._key(req.session_id, req.last_turn_id) if req.last_turn_id is not None else None
+        parent = self.memory.get(parent_key) if parent_key is not None else None
+        if parent is not None and len(parent) < len(history):
+            turn = turn_id(req.last_turn_id, canonical_messages(history[len(parent):]))
+        else:
+            turn = turn_id(None, canonical_messages(history))
+
+        key = self._key(req.session_id, turn)
+        self.memory.set(key, history)
+        if self.shared is not None:
+            await self.shared.aset(key, dumps(canonical_messages(history)).decode("utf-8"), self.ttl)
+        # 앞 턴의 히스토리는 새 턴에 모두 들어 있으므로 지운다. 같은 턴으로 다시 보내면 409 뒤에 전체를 받는다
+        if parent_key is not None:
+            self.memory.delete(parent_key)
+            if self.shared is not None:
+                await self.shared.adelete(parent_key)
+        return turn
+
+    def stats(self) -> dict:
+        return {"requests": dict(self.requests), "entries": len(self.memory), "bytes": self.memory.weight}
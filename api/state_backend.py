@@ -0,0 +1,313 @@
+"""게이트웨이 워커들이 나눠 쓰는 상태 저장소.
+
+모델별 동시 호출 슬롯, 응답 캐시, 진행 중인 업스트림 호출(single-flight)을 워커 여러 개가
+함께 보려면 프로세스 밖에 상태를 둬야 한다. CHAT_STATE_BACKEND 로 고른다.
+
+    memory                      프로세스 안에서만 (기본값, 워커 1개일 때)
+    sqlite:///gateway_state.db  한 노드의 여러 워커 (SQLAlchemy 처럼 슬래시 넷이면 절대 경로)
+    redis://host:6379/0         여러 노드. RESP 프로토콜만 쓰므로 Redis 호환 서버면 된다
+
+값은 문자열이고 키마다 TTL(초)을 둔다. 연산은 동기 호출이고, 이벤트 루프에서는 a 로 시작하는 짝(aget, aadd, ...)을
+쓴다. 공유 저장소 호출은 SQLite 잠금 대기나 소켓 I/O 로 막힐 수 있으므로 전용 스레드풀에서 돌린다.
+"""
+import asyncio
+import socket
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional
+from urllib.parse import urlparse
+
+STATE_IO_THREADS = 4
+
+
+class StateBackend:
+    # shared 가 False 이면 워커끼리 나눌 게 없으므로 호출하는 쪽이 프로세스 안의 자료구조만 쓴다
+    shared = True
+    _executor = None
+
+    def get(self, key: str) -> Optional[str]:
+        raise NotImplementedError
+
+    def get_many(self, keys: List[str]) -> List[Optional[str]]:
+        return [self.get(key) for key in keys]
+
+    def set(self, key: str, value: str, ttl: float):
+        raise NotImplementedError
+
+    def add(self, key: str, value: str, ttl: float) -> bool:
+        """키가 없을 때만 넣고, 넣었으면 True. 슬롯과 single-flight 의 주인을 정하는 데 쓴다.
+
+        응답을 받지 못해 적용 여부를 모를 때는 지금 값이 value 인지로 판단하므로, value 는 lease 마다 달라야 한다.
+        """
+        raise NotImplementedError
+
+    def delete(self, key: str, value: Optional[str] = None):
+        """value 를 주면 지금 값이 그것일 때만 지운다(남의 lease 를 지우지 않도록)."""
+        raise NotImplementedError
+
+    async def _offload(self, method, *args):
+        if not self.shared:
+            return method(*args)
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(STATE_IO_THREADS, thread_name_prefix="state-io")
+        return await asyncio.get_running_loop().run_in_executor(self._executor, method, *args)
+
+    async def aget(self, key: str) -> Optional[str]:
+        return await self._offload(self.get, key)
+
+    async def aget_many(self, keys: List[str]) -> List[Optional[str]]:
+        return await self._offload(self.get_many, keys)
+
+    async def aset(self, key: str, value: str, ttl: float):
+        await self._offload(self.set, key, value, ttl)
+
+    async def aadd(self, key: str, value: str, ttl: float) -> bool:
+        return await self._offload(self.add, key, value, ttl)
+
+    async def adelete(self, key: str, value: Optional[str] = None):
+        await self._offload(self.delete, key, value)
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+
+class InProcessStateBackend(StateBackend):
+    shared = False
+
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def _live(self, key: str) -> Optional[str]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self._entries[key]
+            return None
+        return value
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            return self._live(key)
+
+    def set(self, key: str, value: str, ttl: float):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl, value)
+
+    def add(self, key: str, value: str, ttl: float) -> bool:
+        with self._lock:
+            if self._live(key) is not None:
+                return False
+            self._entries[key] = (time.monotonic() + ttl, value)
+            return True
+
+    def delete(self, key: str, value: Optional[str] = None):
+        with self._lock:
+            if value is None or self._live(key) == value:
+                self._entries.pop(key, None)
+
+
+class SQLiteStateBackend(StateBackend):
+    """WAL 모드 SQLite 파일 하나를 같은 노드의 워커들이 함께 연다."""
+
+    def __init__(self, path: str):
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=5.0)
+        self._lock = threading.Lock()
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS gateway_state ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL)"
+        )
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value FROM gateway_state WHERE key = ? AND expires_at >= ?", (key, time.time())
+            ).fetchone()
+        return row[0] if row else None
+
+    def get_many(self, keys: List[str]) -> List[Optional[str]]:
+        with self._lock:
+            rows = dict(self._conn.execute(
+                f"SELECT key, value FROM gateway_state WHERE key IN ({','.join('?' * len(keys))}) "
+                "AND expires_at >= ?", (*keys, time.time())
+            ).fetchall())
+        return [rows.get(key) for key in keys]
+
+    def set(self, key: str, value: str, ttl: float):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO gateway_state (key, value, expires_at) VALUES (?, ?, ?)",
+                (key, value, time.time() + ttl)
+            )
+
+    def add(self, key: str, value: str, ttl: float) -> bool:
+        now = time.time()
+        with self._lock:
+            # 만료된 값은 없는 것으로 보고 덮어쓴다. 한 문장이라 워커 사이에서도 원자적이다
+            cursor = self._conn.execute(
+                "INSERT INTO gateway_state (key, value, expires_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET value = excluded.value, expires_at = excluded.expires_at "
+                "WHERE gateway_state.expires_at < ?",
+                (key, value, now + ttl, now)
+            )
+        return cursor.rowcount == 1
+
+    def delete(self, key: str, value: Optional[str] = None):
+        with self._lock:
+            if value is None:
+                self._conn.execute("DELETE FROM gateway_state WHERE key = ?", (key,))
+            else:
+                self._conn.execute("DELETE FROM gateway_state WHERE key = ? AND value = ?", (key, value))
+
+    def purge_expired(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM gateway_state WHERE expires_at < ?", (time.time(),))
+
+    def close(self):
+        super().close()
+        self._conn.close()
+
+
+class RESPError(Exception):
+    pass
+
+
+class IndeterminateWriteError(ConnectionError):
+    """명령은 보냈지만 응답을 받지 못해서 적용되었는지 알 수 없다."""
+
+
+class _Connection:
+    def __init__(self, address, db: int, timeout: float):
+        self.sock = socket.create_connection(address, timeout=timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.reader = self.sock.makefile("rb")
+        if db:
+            self.send("SELECT", str(db))
+            self.read()
+
+    def send(self, *args: str):
+        parts = [f"*{len(args)}\r\n".encode()]
+        for arg in args:
+            data = arg.encode("utf-8")
+            parts.append(b"$%d\r\n%s\r\n" % (len(data), data))
+        self.sock.sendall(b"".join(parts))
+
+    def read(self):
+        line = self.reader.readline()
+        if not line:
+            raise ConnectionError("state server closed the connection")
+        kind, rest = line[:1], line[1:-2]
+        if kind == b"+":
+            return rest.decode()
+        if kind == b"-":
+            raise RESPError(rest.decode())
+        if kind == b":":
+            return int(rest)
+        if kind == b"$":
+            length = int(rest)
+            if length < 0:
+                return None
+            return self.reader.read(length + 2)[:-2].decode("utf-8")
+        if kind == b"*":
+            length = int(rest)
+            return None if length < 0 else [self.read() for _ in range(length)]
+        raise RESPError(f"Unexpected reply: {line!r}")
+
+    def close(self):
+        # makefile 로 만든 reader 까지 닫아야 소켓이 실제로 닫힌다
+        self.reader.close()
+        self.sock.close()
+
+
+class RedisStateBackend(StateBackend):
+    """GET/MGET/SET NX PX/DEL 만 쓰는 최소한의 RESP 클라이언트. 스레드마다 연결 하나를 둔다."""
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 6379, db: int = 0, timeout: float = 1.0):
+        self._address = (host, port)
+        self._db = db
+        self._timeout = timeout
+        self._local = threading.local()
+        self._connections = set()
+        self._lock = threading.Lock()
+
+    def execute(self, *args: str, idempotent: bool = True):
+        # 끊긴 연결은 한 번만 다시 맺어 본다. 보낸 뒤에 실패한 명령은 멱등일 때만 다시 보낸다
+        for attempt in range(2):
+            sent = False
+            try:
+                connection = self._connection()
+                connection.send(*args)
+                sent = True
+                return connection.read()
+            except OSError as e:
+                self._disconnect()
+                if sent and not idempotent:
+                    raise IndeterminateWriteError(f"No reply to {args[0]}: {e}") from e
+                if attempt:
+                    raise
+
+    def _connection(self) -> _Connection:
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = _Connection(self._address, self._db, self._timeout)
+            self._local.connection = connection
+            with self._lock:
+                self._connections.add(connection)
+        return connection
+
+    def _disconnect(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is not None:
+            self._local.connection = None
+            with self._lock:
+                self._connections.discard(connection)
+            connection.close()
+
+    def get(self, key: str) -> Optional[str]:
+        return self.execute("GET", key)
+
+    def get_many(self, keys: List[str]) -> List[Optional[str]]:
+        return self.execute("MGET", *keys)
+
+    def set(self, key: str, value: str, ttl: float):
+        self.execute("SET", key, value, "PX", str(int(ttl * 1000)))
+
+    def add(self, key: str, value: str, ttl: float) -> bool:
+        try:
+            return self.execute("SET", key, value, "NX", "PX", str(int(ttl * 1000)), idempotent=False) == "OK"
+        except IndeterminateWriteError:
+            # 다시 보내면 먼저 보낸 SET 이 이미 잡은 키를 남의 것으로 보게 된다. 지금 값이 우리 값이면 잡은 것이다
+            return self.get(key) == value
+
+    def delete(self, key: str, value: Optional[str] = None):
+        # GET 과 DEL 사이에 lease 가 만료되어 남에게 넘어갈 수 있지만, lease TTL 이 호출 시간보다
+        # 훨씬 길어서 실제로는 일어나지 않는다
+        if value is None or self.get(key) == value:
+            self.execute("DEL", key)
+
+    def close(self):
+        super().close()
+        with self._lock:
+            connections, self._connections = self._connections, set()
+        for connection in connections:
+            connection.close()
+
+
+def create_state_backend(url: str) -> StateBackend:
+    if not url or url == "memory":
+        return InProcessStateBackend()
+    parsed = urlparse(url)
+    if parsed.scheme == "sqlite":
+        return SQLiteStateBackend(url[len("sqlite:///"):])
+    if parsed.scheme == "redis":
+        return RedisStateBackend(parsed.hostname or "127.0.0.1", parsed.port or 6379,
+                                 int(parsed.path.lstrip("/") or 0))
+    raise ValueError(f"Unsupported state backend: {url}")
@@ -0,0 +1,70 @@
+"""게이트웨이 요청/응답 본문의 직렬화.
+
+FastAPI 기본 경로(json.loads 후 모델 검증) 대신 본문 바이트를 orjson 으로 풀어서 바로 검증한다.
+Content-Type 이 application/msgpack 이면 msgpack 으로 푼다. 둘 다 선택 의존성이라 없으면
+각각 표준 json 으로 대신하거나 415 를 돌려준다. 응답 이벤트도 같은 방식으로 인코딩한다.
+orjson 은 한글을 \\uXXXX 로 이스케이프하지 않으므로 같은 JSON 이라도 바이트가 절반 가까이 줄어든다.
+"""
+import json
+from typing import Any
+
+from fastapi import HTTPException, Request
+from fastapi.exceptions import RequestValidationError
+from pydantic import ValidationError
+
+from api.chat_requeset_schema import ChatRequest
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+JSON_TYPE = "application/json"
+MSGPACK_TYPE = "application/msgpack"
+
+
+def dumps(value: Any) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(value)
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def loads(body: bytes, content_type: str = JSON_TYPE) -> Any:
+    if content_type == MSGPACK_TYPE:
+        if msgpack is None:
+            raise HTTPException(status_code=415, detail="msgpack is not installed on this gateway")
+        return msgpack.unpackb(body, raw=False)
+    if orjson is not None:
+        return orjson.loads(body)
+    return json.loads(body)
+
+
+def ndjson_line(event: dict) -> bytes:
+    return dumps(event) + b"\n"
+
+
+async def read_chat_request(request: Request) -> ChatRequest:
+    """ChatRequest 를 본문에서 직접 읽는 FastAPI 의존성. 오류 형식(422)은 FastAPI 기본 경로와 같게 맞춘다."""
+    body = await request.body()
+    content_type = request.headers.get("content-type", JSON_TYPE).split(";")[0].strip().lower()
+    try:
+        data = loads(body, content_type)
+    except HTTPException:
+        raise
+    except ValueError as e:
+        # orjson, json, msgpack 의 디코드 오류는 모두 ValueError 다
+        raise RequestValidationError([{
+            "type": "json_invalid", "loc": ("body", 0), "msg": "JSON decode error", "input": {},
+            "ctx": {"error": str(e)},
+        }])
+    try:
+        return ChatRequest.model_validate(data)
+    except ValidationError as e:
+        raise RequestValidationError([
+            {**error, "loc": ("body", *error["loc"])} for error in e.errors(include_url=False)
+        ])
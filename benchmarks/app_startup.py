@@ -0,0 +1,80 @@
+"""Streamlit 앱 기동/rerun 시간 벤치마크.
+
+임시 디렉토리에 대화가 쌓인 chatbot.db 를 만들고 AppTest 로 chat_app.py 를 돌린다.
+첫 실행(엔진 생성과 스키마 확인 포함), 같은 프로세스의 새 세션, 같은 세션의 rerun 시간을 잰다.
+
+    python -m benchmarks.app_startup --rooms 5 --turns 200 --reruns 30
+"""
+import argparse
+import os
+import tempfile
+import time
+
+from benchmarks.gateway_load import percentile
+from database.setup_chat_db import ChatDatabase
+
+APP_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "chat_app.py")
+
+
+def seed_database(db_file: str, rooms: int, turns: int):
+    chat_bot_db = ChatDatabase(db_file)
+    user = chat_bot_db.user_login('default')
+    for room in range(rooms):
+        for turn in range(turns):
+            chat_bot_db.add_message(
+                room_name=f"room{room}",
+                user_id=user.id,
+                user_name=user.name,
+                user_message=f"질문 {turn} " * 20,
+                chatbot_message=f"답변 {turn} " * 60,
+                model_name="gpt-3.5-turbo",
+                total_tokens=300,
+                cost=0.0006
+            )
+    chat_bot_db.close()
+
+
+def timed_run(app_test) -> float:
+    started = time.perf_counter()
+    app_test.run()
+    elapsed = time.perf_counter() - started
+    if app_test.exception:
+        raise RuntimeError(app_test.exception[0].value)
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rooms", type=int, default=5)
+    parser.add_argument("--turns", type=int, default=200)
+    parser.add_argument("--reruns", type=int, default=30)
+    args = parser.parse_args()
+
+    os.chdir(tempfile.mkdtemp())
+    seed_database("chatbot.db", args.rooms, args.turns)
+
+    started = time.perf_counter()
+    from streamlit.testing.v1 import AppTest
+    import_s = time.perf_counter() - started
+
+    first = AppTest.from_file(APP_PATH, default_timeout=60)
+    first_run_s = timed_run(first)
+    rerun_s = [timed_run(first) for _ in range(args.reruns)]
+
+    second = AppTest.from_file(APP_PATH, default_timeout=60)
+    new_session_s = timed_run(second)
+
+    result = {
+        "streamlit_import_ms": import_s * 1000,
+        "first_run_ms": first_run_s * 1000,
+        "new_session_ms": new_session_s * 1000,
+        "rerun_p50_ms": percentile(rerun_s, 50) * 1000,
+        "rerun_p99_ms": percentile(rerun_s, 99) * 1000,
+        "rendered_messages": len(first.chat_message),
+    }
+    for key, value in result.items():
+        print(f"{key:>20}: {value:.2f}" if isinstance(value, float) else f"{key:>20}: {value}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+"""ChatDatabase 동시성 스트레스 테스트.
+
+여러 writer 스레드가 한 DB 파일에 동시에 add_message 를 하고, reader 스레드가
+그 사이 방 목록과 메세지를 읽는다. 잠금 오류가 하나라도 나거나 저장된 행 수/합계가
+맞지 않으면 0 이 아닌 코드로 끝난다.
+
+    python -m benchmarks.db_stress --writers 32 --turns 200
+"""
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+
+from sqlalchemy import func
+
+from database.models import Message, Room, UsageDaily, UsageLedger
+from database.setup_chat_db import ChatDatabase
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--writers", type=int, default=32)
+    parser.add_argument("--readers", type=int, default=4)
+    parser.add_argument("--turns", type=int, default=200)
+    parser.add_argument("--db", default=None, help="기본값은 임시 디렉토리의 새 파일")
+    args = parser.parse_args()
+
+    db_file = args.db or os.path.join(tempfile.mkdtemp(), "stress.db")
+    chat_db = ChatDatabase(db_file)
+    user = chat_db.user_login("stress")
+
+    errors = []
+    stop_readers = threading.Event()
+
+    def writer(index):
+        try:
+            for turn in range(args.turns):
+                chat_db.add_message(
+                    room_name=f"room-{index % 8}",
+                    user_id=user.id,
+                    user_name=user.name,
+                    user_message=f"question {index}-{turn}",
+                    chatbot_message=f"answer {index}-{turn}",
+                    model_name="gpt-3.5-turbo",
+                    total_tokens=10,
+                    cost=0.001
+                )
+        except Exception as e:
+            errors.append(e)
+
+    def reader():
+        try:
+            while not stop_readers.is_set():
+                rooms, chat_rooms_data = chat_db.load_chat_rooms(user.id)
+                for room in rooms:
+                    chat_db.load_messages(chat_rooms_data[room]['room_id'])
+        except Exception as e:
+            errors.append(e)
+
+    readers = [threading.Thread(target=reader) for _ in range(args.readers)]
+    writers = [threading.Thread(target=writer, args=(i,)) for i in range(args.writers)]
+    started = time.perf_counter()
+    for thread in readers + writers:
+        thread.start()
+    for thread in writers:
+        thread.join()
+    elapsed = time.perf_counter() - started
+    stop_readers.set()
+    for thread in readers:
+        thread.join()
+
+    expected = args.writers * args.turns
+    with chat_db.session_scope() as session:
+        stored = session.query(func.count(Message.id)).scalar()
+        total_cost = session.query(func.sum(Room.room_total_cost)).scalar() or 0.0
+    # close 가 남은 사용량을 flush 하므로 장부와 롤업은 그 뒤에 센다
+    chat_db.close()
+    with chat_db.session_scope() as session:
+        ledger_entries = session.query(func.count(UsageLedger.id)).scalar()
+        rollup_cost = session.query(func.sum(UsageDaily.cost)).scalar() or 0.0
+    chat_db.engine.dispose()
+
+    print(f"       db: {db_file}")
+    print(f"   writes: {stored}/{expected} in {elapsed:.2f}s ({stored / elapsed:.0f} turns/s)")
+    print(f"     cost: {total_cost:.3f} (expected {expected * 0.001:.3f})")
+    print(f"   ledger: {ledger_entries} entries, rollup cost {rollup_cost:.3f}")
+    print(f"   errors: {len(errors)}")
+    for error in errors[:5]:
+        print(f"           {type(error).__name__}: {error}")
+
+    ok = not errors and stored == expected and abs(total_cost - expected * 0.001) < 1e-6 \
+        and ledger_entries == stored and abs(rollup_cost - total_cost) < 1e-6
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,156 @@
+"""OpenAI 호환 /v1/chat/completions 를 흉내내는 로컬 가짜 업스트림.
+
+    FAKE_UPSTREAM_LATENCY=0.2 FAKE_UPSTREAM_TPS=50 uvicorn benchmarks.fake_upstream:app --port 9100
+
+FAKE_UPSTREAM_RPM / FAKE_UPSTREAM_TPM 을 주면 OpenAI 처럼 분당 한도를 세어 x-ratelimit-* 헤더를 붙이고,
+넘으면 429 와 retry-after 를 돌려준다.
+FAKE_UPSTREAM_ERROR_RATE 비율만큼은 응답 전에 500/502/503 으로 실패하고, FAKE_UPSTREAM_DISCONNECT_RATE
+비율만큼은 스트림을 절반쯤 보낸 뒤 연결을 끊는다. FAKE_UPSTREAM_SEED 를 주면 실패가 매번 같은 순서로 난다.
+"""
+import asyncio
+import json
+import os
+import random
+import time
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+LATENCY = float(os.environ.get("FAKE_UPSTREAM_LATENCY", 0.2))
+TOKENS_PER_SECOND = float(os.environ.get("FAKE_UPSTREAM_TPS", 50))
+COMPLETION_TOKENS = int(os.environ.get("FAKE_UPSTREAM_COMPLETION_TOKENS", 32))
+REQUESTS_PER_MINUTE = float(os.environ.get("FAKE_UPSTREAM_RPM", 0))  # 0 이면 제한하지 않는다
+TOKENS_PER_MINUTE = float(os.environ.get("FAKE_UPSTREAM_TPM", 0))
+ERROR_RATE = float(os.environ.get("FAKE_UPSTREAM_ERROR_RATE", 0))
+DISCONNECT_RATE = float(os.environ.get("FAKE_UPSTREAM_DISCONNECT_RATE", 0))
+ERROR_STATUS_CODES = (500, 502, 503)
+
+failures = random.Random(os.environ.get("FAKE_UPSTREAM_SEED"))
+
+app = FastAPI()
+
+
+class RateLimits:
+    """요청 수와 토큰 수를 분당 한도만큼 연속으로 채우는 버킷. 토큰은 prompt + max_tokens 로 미리 뗀다."""
+
+    def __init__(self, requests_per_minute: float, tokens_per_minute: float):
+        self.limits = {"requests": requests_per_minute, "tokens": tokens_per_minute}
+        self.remaining = dict(self.limits)
+        self.updated_at = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        for kind, limit in self.limits.items():
+            self.remaining[kind] = min(limit, self.remaining[kind] + (now - self.updated_at) * limit / 60)
+        self.updated_at = now
+
+    def _reset(self, kind: str) -> float:
+        limit = self.limits[kind]
+        return (limit - self.remaining[kind]) * 60 / limit if limit else 0.0
+
+    def take(self, tokens: int) -> float:
+        """한도 안이면 떼고 0을, 넘으면 다시 시도할 때까지의 초를 돌려준다."""
+        self._refill()
+        need = {"requests": 1, "tokens": tokens}
+        waits = [
+            (need[kind] - self.remaining[kind]) * 60 / limit
+            for kind, limit in self.limits.items() if limit and self.remaining[kind] < need[kind]
+        ]
+        if waits:
+            return max(waits)
+        for kind, limit in self.limits.items():
+            if limit:
+                self.remaining[kind] -= need[kind]
+        return 0.0
+
+    def headers(self) -> dict:
+        headers = {}
+        for kind, limit in self.limits.items():
+            if limit:
+                headers[f"x-ratelimit-limit-{kind}"] = str(int(limit))
+                headers[f"x-ratelimit-remaining-{kind}"] = str(max(0, int(self.remaining[kind])))
+                headers[f"x-ratelimit-reset-{kind}"] = f"{self._reset(kind):.3f}s"
+        return headers
+
+
+rate_limits = RateLimits(REQUESTS_PER_MINUTE, TOKENS_PER_MINUTE)
+
+
+def _usage(body: dict, completion_tokens: int) -> dict:
+    prompt_tokens = sum(len(str(m.get("content", "")).split()) for m in body.get("messages", []))
+    return {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": prompt_tokens + completion_tokens,
+    }
+
+
+def _chunk(model: str, choices: list, usage: dict = None) -> str:
+    payload = {
+        "id": "chatcmpl-fake",
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": model,
+        "choices": choices,
+    }
+    if usage is not None:
+        payload["usage"] = usage
+    return f"data: {json.dumps(payload)}\n\n"
+
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    body = await request.json()
+    model = body.get("model", "fake")
+    completion_tokens = min(body.get("max_tokens") or COMPLETION_TOKENS, COMPLETION_TOKENS)
+    usage = _usage(body, completion_tokens)
+    token_interval = 1.0 / TOKENS_PER_SECOND if TOKENS_PER_SECOND > 0 else 0.0
+
+    retry_after = rate_limits.take(usage["prompt_tokens"] + (body.get("max_tokens") or COMPLETION_TOKENS))
+    headers = rate_limits.headers()
+    if retry_after:
+        return JSONResponse(
+            {"error": {"message": "Rate limit reached", "type": "requests", "code": "rate_limit_exceeded"}},
+            status_code=429,
+            headers={**headers, "retry-after": f"{retry_after:.3f}"},
+        )
+
+    await asyncio.sleep(LATENCY)
+
+    if failures.random() < ERROR_RATE:
+        return JSONResponse(
+            {"error": {"message": "The server had an error while processing your request", "type": "server_error"}},
+            status_code=failures.choice(ERROR_STATUS_CODES),
+            headers=headers,
+        )
+
+    if body.get("stream"):
+        disconnect_at = completion_tokens // 2 if failures.random() < DISCONNECT_RATE else None
+
+        async def event_stream():
+            for i in range(completion_tokens):
+                if i == disconnect_at:
+                    # 응답 도중에 예외를 내면 uvicorn 이 청크 전송을 끝내지 않고 연결을 닫는다
+                    raise ConnectionResetError("fake upstream dropped the stream")
+                yield _chunk(model, [{"index": 0, "delta": {"content": f" tok{i}"}, "finish_reason": None}])
+                await asyncio.sleep(token_interval)
+            yield _chunk(model, [{"index": 0, "delta": {}, "finish_reason": "stop"}])
+            if body.get("stream_options", {}).get("include_usage"):
+                yield _chunk(model, [], usage)
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(event_stream(), media_type="text/event-stream", headers=headers)
+
+    await asyncio.sleep(token_interval * completion_tokens)
+    return JSONResponse(headers=headers, content={
+        "id": "chatcmpl-fake",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{
+            "index": 0,
+            "message": {"role": "assistant", "content": "".join(f" tok{i}" for i in range(completion_tokens))},
+            "finish_reason": "stop",
+        }],
+        "usage": usage,
+    })
@@ -0,0 +1,129 @@
+"""대화 검색(FTS5) 벤치마크.
+
+합성 메세지 N 개를 사용자/방에 나눠 넣고 FTS 인덱스를 만든 뒤
+흔한 단어, 드문 단어, 두 단어 질의로 ChatDatabase.search_messages 의 지연을 잰다.
+
+    python -m benchmarks.fts_search --messages 1000000 --queries 200
+    python -m benchmarks.fts_search --db /tmp/search.db   # 이미 만든 DB 로 검색만 다시 잰다
+"""
+import argparse
+import itertools
+import os
+import random
+import sqlite3
+import tempfile
+import time
+
+from benchmarks.gateway_load import percentile
+from database.setup_chat_db import ChatDatabase
+
+SYLLABLES = "가나다라마바사아자차카타파하서울날씨파이썬정렬모델토큰비용요약검색대화기록설정"
+PARTICLES = ["", "", "를", "은", "는", "에서", "으로"]
+INSERT_BATCH = 10000
+
+
+def make_vocabulary(size: int, rng: random.Random) -> list:
+    words = set()
+    while len(words) < size:
+        words.add("".join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4))))
+    return sorted(words)
+
+
+def make_sentence(vocabulary: list, cum_weights: list, rng: random.Random, length: int) -> str:
+    words = rng.choices(vocabulary, cum_weights=cum_weights, k=length)
+    return " ".join(word + rng.choice(PARTICLES) for word in words)
+
+
+def build_database(db_file: str, messages: int, users: int, rooms_per_user: int, vocabulary: list,
+                   cum_weights: list, rng: random.Random):
+    # 스키마를 만든 뒤 대량 적재 동안만 FTS 인덱스와 트리거를 떼어 두고, 끝나면 ChatDatabase 가 다시 만들며 한 번에 채운다
+    ChatDatabase(db_file).close()
+    conn = sqlite3.connect(db_file, isolation_level=None)
+    for trigger in ("messages_fts_insert", "messages_fts_delete", "messages_fts_update"):
+        conn.execute(f"DROP TRIGGER {trigger}")
+    conn.execute("DROP TABLE messages_fts")
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("BEGIN")
+    conn.executemany("INSERT INTO users (id, name, user_total_cost) VALUES (?, ?, 0)",
+                     [(user, f"user{user}") for user in range(1, users + 1)])
+    conn.executemany("INSERT INTO rooms (id, name, user_id, room_total_cost) VALUES (?, ?, ?, 0)", [
+        (user * rooms_per_user + room, f"room{room}", user)
+        for user in range(1, users + 1) for room in range(rooms_per_user)
+    ])
+    conn.execute("COMMIT")
+
+    started = time.perf_counter()
+    for offset in range(0, messages, INSERT_BATCH):
+        rows = []
+        for _ in range(min(INSERT_BATCH, messages - offset)):
+            user = rng.randint(1, users)
+            rows.append((
+                user * rooms_per_user + rng.randrange(rooms_per_user), user,
+                make_sentence(vocabulary, cum_weights, rng, rng.randint(4, 12)),
+                make_sentence(vocabulary, cum_weights, rng, rng.randint(10, 40)),
+            ))
+        conn.execute("BEGIN")
+        conn.executemany(
+            "INSERT INTO messages (room_id, user_id, user_message, chatbot_message, model_name, total_tokens, cost) "
+            "VALUES (?, ?, ?, ?, 'gpt-3.5-turbo', 100, 0.0002)", rows
+        )
+        conn.execute("COMMIT")
+    conn.close()
+    insert_s = time.perf_counter() - started
+
+    started = time.perf_counter()
+    ChatDatabase(db_file).close()
+    return insert_s, time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=1000000)
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--rooms-per-user", type=int, default=10)
+    parser.add_argument("--vocabulary", type=int, default=20000)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--db", default=None, help="있으면 그대로 쓰고, 없으면 새로 만든다")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    vocabulary = make_vocabulary(args.vocabulary, rng)
+    # 단어 빈도가 Zipf 분포를 따르게 한다
+    cum_weights = list(itertools.accumulate(1 / rank for rank in range(1, len(vocabulary) + 1)))
+
+    db_file = args.db or os.path.join(tempfile.mkdtemp(), "search.db")
+    if not os.path.exists(db_file):
+        insert_s, index_s = build_database(
+            db_file, args.messages, args.users, args.rooms_per_user, vocabulary, cum_weights, rng
+        )
+        print(f"{'insert_s':>18}: {insert_s:.1f} ({args.messages / insert_s:.0f} messages/s)")
+        print(f"{'index_s':>18}: {index_s:.1f}")
+
+    chat_db = ChatDatabase(db_file)
+    queries = {
+        "common_word": [vocabulary[rng.randrange(10)] for _ in range(args.queries)],
+        "rare_word": [vocabulary[rng.randrange(1000, len(vocabulary))] for _ in range(args.queries)],
+        "two_words": [f"{vocabulary[rng.randrange(100)]} {vocabulary[rng.randrange(100, 2000)]}"
+                      for _ in range(args.queries)],
+        "page_3": [vocabulary[rng.randrange(10, 100)] for _ in range(args.queries)],
+    }
+    print(f"{'db':>18}: {db_file} ({os.path.getsize(db_file) / 1024 / 1024:.0f}MB)")
+    for name, terms in queries.items():
+        latencies = []
+        hits = 0
+        for term in terms:
+            user_id = rng.randint(1, args.users)
+            offset = 40 if name == "page_3" else 0
+            started = time.perf_counter()
+            results = chat_db.search_messages(user_id, term, offset=offset)
+            latencies.append(time.perf_counter() - started)
+            hits += len(results)
+        print(f"{name:>18}: p50 {percentile(latencies, 50) * 1000:.2f}ms  "
+              f"p99 {percentile(latencies, 99) * 1000:.2f}ms  avg hits {hits / len(terms):.1f}")
+    chat_db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+"""게이트웨이 부하 벤치마크.
+
+가짜 업스트림(benchmarks.fake_upstream)과 게이트웨이를 로컬에 띄운 뒤
+동시 요청을 흘려 p50/p99 지연과 처리량을 출력한다.
+
+    python -m benchmarks.gateway_load --requests 2000 --concurrency 200 --stream
+"""
+import argparse
+import asyncio
+import os
+import subprocess
+import sys
+import time
+from collections import Counter
+
+import httpx
+
+UPSTREAM_PORT = 9100
+GATEWAY_PORT = 8100
+
+
+def start_server(app_path: str, port: int, env: dict = None) -> subprocess.Popen:
+    return subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", app_path, "--port", str(port), "--log-level", "warning"],
+        env={**os.environ, **(env or {})},
+    )
+
+
+def wait_until_ready(url: str, timeout: float = 15.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            httpx.get(url, timeout=1.0)
+            return
+        except httpx.TransportError:
+            time.sleep(0.1)
+    raise RuntimeError(f"{url} did not come up within {timeout}s")
+
+
+def percentile(values: list, p: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+async def run_load(url: str, total: int, concurrency: int, stream: bool, model: str, tag: str = "") -> dict:
+    latencies = []
+    statuses = Counter()
+    payload = {
+        "model": model,
+        "max_tokens": 32,
+        "temperature": 0.2,
+    }
+    endpoint = url + ("/chat/gpt3/stream" if stream else "/chat/gpt3")
+    queue = asyncio.Queue()
+    for i in range(total):
+        queue.put_nowait(i)
+
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(limits=limits, timeout=60.0) as http:
+        async def worker():
+            while True:
+                try:
+                    index = queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    return
+                # 요청마다 내용을 달리해 응답 캐시와 중복 호출 병합을 타지 않게 한다
+                message = [{"role": "user", "content": f"벤치마크 요청 {tag}{index}"}]
+                started = time.perf_counter()
+                try:
+                    async with http.stream("POST", endpoint, json={**payload, "message": message}) as response:
+                        async for _ in response.aiter_bytes():
+                            pass
+                    statuses[response.status_code] += 1
+                    if response.status_code == 200:
+                        latencies.append(time.perf_counter() - started)
+                except httpx.HTTPError as e:
+                    statuses[type(e).__name__] += 1
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+
+    return {
+        "requests": total,
+        "concurrency": concurrency,
+        "elapsed_s": elapsed,
+        "throughput_rps": len(latencies) / elapsed if elapsed else 0.0,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "statuses": dict(statuses),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=100)
+    parser.add_argument("--model", default="gpt-3.5-turbo")
+    parser.add_argument("--stream", action="store_true")
+    parser.add_argument("--upstream-latency", type=float, default=0.2)
+    parser.add_argument("--upstream-tps", type=float, default=200)
+    args = parser.parse_args()
+
+    upstream = start_server("benchmarks.fake_upstream:app", UPSTREAM_PORT, {
+        "FAKE_UPSTREAM_LATENCY": str(args.upstream_latency),
+        "FAKE_UPSTREAM_TPS": str(args.upstream_tps),
+    })
+    gateway = start_server("api.chat_api:app", GATEWAY_PORT, {
+        "OPENAI_API_KEY": "fake",
+        "OPENAI_BASE_URL": f"http://127.0.0.1:{UPSTREAM_PORT}/v1",
+    })
+    try:
+        wait_until_ready(f"http://127.0.0.1:{UPSTREAM_PORT}/docs")
+        wait_until_ready(f"http://127.0.0.1:{GATEWAY_PORT}/docs")
+        result = asyncio.run(run_load(
+            f"http://127.0.0.1:{GATEWAY_PORT}", args.requests, args.concurrency, args.stream, args.model
+        ))
+    finally:
+        gateway.terminate()
+        upstream.terminate()
+        gateway.wait()
+        upstream.wait()
+
+    for key, value in result.items():
+        print(f"{key:>15}: {value:.2f}" if isinstance(value, float) else f"{key:>15}: {value}")
+
+
+if __name__ == "__main__":
+    main()
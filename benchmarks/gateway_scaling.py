@@ -0,0 +1,139 @@
+"""게이트웨이 워커 수에 따른 처리량 벤치마크.
+
+가짜 업스트림을 띄우고, 워커 수를 바꿔 가며 `python -m api.chat_api` 를 다시 띄운 뒤
+여러 클라이언트 프로세스로 같은 부하를 흘려 처리량과 p50/p99 지연을 비교한다.
+워커가 나눠 쓰는 상태 저장소는 --state 로 고른다(redis 이면서 --redis-url 이 없으면
+benchmarks.resp_server 를 대신 띄운다).
+
+    python -m benchmarks.gateway_scaling --workers 1 2 4 --state sqlite --requests 4000 --concurrency 256
+"""
+import argparse
+import asyncio
+import os
+import subprocess
+import sys
+import tempfile
+from collections import Counter
+from multiprocessing import Pool
+
+from benchmarks.gateway_load import run_load, wait_until_ready
+
+UPSTREAM_PORT = 9100
+GATEWAY_PORT = 8100
+RESP_PORT = 6390
+
+
+def _client(job: tuple) -> dict:
+    url, total, concurrency, stream, model, tag = job
+    return asyncio.run(run_load(url, total, concurrency, stream, model, tag))
+
+
+def run_clients(clients: int, total: int, concurrency: int, stream: bool, model: str, round_tag: str) -> dict:
+    # 한 프로세스의 이벤트 루프가 병목이 되지 않도록 클라이언트도 여러 프로세스로 나눈다
+    url = f"http://127.0.0.1:{GATEWAY_PORT}"
+    jobs = [
+        (url, total // clients, max(1, concurrency // clients), stream, model, f"{round_tag}-{client}-")
+        for client in range(clients)
+    ]
+    with Pool(clients) as pool:
+        results = pool.map(_client, jobs)
+
+    elapsed = max(result["elapsed_s"] for result in results)
+    statuses = Counter()
+    for result in results:
+        statuses.update(result["statuses"])
+    # 클라이언트별 분위수를 요청 수로 가중 평균한다(전체 지연 목록은 넘기지 않는다)
+    weights = [result["throughput_rps"] * result["elapsed_s"] for result in results]
+    total_ok = sum(weights) or 1
+    return {
+        "throughput_rps": sum(weights) / elapsed if elapsed else 0.0,
+        "p50_ms": sum(result["p50_ms"] * weight for result, weight in zip(results, weights)) / total_ok,
+        "p99_ms": max(result["p99_ms"] for result in results),
+        "statuses": dict(statuses),
+    }
+
+
+def start_gateway(workers: int, state_url: str, args) -> subprocess.Popen:
+    return subprocess.Popen([sys.executable, "-m", "api.chat_api"], env={
+        **os.environ,
+        "OPENAI_API_KEY": "fake",
+        "OPENAI_BASE_URL": f"http://127.0.0.1:{UPSTREAM_PORT}/v1",
+        "CHAT_API_HOST": "127.0.0.1",
+        "CHAT_API_PORT": str(GATEWAY_PORT),
+        "CHAT_API_WORKERS": str(workers),
+        "CHAT_STATE_BACKEND": state_url,
+        # 처리량을 재는 것이므로 모델 동시 호출 상한에 걸리지 않게 넉넉히 둔다
+        "CHAT_MAX_CONCURRENCY_PER_MODEL": str(args.max_concurrency),
+        "CHAT_MAX_QUEUE_PER_MODEL": str(args.concurrency),
+        "LOG_LEVEL": "WARNING",
+    })
+
+
+def stop(process: subprocess.Popen):
+    process.terminate()
+    process.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--state", choices=["memory", "sqlite", "redis"], default="sqlite")
+    parser.add_argument("--redis-url", default=None)
+    parser.add_argument("--requests", type=int, default=4000)
+    parser.add_argument("--concurrency", type=int, default=256)
+    parser.add_argument("--clients", type=int, default=4)
+    parser.add_argument("--max-concurrency", type=int, default=1024)
+    parser.add_argument("--model", default="gpt-3.5-turbo")
+    parser.add_argument("--stream", action="store_true")
+    parser.add_argument("--upstream-workers", type=int, default=4)
+    parser.add_argument("--upstream-latency", type=float, default=0.05)
+    parser.add_argument("--upstream-tps", type=float, default=1000)
+    args = parser.parse_args()
+
+    upstream = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "benchmarks.fake_upstream:app", "--port", str(UPSTREAM_PORT),
+         "--workers", str(args.upstream_workers), "--log-level", "warning"],
+        env={**os.environ, "FAKE_UPSTREAM_LATENCY": str(args.upstream_latency),
+             "FAKE_UPSTREAM_TPS": str(args.upstream_tps)},
+    )
+    resp_server = None
+    if args.state == "redis" and args.redis_url is None:
+        resp_server = subprocess.Popen([sys.executable, "-m", "benchmarks.resp_server", "--port", str(RESP_PORT)])
+    state_dir = tempfile.mkdtemp()
+
+    rows = []
+    try:
+        wait_until_ready(f"http://127.0.0.1:{UPSTREAM_PORT}/docs")
+        for workers in args.workers:
+            state_url = {
+                "memory": "memory",
+                "sqlite": f"sqlite:///{os.path.join(state_dir, f'state-{workers}.db')}",
+                "redis": args.redis_url or f"redis://127.0.0.1:{RESP_PORT}/0",
+            }[args.state]
+            gateway = start_gateway(workers, state_url, args)
+            try:
+                wait_until_ready(f"http://127.0.0.1:{GATEWAY_PORT}/docs", timeout=30.0)
+                # 워커가 모두 뜨고 연결 풀이 데워지도록 짧게 한 번 흘려 둔다
+                run_clients(args.clients, args.clients * 20, args.clients * 4, args.stream, args.model,
+                            f"warmup{workers}")
+                result = run_clients(args.clients, args.requests, args.concurrency, args.stream, args.model,
+                                     f"w{workers}")
+            finally:
+                stop(gateway)
+            rows.append((workers, result))
+    finally:
+        stop(upstream)
+        if resp_server is not None:
+            stop(resp_server)
+
+    base_workers, base = rows[0][0], rows[0][1]["throughput_rps"] or 1.0
+    print(f"state={args.state} requests={args.requests} concurrency={args.concurrency} cpus={os.cpu_count()}")
+    print(f"{'workers':>8} {'rps':>9} {'p50_ms':>8} {'p99_ms':>8} {'speedup':>8} {'eff':>6}  statuses")
+    for workers, result in rows:
+        speedup = result["throughput_rps"] / base
+        print(f"{workers:>8} {result['throughput_rps']:>9.1f} {result['p50_ms']:>8.1f} {result['p99_ms']:>8.1f} "
+              f"{speedup:>8.2f} {speedup * base_workers / workers:>6.2f}  {result['statuses']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,334 @@
+"""대화 트레이스 재생 벤치마크.
+
+가짜 업스트림(benchmarks.fake_upstream)과 게이트웨이를 로컬에 띄우고, 대화 트레이스를 세션마다
+UI 와 같은 턴 처리(chat_turn.run_turn → save_turn)로 재생한다.
+세션은 Streamlit 처럼 스레드 하나가 하나씩 맡는다. 결과는 JSON 으로 내보내고, --baseline 에
+이전 결과를 주면 주요 지표가 얼마나 바뀌었는지도 함께 보여 준다.
+
+트레이스는 JSONL 파일이거나 합성 대화다. 파일의 한 줄은 대화 하나이고, "turns"(사용자 메세지 목록)나
+batch_runner 입력처럼 "message" 를 가진다. "message" 에서는 사용자 메세지만 차례로 보낸다.
+"session" 필드가 같은 줄은 한 대화로 이어 붙인다.
+
+    python -m benchmarks.replay --sessions 50 --turns 20 --concurrency 8 --output replay.json
+    python -m benchmarks.replay --trace requests.jsonl --error-rate 0.05 --baseline replay.json
+"""
+import argparse
+import datetime
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional
+
+import httpx
+import requests
+
+from benchmarks.fts_search import make_sentence, make_vocabulary
+from benchmarks.gateway_load import percentile, start_server, wait_until_ready
+from chat_client import ChatClient, DeltaSession
+from chat_turn import GatewaySummarizer, run_turn, save_turn
+from database.setup_chat_db import ChatDatabase
+
+UPSTREAM_PORT = 9100
+GATEWAY_PORT = 8100
+# --baseline 과 비교할 지표. 값이 클수록 나쁜 것은 True
+COMPARED_METRICS = OrderedDict([
+    ("throughput_turns_per_s", False),
+    ("latency_ms.p50", True),
+    ("latency_ms.p99", True),
+    ("ttft_ms.p50", True),
+    ("db_write_ms.p99", True),
+    ("request_bytes_per_turn", True),
+    ("db.bytes_per_turn", True),
+    ("memory.client_bytes_per_session", True),
+    ("memory.gateway_rss_bytes_per_session", True),
+])
+
+
+def load_traces(path: str) -> List[List[str]]:
+    conversations = OrderedDict()
+    with open(path, encoding="utf-8") as f:
+        for line_no, line in enumerate(f):
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            turns = record.get("turns") or [
+                message["content"] for message in record.get("message", []) if message.get("role") == "user"
+            ]
+            conversations.setdefault(record.get("session", line_no), []).extend(turns)
+    traces = [turns for turns in conversations.values() if turns]
+    if not traces:
+        # 형식이 다른 파일을 주면 0 턴을 재생하고 빈 결과를 내보내므로 여기서 멈춘다
+        raise ValueError(f"{path} has no conversations; each line needs \"turns\" or user \"message\" entries")
+    return traces
+
+
+def synthetic_traces(sessions: int, turns: int, rng: random.Random) -> List[List[str]]:
+    vocabulary = make_vocabulary(2000, rng)
+    cum_weights = list(range(1, len(vocabulary) + 1))
+    return [
+        [make_sentence(vocabulary, cum_weights, rng, rng.randint(4, 20)) for _ in range(turns)]
+        for _ in range(sessions)
+    ]
+
+
+def deep_sizeof(obj, seen: Optional[set] = None) -> int:
+    # 여러 곳에서 같이 가리키는 문자열(세션 메세지와 델타 세션의 참조)은 한 번만 센다
+    seen = set() if seen is None else seen
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deep_sizeof(key, seen) + deep_sizeof(value, seen) for key, value in obj.items())
+    elif isinstance(obj, (list, tuple, set)):
+        size += sum(deep_sizeof(item, seen) for item in obj)
+    elif hasattr(obj, "__dict__"):
+        size += deep_sizeof(vars(obj), seen)
+    return size
+
+
+def rss_bytes(pid: int) -> Optional[int]:
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        return None
+    return None
+
+
+def db_bytes(db_file: str) -> int:
+    return sum(os.path.getsize(db_file + suffix) for suffix in ("", "-wal") if os.path.exists(db_file + suffix))
+
+
+class MeteredChatClient(ChatClient):
+    """게이트웨이로 보낸 요청 본문 바이트를 센다."""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.bytes_sent = 0
+        self._lock = threading.Lock()
+        post = self.session.post
+
+        def metered_post(url, data=None, **post_kwargs):
+            with self._lock:
+                self.bytes_sent += len(data or b"")
+            return post(url, data=data, **post_kwargs)
+
+        self.session.post = metered_post
+
+
+class ReplaySession:
+    """ChatBotApp 이 방 하나에서 하는 일을 Streamlit 없이 그대로 한다."""
+
+    def __init__(self, index: int, chat_db: ChatDatabase, chat_client: ChatClient, args):
+        self.chat_db = chat_db
+        self.chat_client = chat_client
+        self.args = args
+        self.user = chat_db.user_login(f"replay{index}")
+        self.room_name = f"trace{index}"
+        self.url = f"http://127.0.0.1:{GATEWAY_PORT}/chat/gpt3"
+        # chat_app 의 st.session_state[user]['chat_rooms'][room] 과 같은 모양
+        self.room = {
+            'messages': [], 'user_message': [], 'chatbot_message': [], 'model_name': [], 'total_tokens': [],
+            'cost': [], 'saved_cost': [], 'latency_ms': [], 'summary': {}, 'total_cost': 0.0,
+        }
+        if not args.no_delta:
+            self.room['delta'] = DeltaSession()
+
+    def turn(self, text: str) -> dict:
+        summarizer = GatewaySummarizer(self.chat_client, self.url, self.args.model) if self.args.summarize else None
+        try:
+            turn = run_turn(self.chat_client, self.url, self.room, text, self.args.model,
+                            max_tokens=self.args.max_tokens, summarizer=summarizer)
+        except requests.RequestException as e:
+            # UI 처럼 답을 받지 못한 턴은 남기지 않는다
+            return {"error": str(getattr(e, "status_code", None) or type(e).__name__)}
+
+        db_started = time.perf_counter()
+        save_turn(self.chat_db, self.room_name, self.user, turn)
+        return {"latency": turn['latency'], "ttft": turn['ttft'], "db_write": time.perf_counter() - db_started}
+
+
+def replay(traces: List[List[str]], chat_db: ChatDatabase, chat_client: ChatClient, args) -> dict:
+    latencies, ttfts, db_writes = [], [], []
+    errors = Counter()
+    lock = threading.Lock()
+    sessions = []
+
+    def run_session(index: int, turns: List[str]):
+        session = ReplaySession(index, chat_db, chat_client, args)
+        with lock:
+            sessions.append(session)
+        for text in turns:
+            result = session.turn(text)
+            with lock:
+                if "error" in result:
+                    errors[result["error"]] += 1
+                else:
+                    latencies.append(result["latency"])
+                    db_writes.append(result["db_write"])
+                    if result["ttft"] is not None:
+                        ttfts.append(result["ttft"])
+            if args.think_time:
+                time.sleep(random.uniform(0, 2 * args.think_time))
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(args.concurrency) as pool:
+        for future in [pool.submit(run_session, index, turns) for index, turns in enumerate(traces)]:
+            future.result()
+    elapsed = time.perf_counter() - started
+
+    def summary(values: list) -> dict:
+        return {f"p{p}": percentile(values, p) * 1000 for p in (50, 90, 99)} | {"max": max(values, default=0) * 1000}
+
+    return {
+        "elapsed_s": elapsed,
+        "turns": len(latencies),
+        "throughput_turns_per_s": len(latencies) / elapsed if elapsed else 0.0,
+        "errors": dict(errors),
+        "latency_ms": summary(latencies),
+        "ttft_ms": summary(ttfts),
+        "db_write_ms": summary(db_writes),
+        "client_state_bytes": sum(deep_sizeof(session.room) for session in sessions),
+    }
+
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def lookup(result: dict, path: str):
+    for part in path.split("."):
+        if not isinstance(result, dict) or part not in result:
+            return None
+        result = result[part]
+    return result
+
+
+def compare(result: dict, baseline: dict):
+    print(f"{'metric':>38} {'baseline':>12} {'current':>12} {'change':>8}", file=sys.stderr)
+    for path, lower_is_better in COMPARED_METRICS.items():
+        old, new = lookup(baseline, path), lookup(result, path)
+        if not old or new is None:
+            continue
+        change = (new - old) / old
+        worse = change > 0 if lower_is_better else change < 0
+        flag = "  worse" if worse and abs(change) >= 0.05 else ""
+        print(f"{path:>38} {old:>12.2f} {new:>12.2f} {change:>+8.1%}{flag}", file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--trace", help="JSONL 트레이스. 없으면 합성 대화를 만든다")
+    parser.add_argument("--sessions", type=int, default=50)
+    parser.add_argument("--turns", type=int, default=20)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--think-time", type=float, default=0.0, help="턴 사이 평균 대기 시간(초)")
+    parser.add_argument("--model", default="gpt-3.5-turbo")
+    parser.add_argument("--max-tokens", type=int, default=64)
+    parser.add_argument("--summarize", action="store_true", help="UI 처럼 예산을 넘는 히스토리를 게이트웨이로 요약한다")
+    parser.add_argument("--no-delta", action="store_true", help="델타 프로토콜 없이 매번 전체 컨텍스트를 보낸다")
+    parser.add_argument("--db", help="재생 결과를 쓸 대화 DB (기본값은 임시 파일)")
+    parser.add_argument("--upstream-latency", type=float, default=0.05)
+    parser.add_argument("--upstream-tps", type=float, default=500)
+    parser.add_argument("--completion-tokens", type=int, default=32)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--disconnect-rate", type=float, default=0.0)
+    parser.add_argument("--gateway-env", nargs="*", default=[], metavar="NAME=VALUE",
+                        help="게이트웨이에 넘길 환경 변수 (예: CHAT_STATE_BACKEND=sqlite:///state.db)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="결과 JSON 파일 (없으면 표준 출력)")
+    parser.add_argument("--baseline", help="비교할 이전 결과 JSON")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    random.seed(args.seed)
+    traces = load_traces(args.trace) if args.trace else synthetic_traces(args.sessions, args.turns, rng)
+    db_file = args.db or os.path.join(tempfile.mkdtemp(), "replay.db")
+
+    upstream = start_server("benchmarks.fake_upstream:app", UPSTREAM_PORT, {
+        "FAKE_UPSTREAM_LATENCY": str(args.upstream_latency),
+        "FAKE_UPSTREAM_TPS": str(args.upstream_tps),
+        "FAKE_UPSTREAM_COMPLETION_TOKENS": str(args.completion_tokens),
+        "FAKE_UPSTREAM_ERROR_RATE": str(args.error_rate),
+        "FAKE_UPSTREAM_DISCONNECT_RATE": str(args.disconnect_rate),
+        "FAKE_UPSTREAM_SEED": str(args.seed),
+    })
+    gateway = start_server("api.chat_api:app", GATEWAY_PORT, {
+        "OPENAI_API_KEY": "fake",
+        "OPENAI_BASE_URL": f"http://127.0.0.1:{UPSTREAM_PORT}/v1",
+        "LOG_LEVEL": "WARNING",
+        **dict(item.split("=", 1) for item in args.gateway_env),
+    })
+    gateway_url = f"http://127.0.0.1:{GATEWAY_PORT}"
+    chat_db = ChatDatabase(db_file)
+    chat_client = MeteredChatClient(pool_maxsize=args.concurrency)
+    try:
+        wait_until_ready(f"http://127.0.0.1:{UPSTREAM_PORT}/docs")
+        wait_until_ready(f"{gateway_url}/docs")
+        # 첫 요청에서 생기는 import, 연결 풀, 토크나이저 메모리는 세션 몫에서 뺀다
+        httpx.post(f"{gateway_url}/chat/gpt3", timeout=30.0, json={
+            "model": args.model, "message": [{"role": "user", "content": "warmup"}], "max_tokens": 1,
+        })
+        db_before = db_bytes(db_file)
+        rss_before = rss_bytes(gateway.pid)
+        result = replay(traces, chat_db, chat_client, args)
+        rss_after = rss_bytes(gateway.pid)
+        gateway_stats = {
+            name: httpx.get(f"{gateway_url}/stats/{name}", timeout=5.0).json()
+            for name in ("sessions", "cache", "coalescing", "scheduler")
+        }
+    finally:
+        chat_client.close()
+        chat_db.close()
+        gateway.terminate()
+        upstream.terminate()
+        gateway.wait()
+        upstream.wait()
+
+    sessions = len(traces)
+    turns = result["turns"] or 1
+    client_state_bytes = result.pop("client_state_bytes")
+    db_after = db_bytes(db_file)
+    result = {
+        "revision": git_revision(),
+        "created_at": datetime.datetime.now().isoformat(timespec="seconds"),
+        "config": {name: value for name, value in vars(args).items() if name not in ("output", "baseline")},
+        "sessions": sessions,
+        **result,
+        "request_bytes_per_turn": chat_client.bytes_sent / turns,
+        "db": {"bytes_before": db_before, "bytes_after": db_after, "bytes_per_turn": (db_after - db_before) / turns},
+        "memory": {
+            "client_bytes_per_session": client_state_bytes / sessions if sessions else 0,
+            "gateway_rss_bytes_per_session":
+                (rss_after - rss_before) / sessions if sessions and rss_before and rss_after else None,
+        },
+        "gateway": gateway_stats,
+    }
+
+    output = json.dumps(result, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            compare(result, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
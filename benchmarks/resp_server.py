@@ -0,0 +1,104 @@
+"""Redis 대신 띄우는 RESP 프로토콜 상태 서버.
+
+게이트웨이의 RedisStateBackend 가 쓰는 명령(PING, SELECT, GET, MGET, SET NX/PX/EX, DEL)만 구현한다.
+Redis 가 없는 개발 환경에서 여러 워커 구성을 돌려 볼 때 쓴다.
+
+    python -m benchmarks.resp_server --port 6390
+    CHAT_STATE_BACKEND=redis://127.0.0.1:6390 CHAT_API_WORKERS=4 python -m api.chat_api
+"""
+import argparse
+import asyncio
+import time
+
+
+class Store:
+    def __init__(self):
+        self.entries = {}
+
+    def get(self, key: bytes):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at is not None and expires_at < time.monotonic():
+            del self.entries[key]
+            return None
+        return value
+
+    def set(self, args: list) -> bytes:
+        key, value, options = args[0], args[1], [arg.upper() for arg in args[2:]]
+        expires_at = None
+        for name, scale in ((b"PX", 1000), (b"EX", 1)):
+            if name in options:
+                expires_at = time.monotonic() + int(options[options.index(name) + 1]) / scale
+        if b"NX" in options and self.get(key) is not None:
+            return b"$-1\r\n"
+        self.entries[key] = (expires_at, value)
+        return b"+OK\r\n"
+
+
+def bulk(value) -> bytes:
+    if value is None:
+        return b"$-1\r\n"
+    return b"$%d\r\n%s\r\n" % (len(value), value)
+
+
+def handle(store: Store, command: list) -> bytes:
+    name, args = command[0].upper(), command[1:]
+    if name == b"PING":
+        return b"+PONG\r\n"
+    if name == b"SELECT":
+        return b"+OK\r\n"
+    if name == b"GET":
+        return bulk(store.get(args[0]))
+    if name == b"MGET":
+        return b"*%d\r\n" % len(args) + b"".join(bulk(store.get(key)) for key in args)
+    if name == b"SET":
+        return store.set(args)
+    if name == b"DEL":
+        return b":%d\r\n" % sum(store.entries.pop(key, None) is not None for key in args)
+    return b"-ERR unknown command '%s'\r\n" % name
+
+
+async def read_command(reader: asyncio.StreamReader) -> list:
+    header = await reader.readline()
+    if not header:
+        raise EOFError
+    if not header.startswith(b"*"):
+        # redis-cli 처럼 한 줄로 보내는 inline 명령
+        return header.split()
+    command = []
+    for _ in range(int(header[1:])):
+        length = int((await reader.readline())[1:])
+        command.append((await reader.readexactly(length + 2))[:-2])
+    return command
+
+
+async def serve(host: str, port: int):
+    store = Store()
+
+    async def on_client(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                writer.write(handle(store, await read_command(reader)))
+                await writer.drain()
+        except (EOFError, ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(on_client, host, port)
+    async with server:
+        await server.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=6390)
+    args = parser.parse_args()
+    asyncio.run(serve(args.host, args.port))
+
+
+if __name__ == "__main__":
+    main()
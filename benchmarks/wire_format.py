@@ -0,0 +1,106 @@
+"""게이트웨이 요청 본문 형식 벤치마크.
+
+10, 100, 1000 턴 히스토리로 ChatRequest 를 만들어 형식마다 본문 바이트 수와
+요청 하나를 풀고 검증하는 데 걸린 시간(중앙값)을 잰다.
+
+    json      requests 의 json= 과 FastAPI 기본 경로 (json.dumps / json.loads + 모델 검증)
+    orjson    api.wire 의 빠른 경로 (orjson.dumps / orjson.loads + 모델 검증)
+    msgpack   Content-Type: application/msgpack (msgpack 이 설치되어 있을 때만)
+    delta     델타 프로토콜. 새 사용자 메세지만 보내고 게이트웨이가 저장해 둔 히스토리를 붙인다
+
+네트워크와 업스트림 호출은 빼고 본문 처리만 잰다.
+
+    python -m benchmarks.wire_format --turns 10 100 1000
+"""
+import argparse
+import asyncio
+import json
+import random
+import statistics
+import time
+
+from api.chat_requeset_schema import ChatRequest
+from api.sessions import SessionStore
+from api.wire import MSGPACK_TYPE, dumps, loads, msgpack
+from benchmarks.fts_search import make_sentence, make_vocabulary
+from chat_client import encode_payload
+
+
+def make_history(turns: int, rng: random.Random) -> list:
+    vocabulary = make_vocabulary(2000, rng)
+    cum_weights = list(range(1, len(vocabulary) + 1))
+    messages = [{"role": "system", "content": "You are a helpful assistant"}]
+    for _ in range(turns):
+        messages.append({"role": "user", "content": make_sentence(vocabulary, cum_weights, rng, rng.randint(5, 20))})
+        messages.append({"role": "assistant", "content": make_sentence(vocabulary, cum_weights, rng, rng.randint(20, 80))})
+    return messages
+
+
+def measure(parse, repeats: int) -> float:
+    samples = []
+    for _ in range(repeats):
+        started = time.perf_counter()
+        parse()
+        samples.append(time.perf_counter() - started)
+    return statistics.median(samples)
+
+
+def measure_async(parse, repeats: int) -> float:
+    async def timed():
+        samples = []
+        for _ in range(repeats):
+            started = time.perf_counter()
+            await parse()
+            samples.append(time.perf_counter() - started)
+        return statistics.median(samples)
+
+    return asyncio.run(timed())
+
+
+def run(turns: int, repeats: int, rng: random.Random) -> list:
+    history = make_history(turns, rng)
+    question = {"role": "user", "content": "오늘 대화 내용을 정리해 주세요"}
+    payload = {"model": "gpt-3.5-turbo", "message": history + [question], "max_tokens": 256, "temperature": 0.2}
+
+    rows = []
+    body = json.dumps(payload).encode("utf-8")
+    rows.append(("json", len(body), measure(lambda: ChatRequest.model_validate(json.loads(body)), repeats)))
+
+    body, _ = encode_payload(payload)
+    rows.append(("orjson", len(body), measure(lambda: ChatRequest.model_validate(loads(body)), repeats)))
+
+    if msgpack is not None:
+        body, _ = encode_payload(payload, "msgpack")
+        rows.append(("msgpack", len(body),
+                     measure(lambda: ChatRequest.model_validate(loads(body, MSGPACK_TYPE)), repeats)))
+
+    # 앞 턴까지의 히스토리는 게이트웨이가 이전 응답을 끝낼 때 저장해 두었다
+    sessions = SessionStore(max_entries=16, ttl=3600)
+    previous = ChatRequest.model_validate({**payload, "message": history[:-1], "session_id": "bench"})
+    turn = asyncio.run(sessions.commit(previous, history[-1]["content"]))
+    delta = {**payload, "message": [question], "session_id": "bench", "last_turn_id": turn}
+    body = dumps(delta)
+    rows.append(("delta", len(body),
+                 measure_async(lambda: sessions.resolve(ChatRequest.model_validate(loads(body))), repeats)))
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--turns", type=int, nargs="+", default=[10, 100, 1000])
+    parser.add_argument("--repeats", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    rng = random.Random(args.seed)
+
+    print(f"{'turns':>6} {'format':>8} {'bytes':>10} {'parse_us':>10} {'bytes_x':>8} {'parse_x':>8}")
+    for turns in args.turns:
+        rows = run(turns, args.repeats, rng)
+        base_bytes, base_time = rows[0][1], rows[0][2]
+        for name, size, elapsed in rows:
+            print(f"{turns:>6} {name:>8} {size:>10} {elapsed * 1e6:>10.1f} "
+                  f"{base_bytes / size:>8.2f} {base_time / elapsed:>8.2f}")
+
+
+if __name__ == "__main__":
+    main()
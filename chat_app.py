@@ -1,31 +1,65 @@
-import json
-import time
-from typing import List
+import atexit
+import os
 
-import numpy as np
 import requests
-from openai import OpenAI
 import streamlit as st
 
-from database.setup_chat_db import ChatDatabase
+from chat_client import ChatClient, DeltaSession, GatewayError
+from chat_turn import GatewaySummarizer, run_turn, save_turn
+from database.setup_chat_db import MESSAGE_PAGE_SIZE, SEARCH_PAGE_SIZE, ChatDatabase
+from observability.logs import get_logger, log_event
+from observability.metrics import serve_metrics, span
 
+DATABASE_FILE = 'chatbot.db'
 BASE_URL ='http://localhost:8000'
 CHATGPT_3_API_URL = BASE_URL + '/chat/gpt3'
 CHATGPT_4_API_URL = BASE_URL + '/chat/gpt4'
+LOCAL_MODEL_API_URL = BASE_URL + '/chat/local'
+
+SUMMARY_MODEL = "gpt-3.5-turbo"
+HISTORY_PAGE_TURNS = 20  # 한 번에 화면에 더 보여 주는 대화 턴 수
+WORKING_SET_ROOMS = 3  # 메세지를 세션에 들고 있는 최근 방 수. 나머지 방은 다시 열 때 DB 에서 읽는다
+UI_METRICS_PORT = int(os.environ.get("CHAT_UI_METRICS_PORT", 0))  # 0 이면 메트릭 서버를 띄우지 않는다
+
+logger = get_logger("chat_app")
+
+
+@st.cache_resource
+def get_chat_database(db_file: str) -> ChatDatabase:
+    # 엔진 생성과 스키마 확인은 프로세스당 한 번만 하고, 모든 세션과 rerun 이 같은 커넥션 풀을 쓴다
+    chat_bot_db = ChatDatabase(db_file)
+    atexit.register(chat_bot_db.close)
+    return chat_bot_db
+
+
+@st.cache_resource
+def start_metrics_server(port: int):
+    # Streamlit 은 HTTP 라우트를 따로 둘 수 없으므로 UI 쪽 메트릭은 별도 포트로 내보낸다
+    server = serve_metrics(port)
+    atexit.register(server.shutdown)
+    return server
+
+
+@st.cache_resource
+def get_chat_client() -> ChatClient:
+    # 세션과 rerun 을 가리지 않고 게이트웨이로 가는 keep-alive 커넥션을 함께 쓴다
+    chat_client = ChatClient()
+    atexit.register(chat_client.close)
+    return chat_client
 
-SYSTEM_MSG = "You are a helpful assistant"
 
 class ChatBotApp:
     def __init__(self):
-        self.client = OpenAI()
+        if UI_METRICS_PORT:
+            start_metrics_server(UI_METRICS_PORT)
         self.room_name = None
         self.model_name = None
         self.temperature = 0.2
         self.max_tokens = 256
         self.counter_placeholder = None
 
-        database = 'chatbot.db'
-        self.chat_bot_db = ChatDatabase(database)
+        self.chat_bot_db = get_chat_database(DATABASE_FILE)
+        self.chat_client = get_chat_client()
         self.current_user = self.chat_bot_db.user_login('default')
 
         self.initialize_session_state()
@@ -40,22 +74,98 @@ class ChatBotApp:
             st.session_state[user_name] = {}
             st.session_state[user_name]['chat_rooms'] = {}
 
-        rooms, chat_rooms_data, users_data = self.chat_bot_db.load_chat_rooms(user_id)
-        if chat_rooms_data:
-            for room in rooms:
+        # DB 에서 방 목록을 읽는 건 세션마다 한 번뿐이다. 이후 변경은 세션 상태에 직접 반영한다
+        if st.session_state[user_name].get('hydrated'):
+            return
+        st.session_state[user_name]['hydrated'] = True
+
+        # 방 목록만 가져오고, 이미 세션에 있는 방(불러온 메세지 포함)은 덮어쓰지 않는다
+        rooms, chat_rooms_data = self.chat_bot_db.load_chat_rooms(user_id)
+        for room in rooms:
+            if room not in st.session_state[user_name]['chat_rooms']:
                 st.session_state[user_name]['chat_rooms'][room] = chat_rooms_data.get(room)
-                st.session_state['users'] = users_data
 
     def initialize_chat_room_session_state(self, room_name):
         user_name = self.current_user.name
         st.session_state[user_name]['chat_rooms'][room_name] = {}
+        st.session_state[user_name]['chat_rooms'][room_name]['room_id'] = None
+        st.session_state[user_name]['chat_rooms'][room_name]['message_count'] = 0
+        st.session_state[user_name]['chat_rooms'][room_name]['loaded'] = True
+        st.session_state[user_name]['chat_rooms'][room_name]['oldest_message_id'] = None
+        st.session_state[user_name]['chat_rooms'][room_name]['archive_summary'] = None
+        st.session_state[user_name]['chat_rooms'][room_name]['archive_loaded'] = False
         st.session_state[user_name]['chat_rooms'][room_name]['chatbot_message'] = []
         st.session_state[user_name]['chat_rooms'][room_name]['user_message'] = []
         st.session_state[user_name]['chat_rooms'][room_name]['messages'] = []
         st.session_state[user_name]['chat_rooms'][room_name]['model_name'] = []
         st.session_state[user_name]['chat_rooms'][room_name]['cost'] = []
+        st.session_state[user_name]['chat_rooms'][room_name]['saved_cost'] = []
+        st.session_state[user_name]['chat_rooms'][room_name]['latency_ms'] = []
         st.session_state[user_name]['chat_rooms'][room_name]['total_tokens'] = []
         st.session_state[user_name]['chat_rooms'][room_name]['total_cost'] = 0.0
+        st.session_state[user_name]['chat_rooms'][room_name]['visible_turns'] = HISTORY_PAGE_TURNS
+
+    def load_room_messages(self, room_name):
+        # 선택한 방의 메세지를 한 페이지씩, 가장 오래된 것 앞쪽으로 이어 붙인다
+        user_name = self.current_user.name
+        room = st.session_state[user_name]['chat_rooms'][room_name]
+        room['loaded'] = True
+        if room['room_id'] is None:
+            return
+
+        page = self.chat_bot_db.load_messages(room['room_id'], before_id=room['oldest_message_id'])
+        if not page:
+            room['archive_loaded'] = True
+            return
+
+        room['oldest_message_id'] = page[0]['id']
+        room['user_message'][:0] = [message['user_message'] for message in page]
+        room['chatbot_message'][:0] = [message['chatbot_message'] for message in page]
+        room['model_name'][:0] = [message['model_name'] for message in page]
+        room['total_tokens'][:0] = [message['total_tokens'] for message in page]
+        room['cost'][:0] = [message['cost'] for message in page]
+        room['saved_cost'][:0] = [message['saved_cost'] or 0.0 for message in page]
+        room['latency_ms'][:0] = [message['latency_ms'] for message in page]
+        history = []
+        for message in page:
+            history.append({"role": "user", "content": message['user_message']})
+            history.append({"role": "assistant", "content": message['chatbot_message']})
+        room['messages'][:0] = history
+        # 앞쪽에 메세지가 붙으면 누적 요약의 기준 위치가 바뀌므로 다시 만든다
+        room['summary'] = {}
+        # 가장 오래된 보관 턴까지 세션에 들어와야 보관 요약을 뺀다. 페이지가 덜 찼으면 더 오래된 메세지가 없다
+        if len(page) < MESSAGE_PAGE_SIZE or len(room['user_message']) >= room['message_count']:
+            room['archive_loaded'] = True
+
+    def unload_room_messages(self, room):
+        # 합계와 방 요약은 남기고 메세지만 비운다. 다시 열면 load_room_messages 가 최근 페이지부터 읽는다
+        room['loaded'] = False
+        room['oldest_message_id'] = None
+        room['archive_loaded'] = False
+        room['summary'] = {}
+        room['visible_turns'] = HISTORY_PAGE_TURNS
+        # 델타 세션이 들고 있는 메세지 참조도 놓아야 메모리가 풀린다. 다음 턴은 전체를 보낸다
+        room.pop('delta', None)
+        for name in ('user_message', 'chatbot_message', 'messages', 'model_name', 'total_tokens', 'cost',
+                     'saved_cost', 'latency_ms'):
+            room[name] = []
+
+    def touch_room(self, room_name):
+        # 최근에 연 WORKING_SET_ROOMS 개 방만 메세지를 세션에 남긴다
+        user_name = self.current_user.name
+        chat_rooms = st.session_state[user_name]['chat_rooms']
+        recent_rooms = st.session_state[user_name].setdefault('recent_rooms', [])
+        if recent_rooms and recent_rooms[-1] == room_name:
+            return
+        if room_name in recent_rooms:
+            recent_rooms.remove(room_name)
+        recent_rooms.append(room_name)
+        for name in recent_rooms[:-WORKING_SET_ROOMS]:
+            room = chat_rooms.get(name)
+            # 아직 DB 에 저장된 적 없는 방은 다시 읽을 곳이 없으므로 그대로 둔다
+            if room and room['room_id'] is not None and room['loaded']:
+                self.unload_room_messages(room)
+        del recent_rooms[:-WORKING_SET_ROOMS]
 
     def setup_ui(self):
         # Setting page title and header
@@ -98,12 +208,10 @@ class ChatBotApp:
             )
 
             st.sidebar.markdown('<h4>Temperature</h4>', unsafe_allow_html=True)
-            temperature_range = np.round(np.arange(0, 2.1, 0.1), 1)
-            self.temperature = st.sidebar.select_slider('Choose a number', options=temperature_range, value=0.2)
+            self.temperature = st.sidebar.slider('Choose a number', min_value=0.0, max_value=2.0, value=0.2, step=0.1)
 
             st.sidebar.markdown('<h4>Maximum token length</h4>', unsafe_allow_html=True)
-            max_tokens_range = np.arange(1, 4097, 1)
-            self.max_tokens = int(st.sidebar.select_slider('Choose a number', options=max_tokens_range, value=256))
+            self.max_tokens = st.sidebar.slider('Choose a number', min_value=1, max_value=4096, value=256, step=1)
 
         def sidebar_chat_rooms_setup() -> bool:
             user_name = self.current_user.name
@@ -118,7 +226,7 @@ class ChatBotApp:
                 if st.form_submit_button("채팅방 생성"):
                     st.session_state['create_room_clicked'] = True
                     if room_name.strip() != '' and room_name not in st.session_state[user_name]['chat_rooms']:
-                        print("init new chat room")
+                        log_event(logger, "info", "room_created", room=room_name)
                         self.initialize_chat_room_session_state(room_name)
                         st.rerun()
                     else:
@@ -145,11 +253,38 @@ class ChatBotApp:
             if delete_button:
                 self.delete_session_state()
 
+        def sidebar_search_setup():
+            st.sidebar.markdown('<hr>', unsafe_allow_html=True)
+            st.sidebar.title('대화 검색')
+            query = st.sidebar.text_input("검색어를 입력하세요", key='search_query').strip()
+            if not query:
+                return
+
+            # 검색어가 바뀌면 첫 페이지부터, "더 보기"를 누르면 한 페이지씩 늘려서 보여준다
+            search = st.session_state.setdefault('search', {})
+            if search.get('query') != query:
+                search['query'] = query
+                search['limit'] = SEARCH_PAGE_SIZE
+            results = self.chat_bot_db.search_messages(self.current_user.id, query, limit=search['limit'] + 1)
+            if not results:
+                st.sidebar.write("검색 결과가 없습니다.")
+                return
+
+            for result in results[:search['limit']]:
+                st.sidebar.markdown(
+                    f"**{result['room_name']}** · {result['user_message']}\n\n> {result['chatbot_message']}"
+                )
+            if len(results) > search['limit']:
+                if st.sidebar.button("더 보기", key='search_more'):
+                    search['limit'] += SEARCH_PAGE_SIZE
+                    st.rerun()
+
         login_setting_setup()
         sidebar_chat_settings_setup()
         is_first: bool = sidebar_chat_rooms_setup()
         if is_first is False:
             sidebar_chat_usage_setup()
+        sidebar_search_setup()
 
         return is_first
 
@@ -159,6 +294,9 @@ class ChatBotApp:
         if room_name:
             self.chat_bot_db.delete_room_and_messages(room_name)
         del st.session_state[user_name]['chat_rooms'][room_name]
+        recent_rooms = st.session_state[user_name].get('recent_rooms', [])
+        if room_name in recent_rooms:
+            recent_rooms.remove(room_name)
         self.room_name = None
         st.rerun()
 
@@ -173,125 +311,114 @@ class ChatBotApp:
 
         if room_name:
             st.subheader(f"대화방: {room_name}")
+            self.touch_room(room_name)
+        if not st.session_state[user_name]['chat_rooms'][room_name]['loaded']:
+            self.load_room_messages(room_name)
         if st.session_state[user_name]['chat_rooms'][room_name]['chatbot_message']:
-            self.display_chat_history()
+            with span("ui_render", self.model_name):
+                self.display_chat_history()
         if user_message := st.chat_input(""):
-            if user_message:
-                self.handle_user_message(user_message)
-
             with st.chat_message('user'):
-                user_message = st.session_state[user_name]['chat_rooms'][room_name]["user_message"][-1]
                 st.markdown(user_message)
 
             with st.chat_message('assistant'):
                 message_placeholder = st.empty()
-                full_response = ""
-                for lines in st.session_state[user_name]['chat_rooms'][room_name]['chatbot_message'][-1].split('\n'):
-                    for chunk in lines.split():
-                        full_response += chunk + " "
-                        time.sleep(0.05)
-                        message_placeholder.markdown(full_response)
-                st.write(
-                    f"Model used: {st.session_state[user_name]['chat_rooms'][room_name]['model_name'][-1]} \t"
-                    f"Number of tokens: {st.session_state[user_name]['chat_rooms'][room_name]['total_tokens'][-1]} \t"
-                    f"Cost: ${st.session_state[user_name]['chat_rooms'][room_name]['cost'][-1]:.5f}"
-                )
+                if self.handle_user_message(user_message, message_placeholder):
+                    st.write(self.message_footer(-1))
 
-    def handle_user_message(self, user_message):
+    def handle_user_message(self, user_message, message_placeholder):
         room_name = self.room_name
         user_name = self.current_user.name
+        room = st.session_state[user_name]['chat_rooms'][room_name]
+        # 게이트웨이가 이미 가진 앞부분은 빼고 새 메세지만 보낸다
+        room.setdefault('delta', DeltaSession())
+
+        try:
+            turn = run_turn(
+                self.chat_client, self.get_model_url(), room, user_message,
+                model=self.model_name,
+                max_tokens=self.max_tokens,
+                temperature=self.temperature,
+                summarizer=GatewaySummarizer(self.chat_client, CHATGPT_3_API_URL, SUMMARY_MODEL),
+                on_delta=lambda text: message_placeholder.markdown(text + "▌")
+            )
+        except requests.RequestException as e:
+            # 답을 받지 못한 턴은 세션에도 DB 에도 남기지 않는다(run_turn 이 사용자 메세지를 되돌린다)
+            if isinstance(e, GatewayError) and e.status_code == 429:
+                wait = f" {e.retry_after:.0f}초 뒤에" if e.retry_after else " 잠시 뒤에"
+                message_placeholder.warning(f"요청이 많아 처리하지 못했습니다.{wait} 다시 보내 주세요.")
+            else:
+                message_placeholder.error(f"게이트웨이 요청에 실패했습니다: {e}")
+            log_event(logger, "warning", "turn_failed", model=self.model_name, error=str(e),
+                      status=getattr(e, "status_code", None))
+            return False
+        message_placeholder.markdown(turn['chatbot_message'])
 
-        chatbot_message, total_tokens, prompt_tokens, completion_tokens = self.generate_response(user_message)
-        st.session_state[user_name]['chat_rooms'][room_name]['user_message'].append(user_message)
-        st.session_state[user_name]['chat_rooms'][room_name]['chatbot_message'].append(chatbot_message)
-        st.session_state[user_name]['chat_rooms'][room_name]['total_tokens'].append(total_tokens)
-        st.session_state[user_name]['chat_rooms'][room_name]['model_name'].append(self.model_name)
-
-        cost = (total_tokens * 0.002 / 1000) if self.model_name == "gpt-3.5-turbo"\
-            else (prompt_tokens * 0.03 + completion_tokens * 0.06) / 1000
-        st.session_state[user_name]['chat_rooms'][room_name]['cost'].append(cost)
-        st.session_state[user_name]['chat_rooms'][room_name]['total_cost'] += cost
         self.update_total_cost()
-        messages_json = json.dumps(st.session_state[user_name]['chat_rooms'][room_name]['messages'])
-        # For Debug
-        print(st.session_state[user_name]['chat_rooms'][room_name]['chatbot_message'])
-        print(st.session_state[user_name]['chat_rooms'][room_name]['user_message'])
-        print(st.session_state[user_name]['chat_rooms'][room_name]['messages'])
-        print(st.session_state[user_name]['chat_rooms'][room_name]['model_name'])
-        print(st.session_state[user_name]['chat_rooms'][room_name]['total_tokens'])
-        print(st.session_state[user_name]['chat_rooms'][room_name]['cost'])
-        print(st.session_state[user_name]['chat_rooms'][room_name]['total_cost'])
-        print()
-
-        self.chat_bot_db.add_message(
-            room_name=room_name,
-            user_id=self.current_user.id,
-            user_name=user_name,
-            user_message=user_message,
-            chatbot_message=chatbot_message,
-            messages=messages_json,
-            model_name=self.model_name,
-            total_tokens=total_tokens,
-            cost=cost
-        )
-
-    def generate_response(self, prompt):
-        room_name = self.room_name
-        user_name = self.current_user.name
-
-        st.session_state[user_name]['chat_rooms'][room_name]['messages'].append({"role": "user", "content": prompt})
-
-        completion = self.request_chat_api(
+        log_event(
+            logger, "debug", "turn_completed",
+            room=room_name,
             model=self.model_name,
-            message=st.session_state[user_name]['chat_rooms'][room_name]['messages'], # 대화했던 모든 메세지가 함께 날아감
-            temperature=self.temperature,
-            max_tokens=self.max_tokens
+            turns=room['message_count'],
+            total_tokens=turn['total_tokens'],
+            cost=turn['cost'],
+            cache_hit=turn['cache_hit'],
+            latency_ms=turn['latency_ms']
         )
 
-        chatbot_message = completion.get('message', None)
-        total_tokens = completion.get('total_tokens', 0)
-        prompt_tokens = completion.get('prompt_tokens', 0)
-        completion_tokens = completion.get('completion_tokens', 0)
-
-        st.session_state[user_name]['chat_rooms'][room_name]['messages'].append({"role": "assistant", "content": chatbot_message})
-        return chatbot_message, total_tokens, prompt_tokens, completion_tokens
-
-    def request_chat_api(self, model: str, message: List[st.chat_message], max_tokens: int = 128, temperature: float = 0.2) -> str:
-        chat_api_url = self.get_model_url()
-
-        response = requests.post(
-            chat_api_url,
-            json={
-                "model": model,
-                "message": message,
-                "max_tokens": max_tokens,
-                "temperature": temperature,
-            }
-        )
-        response = response.json()
-        return response
+        with span("db_write", self.model_name):
+            room_id = save_turn(self.chat_bot_db, room_name, self.current_user, turn)
+        # 새로 만든 방은 첫 저장에서 ID 가 생긴다. 그래야 세션에서 비운 뒤에도 다시 읽을 수 있다
+        room['room_id'] = room_id
+        return True
+
     def get_model_url(self):
         # "gpt-3.5-turbo", "gpt-4", "beomi/KoAlpaca-Polyglot-12.8B", "beomi/LLaMA-2-ko-7b", "beomi/LLaMA-2-ko-13b"
         model_name = self.model_name
-        if model_name == 'gpt-3.5-turbo':
-            return CHATGPT_3_API_URL
-        elif model_name == 'gpt-4-1106-preview':
+        if model_name.startswith('gpt-4'):
             return CHATGPT_4_API_URL
-
+        elif model_name.startswith('beomi/'):
+            return LOCAL_MODEL_API_URL
+        return CHATGPT_3_API_URL
+
+    def show_earlier_turns(self):
+        # 화면에 보일 턴을 한 페이지 늘리고, 세션에 아직 없는 구간이면 DB 에서 한 페이지 더 읽는다
+        room = st.session_state[self.current_user.name]['chat_rooms'][self.room_name]
+        room['visible_turns'] = room.get('visible_turns', HISTORY_PAGE_TURNS) + HISTORY_PAGE_TURNS
+        if len(room['user_message']) < min(room['visible_turns'], room['message_count']):
+            self.load_room_messages(self.room_name)
+
+    @st.fragment
     def display_chat_history(self):
+        # fragment 안에서만 다시 그려지므로 "이전 대화 불러오기"를 눌러도 사이드바와 입력창은 그대로다
         room_name = self.room_name
         user_name = self.current_user.name
 
-        for i, message in enumerate(st.session_state[user_name]['chat_rooms'][room_name]['messages']):
-            with st.chat_message(message["role"]):
-                st.markdown(message["content"])
-
-                if (i+1) % 2 == 0:
-                    st.write(
-                        f"Model used: {st.session_state[user_name]['chat_rooms'][room_name]['model_name'][int(i/2)]}     "
-                        f"Number of tokens: {st.session_state[user_name]['chat_rooms'][room_name]['total_tokens'][int(i/2)]}     "
-                        f"Cost: ${st.session_state[user_name]['chat_rooms'][room_name]['cost'][int(i/2)]:.5f}"
-                    )
+        room = st.session_state[user_name]['chat_rooms'][room_name]
+        visible_turns = room.setdefault('visible_turns', HISTORY_PAGE_TURNS)
+        start = max(0, len(room['user_message']) - visible_turns)
+        if start > 0 or len(room['user_message']) < room['message_count']:
+            st.button("이전 대화 불러오기", on_click=self.show_earlier_turns, key=f"load_earlier_{room_name}")
+
+        for index in range(start, len(room['user_message'])):
+            with st.chat_message("user"):
+                st.markdown(room['user_message'][index])
+            with st.chat_message("assistant"):
+                st.markdown(room['chatbot_message'][index])
+                st.write(self.message_footer(index))
+
+    def message_footer(self, index):
+        room = st.session_state[self.current_user.name]['chat_rooms'][self.room_name]
+        footer = (
+            f"Model used: {room['model_name'][index]}     "
+            f"Number of tokens: {room['total_tokens'][index]}     "
+            f"Cost: ${room['cost'][index]:.5f}"
+        )
+        if room['latency_ms'][index] is not None:
+            footer += f"     Latency: {room['latency_ms'][index]}ms"
+        if room['saved_cost'][index]:
+            footer += f"     (saved ${room['saved_cost'][index]:.5f})"
+        return footer
 
     def login(self, user_name: str):
         user = self.chat_bot_db.user_login(user_name=user_name)
@@ -0,0 +1,251 @@
+"""Streamlit 앱이 게이트웨이를 부를 때 쓰는 HTTP 클라이언트.
+
+keep-alive 커넥션 풀을 재사용하고, 연결/읽기 타임아웃과 제한된 재시도를 건다.
+게이트웨이가 연달아 실패하면 서킷 브레이커가 열려서 한동안 요청을 보내지 않고 바로 실패한다.
+게이트웨이가 돌려준 실패(상태 코드나 스트림 중간의 {"error"} 이벤트)는 GatewayError 로 올린다.
+요청 본문은 orjson(없으면 json)이나 msgpack 으로 인코딩하고, DeltaSession 을 넘기면 게이트웨이가 이미 가진
+히스토리 뒤의 새 메세지만 보낸다(api/sessions.py).
+"""
+import json
+import threading
+import time
+import uuid
+from typing import Iterator, List, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import MaxRetryError
+from urllib3.util.retry import Retry
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+CONNECT_TIMEOUT = 3.05
+READ_TIMEOUT = 60.0  # 스트리밍에서는 다음 줄이 올 때까지의 최대 대기 시간이다
+MAX_RETRIES = 3
+BACKOFF_FACTOR = 0.5
+POOL_MAXSIZE = 10
+FAILURE_THRESHOLD = 5
+RESET_TIMEOUT = 30.0
+MAX_RETRY_AFTER = 3.0
+
+# 게이트웨이가 작업을 시작하기 전에 거절한 응답(대기열 가득 참/대기 시간 초과)만 다시 보낸다
+RETRY_STATUS_CODES = (429, 503)
+
+
+class CircuitOpenError(requests.ConnectionError):
+    pass
+
+
+class GatewayRetry(Retry):
+    """Retry-After 가 MAX_RETRY_AFTER 보다 길면 그동안 화면을 멈춰 두지 않고 응답을 그대로 돌려준다."""
+
+    def increment(self, method=None, url=None, response=None, error=None, _pool=None, _stacktrace=None):
+        if response is not None:
+            retry_after = self.get_retry_after(response)
+            if retry_after is not None and retry_after > MAX_RETRY_AFTER:
+                # raise_on_status=False 이므로 urllib3 가 이 응답을 호출한 쪽에 넘긴다
+                raise MaxRetryError(_pool, url, "Retry-After is too long")
+        return super().increment(method, url, response, error, _pool, _stacktrace)
+
+
+class GatewayError(requests.RequestException):
+    def __init__(self, message: str, status_code: Optional[int] = None, retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+def _raise_for_gateway_error(response: requests.Response):
+    if response.status_code == 200:
+        return
+    try:
+        body = response.json()
+        message = body.get("error") or body.get("detail") or response.reason
+    except ValueError:
+        message = response.text or response.reason
+    try:
+        retry_after = float(response.headers["Retry-After"])
+    except (KeyError, ValueError):
+        retry_after = None
+    raise GatewayError(f"HTTP {response.status_code}: {message}", response.status_code, retry_after)
+
+
+def encode_payload(payload: dict, wire_format: str = "json"):
+    """(본문 바이트, Content-Type). json 은 한글을 이스케이프하지 않는 UTF-8 로 보낸다."""
+    if wire_format == "msgpack":
+        return msgpack.packb(payload), "application/msgpack"
+    if orjson is not None:
+        return orjson.dumps(payload), "application/json"
+    return json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode("utf-8"), "application/json"
+
+
+class DeltaSession:
+    """한 대화방의 히스토리를 게이트웨이와 맞춰 두는 델타 프로토콜 상태.
+
+    게이트웨이가 turn_id 로 확인해 준 히스토리를 들고 있다가, 다음 요청의 메세지가 그 히스토리로 시작하면
+    뒤에 붙은 메세지만 보낸다. 컨텍스트 요약처럼 앞부분이 바뀌면 전체를 보내고 그것을 새 기준으로 삼는다.
+    들고 있는 메세지는 세션 상태의 것과 같은 객체라서 비교는 대부분 참조 비교로 끝난다.
+    """
+
+    def __init__(self):
+        self.session_id = uuid.uuid4().hex
+        self.turn_id = None
+        self._acked: List[dict] = []
+
+    def request(self, payload: dict) -> dict:
+        messages = payload["message"]
+        acked = len(self._acked)
+        if self.turn_id is not None and len(messages) > acked and messages[:acked] == self._acked:
+            return {**payload, "message": messages[acked:], "session_id": self.session_id,
+                    "last_turn_id": self.turn_id}
+        return {**payload, "session_id": self.session_id}
+
+    def ack(self, messages: List[dict], reply: str, turn_id: Optional[str]):
+        if turn_id is None:
+            # 델타 프로토콜을 모르는 게이트웨이
+            self.reset()
+            return
+        self.turn_id = turn_id
+        self._acked = list(messages) + [{"role": "assistant", "content": reply}]
+
+    def reset(self):
+        self.turn_id = None
+        self._acked = []
+
+
+class CircuitBreaker:
+    """연속 실패가 failure_threshold 번이면 열리고, reset_timeout 뒤 요청 하나로 복구 여부를 확인한다."""
+
+    def __init__(self, failure_threshold: int = FAILURE_THRESHOLD, reset_timeout: float = RESET_TIMEOUT):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._trial_in_progress = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half-open"
+        return "open"
+
+    def before_request(self):
+        with self._lock:
+            state = self.state
+            if state == "open" or (state == "half-open" and self._trial_in_progress):
+                retry_in = self.reset_timeout - (time.monotonic() - self.opened_at)
+                raise CircuitOpenError(f"Gateway is unavailable, retry in {max(retry_in, 0):.0f}s")
+            if state == "half-open":
+                self._trial_in_progress = True
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial_in_progress = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._trial_in_progress = False
+            if self.opened_at is not None or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+
+
+class ChatClient:
+    def __init__(self, connect_timeout: float = CONNECT_TIMEOUT, read_timeout: float = READ_TIMEOUT,
+                 max_retries: int = MAX_RETRIES, backoff_factor: float = BACKOFF_FACTOR,
+                 pool_maxsize: int = POOL_MAXSIZE, breaker: Optional[CircuitBreaker] = None,
+                 wire_format: str = "json"):
+        if wire_format == "msgpack" and msgpack is None:
+            raise ValueError("msgpack wire format requires the msgpack package")
+        self.timeout = (connect_timeout, read_timeout)
+        self.wire_format = wire_format
+        self.breaker = breaker or CircuitBreaker()
+        # POST 는 멱등이 아니므로 요청이 아예 전달되지 않은 연결 실패와 RETRY_STATUS_CODES 만 재시도하고,
+        # 응답을 읽다가 끊긴 경우(read)는 다시 보내지 않는다
+        retry = GatewayRetry(
+            total=max_retries,
+            connect=max_retries,
+            read=0,
+            status=max_retries,
+            backoff_factor=backoff_factor,
+            status_forcelist=RETRY_STATUS_CODES,
+            allowed_methods=frozenset({"GET", "POST"}),
+            respect_retry_after_header=True,
+            raise_on_status=False,
+        )
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_maxsize, max_retries=retry)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def _post(self, url: str, payload: dict, stream: bool) -> requests.Response:
+        self.breaker.before_request()
+        data, content_type = encode_payload(payload, self.wire_format)
+        try:
+            response = self.session.post(url, data=data, headers={"Content-Type": content_type},
+                                         timeout=self.timeout, stream=stream)
+        except requests.RequestException:
+            self.breaker.record_failure()
+            raise
+        if response.status_code >= 500:
+            self.breaker.record_failure()
+        else:
+            self.breaker.record_success()
+        return response
+
+    def _post_chat(self, url: str, payload: dict, stream: bool, delta: Optional[DeltaSession]) -> requests.Response:
+        if delta is None:
+            return self._post(url, payload, stream)
+        body = delta.request(payload)
+        response = self._post(url, body, stream)
+        if response.status_code == 409 and "last_turn_id" in body:
+            # 게이트웨이가 앞 턴을 잊었으면(만료, 재시작, 다른 노드) 전체 히스토리로 한 번 더 보낸다
+            response.close()
+            delta.reset()
+            response = self._post(url, delta.request(payload), stream)
+        return response
+
+    def post_json(self, url: str, payload: dict, delta: Optional[DeltaSession] = None) -> dict:
+        with self._post_chat(url, payload, False, delta) as response:
+            _raise_for_gateway_error(response)
+            body = response.json()
+        if delta is not None:
+            delta.ack(payload["message"], body["message"], body.get("turn_id"))
+        return body
+
+    def stream_ndjson(self, url: str, payload: dict, delta: Optional[DeltaSession] = None) -> Iterator[dict]:
+        # 게이트웨이가 NDJSON으로 흘려주는 이벤트를 도착하는 대로 넘겨준다
+        parts = []
+        with self._post_chat(url, payload, True, delta) as response:
+            _raise_for_gateway_error(response)
+            for line in response.iter_lines(chunk_size=None):
+                if not line:
+                    continue
+                try:
+                    event = orjson.loads(line) if orjson is not None else json.loads(line)
+                except ValueError as e:
+                    # 깨진 줄도 실패한 턴으로 다뤄서 호출한 쪽이 턴을 저장하지 않게 한다
+                    raise GatewayError(f"Malformed gateway event: {e}") from e
+                if "error" in event:
+                    raise GatewayError(event["error"], event.get("status"), event.get("retry_after"))
+                if "delta" in event:
+                    parts.append(event["delta"])
+                elif event.get("done") and delta is not None:
+                    delta.ack(payload["message"], "".join(parts), event.get("turn_id"))
+                yield event
+
+    def close(self):
+        self.session.close()
@@ -0,0 +1,171 @@
+"""Streamlit UI 와 재생 벤치마크(benchmarks/replay.py)가 함께 쓰는 대화 한 턴.
+
+방 상태(st.session_state[user]['chat_rooms'][room] 모양의 dict)에 사용자 메세지를 붙이고, 토큰 예산에 맞춘
+컨텍스트를 게이트웨이 스트림으로 보낸다. 완료 이벤트까지 받은 턴만 비용을 계산해 방 상태에 남기고,
+save_turn 이 ChatDatabase 에 쓴다. 답을 받지 못한 턴은 방 상태에서 되돌리고 예외를 그대로 올린다.
+턴 비용에는 그 턴에서 만든 누적 요약의 비용도 들어가고, 아낀 비용(saved_cost)은 캐시 적중과
+줄인 프롬프트 토큰의 값에서 요약 비용을 뺀 것이다.
+"""
+import time
+from typing import Callable, List, Optional
+
+import requests
+
+from chat_client import ChatClient, GatewayError
+from context_window import SUMMARY_PREFIX, ContextWindowManager, build_summary_prompt
+from database.usage import compute_cost
+from observability.logs import get_logger, log_event
+
+SYSTEM_MSG = "You are a helpful assistant"
+SUMMARY_INPUT_TOKENS = 3000
+
+logger = get_logger("chat_turn")
+
+
+class GatewaySummarizer:
+    """예산을 넘는 옛 턴을 게이트웨이로 요약하고, 요약에 쓴 토큰과 비용을 모아 둔다.
+
+    실패하면 None 을 돌려주고 ContextWindowManager 가 잘라서 보낸다. run_turn 이 take_usage 로 모은 사용량을
+    가져가서 턴 비용에 더한다.
+    """
+
+    def __init__(self, chat_client: ChatClient, url: str, model: str):
+        self.chat_client = chat_client
+        self.url = url
+        self.model = model
+        self.usage = self._empty_usage()
+
+    def _empty_usage(self) -> dict:
+        return {'model_name': self.model, 'prompt_tokens': 0, 'completion_tokens': 0, 'total_tokens': 0, 'cost': 0.0}
+
+    def __call__(self, previous_summary: str, messages: List[dict]) -> Optional[str]:
+        prompt = build_summary_prompt(self.model, previous_summary, messages, SUMMARY_INPUT_TOKENS)
+        try:
+            response = self.chat_client.post_json(
+                self.url,
+                {
+                    "model": self.model,
+                    "message": [{"role": "user", "content": prompt}],
+                    "max_tokens": 256,
+                    "temperature": 0.0,
+                }
+            )
+        except (requests.RequestException, ValueError) as e:
+            log_event(logger, "warning", "summarization_failed", error=str(e))
+            return None
+        # 캐시에서 나온 요약은 업스트림 비용이 들지 않았다
+        if not response.get('cache_hit'):
+            prompt_tokens = response.get('prompt_tokens', 0)
+            completion_tokens = response.get('completion_tokens', 0)
+            self.usage['prompt_tokens'] += prompt_tokens
+            self.usage['completion_tokens'] += completion_tokens
+            self.usage['total_tokens'] += response.get('total_tokens', 0)
+            self.usage['cost'] += compute_cost(self.model, prompt_tokens, completion_tokens)
+        return response.get('message')
+
+    def take_usage(self) -> dict:
+        usage, self.usage = self.usage, self._empty_usage()
+        return usage
+
+
+def run_turn(chat_client: ChatClient, url: str, room: dict, user_message: str, model: str,
+             max_tokens: int = 256, temperature: float = 0.2,
+             summarizer: Optional[GatewaySummarizer] = None,
+             on_delta: Optional[Callable[[str], None]] = None) -> dict:
+    """user_message 를 보내고 받은 답을 방 상태에 붙인 뒤 턴 정보를 돌려준다.
+
+    url 은 스트리밍 엔드포인트의 앞부분(/chat/gpt3 등)이다. room['delta'] 가 있으면 델타 프로토콜로 보낸다.
+    on_delta 는 지금까지 받은 답 전체를 받는다.
+    """
+    room['messages'].append({"role": "user", "content": user_message})
+
+    # 보관된 턴을 불러오지 않았으면 보관 작업이 미리 만들어 둔 요약으로 그 구간을 대신한다
+    system_message = SYSTEM_MSG
+    if room.get('archive_summary') and not room.get('archive_loaded'):
+        system_message += "\n\n" + SUMMARY_PREFIX + room['archive_summary']
+
+    # 전체 히스토리 대신 모델별 토큰 예산에 맞춘 컨텍스트만 보낸다
+    context_manager = ContextWindowManager(model, max_tokens, summarizer=summarizer)
+    context, saved_prompt_tokens = context_manager.build(system_message, room['messages'], room.setdefault('summary', {}))
+
+    completion = {}
+    parts = []
+    ttft = None
+    started = time.perf_counter()
+    try:
+        for event in chat_client.stream_ndjson(url + '/stream', {
+            "model": model,
+            "message": context,
+            "max_tokens": max_tokens,
+            "temperature": temperature,
+        }, delta=room.get('delta')):
+            if 'delta' in event:
+                if ttft is None:
+                    ttft = time.perf_counter() - started
+                parts.append(event['delta'])
+                if on_delta is not None:
+                    on_delta("".join(parts))
+            else:
+                completion = event
+        if not completion.get('done'):
+            raise GatewayError("Response stream ended before completion")
+    except requests.RequestException:
+        room['messages'].pop()
+        raise
+    latency = time.perf_counter() - started
+
+    chatbot_message = "".join(parts)
+    room['messages'].append({"role": "assistant", "content": chatbot_message})
+    prompt_tokens = completion.get('prompt_tokens', 0)
+    completion_tokens = completion.get('completion_tokens', 0)
+    cache_hit = completion.get('cache_hit', False)
+    summary_usage = summarizer.take_usage() if summarizer is not None else None
+    summary_cost = summary_usage['cost'] if summary_usage is not None else 0.0
+    cost = compute_cost(model, prompt_tokens, completion_tokens)
+    # 게이트웨이 캐시에서 나온 응답은 업스트림 비용이 들지 않았으므로 그 금액을 절약액으로 남긴다.
+    # 컨텍스트를 줄여서 아낀 프롬프트 값도 더하되, 그러려고 만든 요약의 비용은 뺀다
+    saved_cost = cost if cache_hit else 0.0
+    saved_cost = max(0.0, saved_cost + compute_cost(model, saved_prompt_tokens, 0) - summary_cost)
+    cost = (0.0 if cache_hit else cost) + summary_cost
+    turn = {
+        'user_message': user_message,
+        'chatbot_message': chatbot_message,
+        'model_name': model,
+        'total_tokens': completion.get('total_tokens', 0),
+        'prompt_tokens': prompt_tokens,
+        'completion_tokens': completion_tokens,
+        'saved_prompt_tokens': saved_prompt_tokens,
+        'cost': cost,
+        'saved_cost': saved_cost,
+        'summary_usage': summary_usage if summary_cost else None,
+        'cache_hit': cache_hit,
+        'latency_ms': int(latency * 1000),
+        'latency': latency,
+        'ttft': ttft,
+    }
+    for name in ('user_message', 'chatbot_message', 'model_name', 'total_tokens', 'cost', 'saved_cost', 'latency_ms'):
+        room[name].append(turn[name])
+    room['message_count'] = room.get('message_count', 0) + 1
+    room['total_cost'] += cost
+    return turn
+
+
+def save_turn(chat_db, room_name: str, user, turn: dict) -> int:
+    """run_turn 이 돌려준 턴을 대화 DB 에 쓰고 방 ID 를 돌려준다."""
+    return chat_db.add_message(
+        room_name=room_name,
+        user_id=user.id,
+        user_name=user.name,
+        user_message=turn['user_message'],
+        chatbot_message=turn['chatbot_message'],
+        model_name=turn['model_name'],
+        total_tokens=turn['total_tokens'],
+        cost=turn['cost'],
+        saved_prompt_tokens=turn['saved_prompt_tokens'],
+        saved_cost=turn['saved_cost'],
+        latency_ms=turn['latency_ms'],
+        prompt_tokens=turn['prompt_tokens'],
+        completion_tokens=turn['completion_tokens'],
+        cache_hit=turn['cache_hit'],
+        summary_usage=turn['summary_usage']
+    )
@@ -0,0 +1,157 @@
+from functools import lru_cache
+from typing import Callable, List, Optional, Tuple
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# 모델별 최대 컨텍스트 길이와 프롬프트에 쓸 토큰 예산
+MODEL_CONTEXT_LIMITS = {
+    "gpt-3.5-turbo": 4096,
+    "gpt-4": 8192,
+    "beomi/KoAlpaca-Polyglot-12.8B": 2048,
+    "beomi/LLaMA-2-ko-7b": 4096,
+    "beomi/LLaMA-2-ko-13b": 4096,
+}
+MODEL_PROMPT_BUDGETS = {
+    "gpt-3.5-turbo": 2048,
+    "gpt-4": 4096,
+    "beomi/KoAlpaca-Polyglot-12.8B": 1024,
+    "beomi/LLaMA-2-ko-7b": 2048,
+    "beomi/LLaMA-2-ko-13b": 2048,
+}
+DEFAULT_CONTEXT_LIMIT = 4096
+DEFAULT_PROMPT_BUDGET = 2048
+RECENT_TURNS = 4
+TOKENS_PER_MESSAGE = 4  # role, 구분자 등 메세지마다 붙는 오버헤드
+
+SUMMARY_PREFIX = "Summary of the earlier conversation:\n"
+
+
+@lru_cache(maxsize=None)
+def get_tokenizer(model: str):
+    if tiktoken is None:
+        return None
+    try:
+        try:
+            return tiktoken.encoding_for_model(model)
+        except KeyError:
+            return tiktoken.get_encoding("cl100k_base")
+    except Exception:
+        # 인코딩 파일을 받을 수 없는 환경이면 글자 수 기반 추정으로 대신한다
+        return None
+
+
+@lru_cache(maxsize=8192)
+def count_tokens(model: str, text: str) -> int:
+    tokenizer = get_tokenizer(model)
+    if tokenizer is None:
+        return max(1, len(text) // 2)
+    return len(tokenizer.encode(text))
+
+
+def truncate_to_tokens(model: str, text: str, max_tokens: int) -> str:
+    tokenizer = get_tokenizer(model)
+    if tokenizer is None:
+        return text[:max_tokens * 2]
+    return tokenizer.decode(tokenizer.encode(text)[:max_tokens])
+
+
+def build_summary_prompt(model: str, previous_summary: str, messages: List[dict], max_input_tokens: int) -> str:
+    # UI 의 누적 요약과 보관 작업의 방 요약이 같은 지시문을 쓴다
+    transcript = "\n".join(f"{message['role']}: {message['content']}" for message in messages)
+    return (
+        "Update the running summary of a conversation with the new turns below. "
+        "Keep names, facts, decisions and open questions; answer with the summary only.\n\n"
+        f"Current summary:\n{previous_summary or '(none)'}\n\n"
+        f"New turns:\n{truncate_to_tokens(model, transcript, max_input_tokens)}"
+    )
+
+
+def count_message_tokens(model: str, messages: List[dict]) -> int:
+    return sum(count_tokens(model, message["content"] or "") + TOKENS_PER_MESSAGE for message in messages)
+
+
+def get_prompt_budget(model: str, max_tokens: int) -> int:
+    context_limit = MODEL_CONTEXT_LIMITS.get(model, DEFAULT_CONTEXT_LIMIT)
+    budget = MODEL_PROMPT_BUDGETS.get(model, DEFAULT_PROMPT_BUDGET)
+    return max(0, min(budget, context_limit - max_tokens))
+
+
+class ContextWindowManager:
+    """방 전체 히스토리 대신 토큰 예산 안에 들어가는 프롬프트를 조립한다.
+
+    시스템 메세지는 항상 맨 앞에 고정하고, 최근 RECENT_TURNS 턴은 그대로 보낸다.
+    그보다 오래된 턴은 summarizer가 있으면 누적 요약으로 대체하고, 없으면 예산이
+    허락하는 만큼만 최신 순으로 남기며 경계에 걸린 메세지는 잘라낸다.
+    """
+
+    def __init__(self, model: str, max_tokens: int, recent_turns: int = RECENT_TURNS,
+                 summarizer: Optional[Callable[[str, List[dict]], str]] = None):
+        self.model = model
+        self.budget = get_prompt_budget(model, max_tokens)
+        self.recent_turns = recent_turns
+        self.summarizer = summarizer
+
+    def build(self, system_message: str, messages: List[dict], summary_cache: dict) -> Tuple[List[dict], int]:
+        """(보낼 메세지 목록, 전체 히스토리 대비 절약한 프롬프트 토큰 수)를 돌려준다.
+
+        summary_cache 는 방마다 하나씩 두는 dict 로, 요약이 몇 개의 메세지까지
+        반영했는지('upto')와 요약문('text')을 담아 다음 턴에 재사용한다.
+        """
+        system = [{"role": "system", "content": system_message}]
+        # 전체 히스토리를 보냈다면 시스템 메세지도 함께 나갔으므로 같이 센다
+        full_tokens = count_message_tokens(self.model, system + messages)
+
+        if full_tokens <= self.budget:
+            return system + messages, 0
+
+        split = max(0, len(messages) - self.recent_turns * 2)
+        older, recent = list(messages[:split]), list(messages[split:])
+
+        # 예산이 모자라면 최근 턴도 오래된 것부터 older 쪽으로 넘긴다 (마지막 사용자 메세지는 남긴다)
+        while len(recent) > 1 and count_message_tokens(self.model, system + recent) > self.budget:
+            older.append(recent.pop(0))
+
+        remaining = self.budget - count_message_tokens(self.model, system + recent)
+        prefix = None
+        if self.summarizer is not None and older:
+            prefix = self._summarize(older, summary_cache, remaining)
+        if prefix is None:
+            # 요약을 쓸 수 없으면 오래된 턴을 예산만큼 잘라서 보낸다
+            prefix = self._fit_latest(older, remaining)
+
+        context = system + prefix + recent
+        saved_tokens = max(0, full_tokens - count_message_tokens(self.model, context))
+        return context, saved_tokens
+
+    def _summarize(self, older: List[dict], summary_cache: dict, remaining: int) -> Optional[List[dict]]:
+        upto = summary_cache.get('upto', 0)
+        if upto > len(older):
+            upto, summary_cache['text'] = 0, ''
+        if upto < len(older):
+            text = self.summarizer(summary_cache.get('text', ''), older[upto:])
+            if not text:
+                return None
+            summary_cache['text'] = text
+            summary_cache['upto'] = len(older)
+
+        if remaining <= TOKENS_PER_MESSAGE:
+            return []
+        text = truncate_to_tokens(self.model, SUMMARY_PREFIX + summary_cache['text'], remaining - TOKENS_PER_MESSAGE)
+        return [{"role": "system", "content": text}]
+
+    def _fit_latest(self, older: List[dict], remaining: int) -> List[dict]:
+        kept = []
+        for message in reversed(older):
+            tokens = count_tokens(self.model, message["content"] or "") + TOKENS_PER_MESSAGE
+            if tokens <= remaining:
+                kept.append(message)
+                remaining -= tokens
+                continue
+            if remaining > TOKENS_PER_MESSAGE:
+                content = truncate_to_tokens(self.model, message["content"] or "", remaining - TOKENS_PER_MESSAGE)
+                kept.append({"role": message["role"], "content": content})
+            break
+        return list(reversed(kept))
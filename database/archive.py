@@ -0,0 +1,256 @@
+"""오래 쓰지 않은 방의 옛 턴을 압축 블록으로 옮기는 유지보수 작업.
+
+마지막 활동(rooms.last_active_at)이 idle_days 보다 오래된 방에서 최근 keep_turns 턴만 messages 에 남기고,
+그보다 오래된 턴은 block_size 개씩 JSON 으로 묶고 압축해서 message_archive 에 넣는다.
+zstandard 가 설치되어 있으면 zstd 로, 없으면 zlib 으로 압축하고 블록마다 codec 을 적어 둔다.
+load_messages 는 hot 메세지를 다 읽은 다음에야 블록을 풀어서 이어 돌려준다.
+
+summarizer 를 주면 옮기는 턴으로 방의 누적 요약(rooms.summary)을 미리 갱신한다. UI 는 보관된 턴을 불러오기
+전까지 이 요약을 컨텍스트에 넣는다. 보관된 턴의 messages_fts 행은 그대로 남으므로 대화 검색에도 나오고,
+검색 결과는 블록을 풀어서 채운다(ChatDatabase.search_messages).
+
+    python -m database.archive --db chatbot.db --idle-days 14 --keep-turns 50
+    python -m database.archive --db chatbot.db --interval 3600 --summarize http://localhost:8000/chat/gpt3
+"""
+import argparse
+import datetime
+import json
+import time
+import zlib
+from typing import Callable, Iterator, List, Optional, Tuple
+
+from sqlalchemy import text
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from database.models import Message, MessageArchive, Room
+from observability.logs import get_logger, log_event
+
+IDLE_DAYS = 14
+KEEP_TURNS = 50  # messages 에 남기는 최근 턴 수. UI 가 방을 열 때 읽는 첫 페이지(50)보다 적으면 안 된다
+BLOCK_SIZE = 200
+ZSTD_LEVEL = 10
+ZLIB_LEVEL = 9
+SUMMARY_MODEL = "gpt-3.5-turbo"
+SUMMARY_INPUT_TOKENS = 3000
+
+ARCHIVED_COLUMNS = (
+    'id', 'user_id', 'user_message', 'chatbot_message', 'model_name', 'total_tokens', 'cost',
+    'saved_prompt_tokens', 'saved_cost', 'latency_ms',
+)
+INDEX_ARCHIVED = (
+    "INSERT INTO messages_fts(rowid, user_message, chatbot_message, user_id) "
+    "VALUES (:id, :user_message, :chatbot_message, :user_id)"
+)
+UNINDEX_ARCHIVED = (
+    "INSERT INTO messages_fts(messages_fts, rowid, user_message, chatbot_message, user_id) "
+    "VALUES ('delete', :id, :user_message, :chatbot_message, :user_id)"
+)
+
+logger = get_logger(__name__)
+
+
+def encode_block(messages: List[dict]) -> Tuple[str, bytes]:
+    raw = json.dumps(messages, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    if zstandard is not None:
+        return 'zstd', zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(raw)
+    return 'zlib', zlib.compress(raw, ZLIB_LEVEL)
+
+
+def decode_block(codec: str, data: bytes) -> List[dict]:
+    if codec == 'zstd':
+        if zstandard is None:
+            raise RuntimeError("zstandard is required to read zstd archive blocks")
+        raw = zstandard.ZstdDecompressor().decompress(data)
+    elif codec == 'zlib':
+        raw = zlib.decompress(data)
+    else:
+        raise ValueError(f"Unknown archive codec: {codec}")
+    return json.loads(raw)
+
+
+def transcript(messages: List[dict]) -> List[dict]:
+    # 답을 받지 못한 턴(chatbot_message 가 None)은 질문만 넣는다
+    history = []
+    for message in messages:
+        history.append({"role": "user", "content": message['user_message']})
+        if message['chatbot_message'] is not None:
+            history.append({"role": "assistant", "content": message['chatbot_message']})
+    return history
+
+
+def summary_chunks(model: str, history: List[dict], max_tokens: int) -> Iterator[List[dict]]:
+    # 요약 프롬프트 한 번에 들어가는 만큼씩 나눈다. 혼자서 예산을 넘는 메세지만 build_summary_prompt 에서 잘린다
+    from context_window import count_message_tokens
+
+    chunk, used = [], 0
+    for message in history:
+        tokens = count_message_tokens(model, [message])
+        if chunk and used + tokens > max_tokens:
+            yield chunk
+            chunk, used = [], 0
+        chunk.append(message)
+        used += tokens
+    if chunk:
+        yield chunk
+
+
+def index_archived(session, messages: List[dict], delete: bool = False):
+    # messages_fts 는 messages 를 원본으로 쓰므로 블록에 든 메세지의 행은 직접 넣고 뺀다.
+    # 빼는 'delete' 명령에는 넣을 때와 같은 값을 줘야 한다
+    if not messages:
+        return
+    session.execute(text(UNINDEX_ARCHIVED if delete else INDEX_ARCHIVED), [
+        {column: message[column] for column in ('id', 'user_message', 'chatbot_message', 'user_id')}
+        for message in messages
+    ])
+
+
+def archive_room(chat_db, room_id: int, keep_turns: int = KEEP_TURNS, block_size: int = BLOCK_SIZE,
+                 summarizer: Optional[Callable[[str, List[dict]], Optional[str]]] = None) -> dict:
+    """방 하나에서 최근 keep_turns 턴보다 오래된 메세지를 블록 단위로 옮긴다."""
+    stats = {'messages': 0, 'blocks': 0, 'raw_bytes': 0, 'stored_bytes': 0}
+    with chat_db.session_scope() as session:
+        # 남길 턴 바로 앞의 메세지까지가 보관 대상이다
+        cutoff = session.query(Message.id).filter(Message.room_id == room_id) \
+            .order_by(Message.id.desc()).offset(keep_turns).limit(1).scalar()
+        room = session.get(Room, room_id)
+        summary = room.summary if room is not None else None
+    if cutoff is None:
+        return stats
+
+    while True:
+        with chat_db.session_scope() as session:
+            rows = session.query(Message).filter(Message.room_id == room_id, Message.id <= cutoff) \
+                .order_by(Message.id).limit(block_size).all()
+            messages = [{column: getattr(row, column) for column in ARCHIVED_COLUMNS} for row in rows]
+        if not messages:
+            return stats
+
+        # 요약은 업스트림을 부르므로 쓰기 트랜잭션 밖에서 만든다. 요약에 실패하면 이 방은 다음 실행으로 미룬다
+        if summarizer is not None:
+            summary = summarizer(summary or '', transcript(messages))
+            if not summary:
+                log_event(logger, "warning", "archive_summary_failed", room_id=room_id)
+                return stats
+
+        codec, data = encode_block(messages)
+        first_id, last_id = messages[0]['id'], messages[-1]['id']
+        with chat_db.session_scope(write=True) as session:
+            session.add(MessageArchive(
+                room_id=room_id,
+                search_indexed=True,
+                first_message_id=first_id,
+                last_message_id=last_id,
+                message_count=len(messages),
+                total_tokens=sum(message['total_tokens'] or 0 for message in messages),
+                codec=codec,
+                data=data,
+                created_at=datetime.datetime.now()
+            ))
+            # messages_fts_delete 트리거는 블록에 든 메세지의 검색 행을 지우지 않는다. 블록을 먼저 써야 트리거가 본다
+            session.flush()
+            # 읽은 뒤 같은 구간에 새 메세지가 생길 수는 없지만(ID 는 늘기만 한다) 읽은 ID 만 지운다
+            session.query(Message).filter(Message.id.in_([message['id'] for message in messages])) \
+                .delete(synchronize_session=False)
+            if summarizer is not None:
+                session.query(Room).filter(Room.id == room_id) \
+                    .update({Room.summary: summary, Room.summary_upto_id: last_id})
+
+        stats['messages'] += len(messages)
+        stats['blocks'] += 1
+        stats['raw_bytes'] += len(json.dumps(messages, ensure_ascii=False, separators=(',', ':')).encode('utf-8'))
+        stats['stored_bytes'] += len(data)
+
+
+def archive_cold_rooms(chat_db, idle_days: float = IDLE_DAYS, keep_turns: int = KEEP_TURNS,
+                       block_size: int = BLOCK_SIZE,
+                       summarizer: Optional[Callable[[str, List[dict]], Optional[str]]] = None,
+                       now: Optional[datetime.datetime] = None) -> dict:
+    now = now or datetime.datetime.now()
+    with chat_db.session_scope() as session:
+        room_ids = [room_id for room_id, in session.query(Room.id).filter(
+            Room.last_active_at < now - datetime.timedelta(days=idle_days)
+        ).order_by(Room.id)]
+
+    totals = {'rooms': 0, 'messages': 0, 'blocks': 0, 'raw_bytes': 0, 'stored_bytes': 0}
+    for room_id in room_ids:
+        stats = archive_room(chat_db, room_id, keep_turns, block_size, summarizer)
+        if stats['messages']:
+            totals['rooms'] += 1
+            for name, value in stats.items():
+                totals[name] += value
+            log_event(logger, "info", "room_archived", room_id=room_id, **stats)
+    return totals
+
+
+def gateway_summarizer(url: str, model: str = SUMMARY_MODEL) -> Callable[[str, List[dict]], Optional[str]]:
+    # UI 와 같은 게이트웨이, 같은 요약 지시문을 쓴다. 보관 작업은 급하지 않으므로 batch 우선순위로 보낸다
+    import requests
+
+    from chat_client import ChatClient
+    from context_window import build_summary_prompt
+
+    chat_client = ChatClient()
+    chat_client.session.headers["X-Priority"] = "batch"
+
+    def summarize(previous_summary: str, messages: List[dict]) -> Optional[str]:
+        # 블록 하나가 SUMMARY_INPUT_TOKENS 를 넘으면 나눠서 앞 조각의 요약에 다음 조각을 이어 붙인다
+        summary = previous_summary
+        for chunk in summary_chunks(model, messages, SUMMARY_INPUT_TOKENS):
+            prompt = build_summary_prompt(model, summary, chunk, SUMMARY_INPUT_TOKENS)
+            try:
+                response = chat_client.post_json(
+                    url,
+                    {
+                        "model": model,
+                        "message": [{"role": "user", "content": prompt}],
+                        "max_tokens": 256,
+                        "temperature": 0.0,
+                    }
+                )
+                summary = response.get('message')
+            except (requests.RequestException, ValueError) as e:
+                log_event(logger, "warning", "summarization_failed", error=str(e))
+                return None
+            if not summary:
+                return None
+        return summary
+
+    return summarize
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--db", default="chatbot.db")
+    parser.add_argument("--idle-days", type=float, default=IDLE_DAYS)
+    parser.add_argument("--keep-turns", type=int, default=KEEP_TURNS)
+    parser.add_argument("--block-size", type=int, default=BLOCK_SIZE)
+    parser.add_argument("--summarize", metavar="URL", default=None,
+                        help="이 게이트웨이 엔드포인트로 방 요약을 미리 만든다 (예: http://localhost:8000/chat/gpt3)")
+    parser.add_argument("--interval", type=float, default=0, help="0 보다 크면 이 간격(초)으로 계속 돈다")
+    args = parser.parse_args()
+
+    from database.setup_chat_db import ChatDatabase
+
+    chat_db = ChatDatabase(args.db)
+    summarizer = gateway_summarizer(args.summarize) if args.summarize else None
+    try:
+        while True:
+            totals = archive_cold_rooms(chat_db, args.idle_days, args.keep_turns, args.block_size, summarizer)
+            ratio = totals['stored_bytes'] / totals['raw_bytes'] if totals['raw_bytes'] else 0.0
+            print(f"{args.db}: archived {totals['messages']} messages from {totals['rooms']} rooms "
+                  f"in {totals['blocks']} blocks ({totals['raw_bytes']} -> {totals['stored_bytes']} bytes, "
+                  f"{ratio:.2f})")
+            if args.interval <= 0:
+                break
+            time.sleep(args.interval)
+    finally:
+        chat_db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,46 @@
+from sqlalchemy import create_engine, event
+from sqlalchemy.pool import QueuePool
+
+# 여러 Streamlit 세션이 한 파일을 같이 쓰는 상황에 맞춘 SQLite 설정
+SQLITE_PRAGMAS = {
+    "journal_mode": "WAL",        # 읽기와 쓰기가 서로를 막지 않는다
+    "synchronous": "NORMAL",      # WAL 에서는 NORMAL 로도 충분히 안전하고 fsync 가 줄어든다
+    "busy_timeout": 5000,         # 잠금을 만나면 바로 실패하지 않고 5초까지 기다린다
+    "mmap_size": 268435456,       # 256MB 까지 메모리 맵으로 읽는다
+    "temp_store": "MEMORY",
+}
+POOL_SIZE = 5
+MAX_OVERFLOW = 10
+POOL_TIMEOUT = 30
+
+
+def create_chat_engine(db_file, pool_size=POOL_SIZE, max_overflow=MAX_OVERFLOW, pool_timeout=POOL_TIMEOUT):
+    engine = create_engine(
+        f'sqlite:///{db_file}',
+        echo=False,
+        poolclass=QueuePool,
+        pool_size=pool_size,
+        max_overflow=max_overflow,
+        pool_timeout=pool_timeout,
+        pool_pre_ping=True,
+        connect_args={"check_same_thread": False, "timeout": SQLITE_PRAGMAS["busy_timeout"] / 1000},
+    )
+
+    @event.listens_for(engine, "connect")
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        # pysqlite 가 트랜잭션을 임의로 열지 않게 하고, BEGIN 은 아래 begin 이벤트에서 직접 낸다
+        dbapi_connection.isolation_level = None
+        cursor = dbapi_connection.cursor()
+        for name, value in SQLITE_PRAGMAS.items():
+            cursor.execute(f"PRAGMA {name}={value}")
+        cursor.close()
+
+    @event.listens_for(engine, "begin")
+    def do_begin(conn):
+        # 쓰기 트랜잭션은 처음부터 쓰기 잠금을 잡아야 읽기→쓰기 승격 중 "database is locked" 가 나지 않는다
+        if conn.get_execution_options().get("sqlite_immediate"):
+            conn.exec_driver_sql("BEGIN IMMEDIATE")
+        else:
+            conn.exec_driver_sql("BEGIN")
+
+    return engine
@@ -0,0 +1,125 @@
+import datetime
+import sqlite3
+import sys
+
+from sqlalchemy import bindparam, inspect, text
+
+from database.models import Base
+
+# 새로 붙인 컬럼 중 기존 행을 채워야 하는 것. 마지막 활동 시각을 모르는 방은 업그레이드한 시점부터 센다
+COLUMN_BACKFILLS = {
+    ('rooms', 'last_active_at'): lambda: datetime.datetime.now(),
+}
+
+
+def ensure_schema(engine):
+    # create_all 은 기존 테이블에 새 컬럼/인덱스를 추가하지 않으므로 빠진 것은 직접 붙인다
+    Base.metadata.create_all(engine)
+    inspector = inspect(engine)
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            existing = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing:
+                    column_type = column.type.compile(dialect=engine.dialect)
+                    conn.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}'))
+                    backfill = COLUMN_BACKFILLS.get((table.name, column.name))
+                    if backfill is not None:
+                        conn.execute(
+                            text(f'UPDATE {table.name} SET {column.name} = :value')
+                            .bindparams(bindparam('value', type_=column.type)),
+                            {'value': backfill()}
+                        )
+            for index in table.indexes:
+                index.create(conn, checkfirst=True)
+        ensure_search_index(conn)
+
+
+# 보관 작업(database/archive.py)이 블록으로 옮긴 메세지는 지워도 검색 행을 남긴다
+ARCHIVE_AWARE_DELETE_TRIGGER = (
+    "CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages "
+    "WHEN NOT EXISTS (SELECT 1 FROM message_archive a WHERE a.room_id = old.room_id "
+    "AND a.first_message_id <= old.id AND a.last_message_id >= old.id) BEGIN "
+    "INSERT INTO messages_fts(messages_fts, rowid, user_message, chatbot_message, user_id) "
+    "VALUES ('delete', old.id, old.user_message, old.chatbot_message, old.user_id); END"
+)
+
+# messages 를 원본으로 쓰는 external content FTS5 인덱스. 본문은 messages 에만 있고 인덱스에는 토큰만 들어간다.
+# unicode61 은 공백 단위로 나누므로 "날씨를" 같은 조사 붙은 말은 접두어 질의("날씨"*)로 찾고,
+# prefix 옵션으로 2, 3 글자 접두어 인덱스를 따로 둬서 그 질의를 빠르게 한다.
+# user_id 도 컬럼으로 넣어서 사용자 범위를 인덱스 안에서 좁힌다. 흔한 단어라도 그 사용자의 문서만 점수를 매긴다
+SEARCH_INDEX_DDL = (
+    "CREATE VIRTUAL TABLE messages_fts USING fts5("
+    "user_message, chatbot_message, user_id, content='messages', content_rowid='id', "
+    "tokenize='unicode61', prefix='2 3')",
+    "CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN "
+    "INSERT INTO messages_fts(rowid, user_message, chatbot_message, user_id) "
+    "VALUES (new.id, new.user_message, new.chatbot_message, new.user_id); END",
+    ARCHIVE_AWARE_DELETE_TRIGGER,
+    "CREATE TRIGGER IF NOT EXISTS messages_fts_update AFTER UPDATE OF user_message, chatbot_message, user_id ON messages BEGIN "
+    "INSERT INTO messages_fts(messages_fts, rowid, user_message, chatbot_message, user_id) "
+    "VALUES ('delete', old.id, old.user_message, old.chatbot_message, old.user_id); "
+    "INSERT INTO messages_fts(rowid, user_message, chatbot_message, user_id) "
+    "VALUES (new.id, new.user_message, new.chatbot_message, new.user_id); END",
+)
+
+
+def ensure_search_index(conn):
+    exists = conn.execute(text(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'messages_fts'"
+    )).first()
+    if exists:
+        trigger = conn.execute(text(
+            "SELECT sql FROM sqlite_master WHERE type = 'trigger' AND name = 'messages_fts_delete'"
+        )).scalar()
+        if trigger is None or 'message_archive' not in trigger:
+            conn.execute(text("DROP TRIGGER IF EXISTS messages_fts_delete"))
+            conn.execute(text(ARCHIVE_AWARE_DELETE_TRIGGER))
+    else:
+        for statement in SEARCH_INDEX_DDL:
+            conn.execute(text(statement))
+        # 인덱스를 처음 만들 때만 기존 메세지 전체로 채운다. 이후는 트리거가 유지한다.
+        # rebuild 는 messages 만 읽으므로 보관된 메세지는 아래에서 블록을 풀어 다시 넣는다
+        conn.execute(text("INSERT INTO messages_fts(messages_fts) VALUES ('rebuild')"))
+        conn.execute(text("UPDATE message_archive SET search_indexed = NULL"))
+    index_archive_blocks(conn)
+
+
+def index_archive_blocks(conn):
+    # 검색 행을 지우던 예전 보관 작업이 만든 블록을 색인한다
+    from database.archive import decode_block, index_archived
+
+    blocks = conn.execute(text(
+        "SELECT id, codec, data FROM message_archive WHERE search_indexed IS NULL OR search_indexed = 0"
+    )).all()
+    for block_id, codec, data in blocks:
+        index_archived(conn, decode_block(codec, data))
+        conn.execute(text("UPDATE message_archive SET search_indexed = 1 WHERE id = :id"), {"id": block_id})
+
+
+def compact_database(db_file):
+    """예전 스키마가 행마다 저장하던 전체 히스토리 JSON(messages.messages)을 걷어내고 파일을 줄인다."""
+    conn = sqlite3.connect(db_file)
+    try:
+        columns = {row[1] for row in conn.execute('PRAGMA table_info(messages)')}
+        if 'messages' not in columns:
+            return False
+
+        if sqlite3.sqlite_version_info >= (3, 35, 0):
+            conn.execute('ALTER TABLE messages DROP COLUMN messages')
+        else:
+            # DROP COLUMN 을 지원하지 않는 SQLite 에서는 값만 비워도 VACUUM 으로 공간이 회수된다
+            conn.execute('UPDATE messages SET messages = NULL')
+        conn.commit()
+        conn.execute('VACUUM')
+        return True
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    for db_file in sys.argv[1:] or ['chatbot.db']:
+        if compact_database(db_file):
+            print(f"{db_file}: compacted")
+        else:
+            print(f"{db_file}: already up to date")
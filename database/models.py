@@ -1,5 +1,5 @@
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy import Column, Integer, String, ForeignKey, Float, Text
+from sqlalchemy import Boolean, Column, Date, DateTime, Integer, LargeBinary, String, ForeignKey, Float, Index
 
 Base = declarative_base()
 
@@ -12,21 +12,87 @@ class User(Base):
 
 class Message(Base):
     __tablename__ = 'messages'
+    __table_args__ = (
+        Index('ix_messages_room_id_id', 'room_id', 'id'),  # 방별 키셋 페이지네이션용
+    )
     id = Column(Integer, primary_key=True)
     room_id = Column(Integer, ForeignKey('rooms.id', ondelete="CASCADE"))
     user_id = Column(Integer, ForeignKey('users.id'))
     user_message = Column(String)
     chatbot_message = Column(String)
-    messages = Column(Text)
     model_name = Column(String)
     total_tokens = Column(Integer)
     cost = Column(Float)
+    saved_prompt_tokens = Column(Integer, default=0)  # 컨텍스트 관리로 줄인 프롬프트 토큰 수
+    saved_cost = Column(Float, default=0.0)  # 응답 캐시 적중과 컨텍스트 관리로 아낀 비용(요약 비용을 뺀 값)
+    latency_ms = Column(Integer)  # UI 에서 잰 게이트웨이 응답 시간
 
 
 class Room(Base):
     __tablename__ = 'rooms'
+    __table_args__ = (
+        Index('ix_rooms_user_id_name', 'user_id', 'name'),
+    )
     id = Column(Integer, primary_key=True)
     name = Column(String)
     user_id = Column(Integer, ForeignKey('users.id'))  # 사용자 ID 외래 키 추가
     room_total_cost = Column(Float, default=0.0)
+    last_active_at = Column(DateTime)  # 마지막으로 메세지를 저장한 시각. 보관 작업이 쉬는 방을 고를 때 쓴다
+    summary = Column(String)  # 보관된 턴까지의 누적 요약
+    summary_upto_id = Column(Integer)  # summary 가 반영한 마지막 메세지 ID
 
+
+class MessageArchive(Base):
+    """오래 쓰지 않은 방에서 옮겨 온 옛 메세지 묶음. 메세지 dict 목록을 JSON 으로 만들어 압축해 둔다."""
+    __tablename__ = 'message_archive'
+    __table_args__ = (
+        Index('ix_message_archive_room_id_last_message_id', 'room_id', 'last_message_id'),
+    )
+    id = Column(Integer, primary_key=True)
+    room_id = Column(Integer, ForeignKey('rooms.id', ondelete="CASCADE"), nullable=False)
+    first_message_id = Column(Integer, nullable=False)
+    last_message_id = Column(Integer, nullable=False)
+    message_count = Column(Integer, nullable=False)
+    total_tokens = Column(Integer, default=0)
+    codec = Column(String, nullable=False)  # "zstd" 또는 "zlib"
+    data = Column(LargeBinary, nullable=False)
+    created_at = Column(DateTime, nullable=False)
+    # 블록에 든 메세지가 messages_fts 에 들어 있는지. 예전 보관 작업이 만든 블록은 비어 있어서 다시 색인한다
+    search_indexed = Column(Boolean)
+
+
+class UsageLedger(Base):
+    """요청 한 건의 사용량. 추가만 하고 고치거나 지우지 않는다(방을 지워도 남는다)."""
+    __tablename__ = 'usage_ledger'
+    __table_args__ = (
+        Index('ix_usage_ledger_user_id_id', 'user_id', 'id'),
+    )
+    id = Column(Integer, primary_key=True)
+    created_at = Column(DateTime, nullable=False)
+    user_id = Column(Integer, nullable=False)
+    room_id = Column(Integer)
+    model_name = Column(String, nullable=False)
+    prompt_tokens = Column(Integer, default=0)
+    completion_tokens = Column(Integer, default=0)
+    total_tokens = Column(Integer, default=0)
+    cost = Column(Float, default=0.0)
+    saved_cost = Column(Float, default=0.0)
+    cache_hit = Column(Boolean, default=False)
+
+
+class UsageDaily(Base):
+    """usage_ledger 를 (날짜, 사용자, 방, 모델) 단위로 미리 합쳐 둔 롤업. 대시보드는 이 테이블만 읽는다."""
+    __tablename__ = 'usage_daily'
+    __table_args__ = (
+        Index('ix_usage_daily_user_id_day', 'user_id', 'day'),
+    )
+    day = Column(Date, primary_key=True)
+    user_id = Column(Integer, primary_key=True)
+    room_id = Column(Integer, primary_key=True)
+    model_name = Column(String, primary_key=True)
+    requests = Column(Integer, default=0)
+    prompt_tokens = Column(Integer, default=0)
+    completion_tokens = Column(Integer, default=0)
+    total_tokens = Column(Integer, default=0)
+    cost = Column(Float, default=0.0)
+    saved_cost = Column(Float, default=0.0)
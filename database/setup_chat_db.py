@@ -1,129 +1,340 @@
-import json
+import datetime
+from contextlib import contextmanager
 
-from sqlalchemy import create_engine
+from sqlalchemy import bindparam, func, text
 from sqlalchemy.orm import sessionmaker
 
-from database.models import Base, Room, Message, User
+from database.engine import create_chat_engine
+from database.archive import decode_block, index_archived
+from database.migrations import ensure_schema
+from database.models import Room, Message, MessageArchive, User
+from database.usage import UsageRecorder
+from observability.logs import get_logger, log_event
+
+MESSAGE_PAGE_SIZE = 50
+SEARCH_PAGE_SIZE = 20
+
+logger = get_logger(__name__)
+
+
+def build_search_query(user_id: int, query: str) -> str:
+    # 사용자가 입력한 단어를 각각 따옴표로 감싼 접두어 질의로 바꿔 FTS5 문법 오류를 막는다(모든 단어가 있어야 한다).
+    # 단어는 본문 컬럼에서만 찾고, user_id 컬럼으로 그 사용자의 메세지만 남긴다
+    terms = [term.replace('"', '') for term in query.split()]
+    terms = " ".join(f'"{term}"*' for term in terms if term)
+    if not terms:
+        return ""
+    return f'user_id:"{int(user_id)}" AND {{user_message chatbot_message}}:({terms})'
+
+
+def highlight(message, terms, window=12):
+    # 보관된 메세지용 snippet(). 처음 걸린 단어 주변 window 단어를 보여 주고 걸린 단어를 굵게 한다
+    if not message:
+        return message
+    words = message.split()
+    matched = [any(word.lower().startswith(term) for term in terms) for word in words]
+    start = max(0, matched.index(True) - window // 2) if any(matched) else 0
+    shown = [f"**{word}**" if hit else word
+             for word, hit in zip(words[start:start + window], matched[start:start + window])]
+    return ("…" if start else "") + " ".join(shown) + ("…" if start + window < len(words) else "")
+
 
 class ChatDatabase:
     def __init__(self, db_file):
-        self.engine = create_engine(f'sqlite:///{db_file}', echo=False)
-        self.Session = sessionmaker(bind=self.engine)
-        Base.metadata.create_all(self.engine)
+        self.engine = create_chat_engine(db_file)
+        # 세션을 닫은 뒤에도 돌려준 객체의 속성을 읽을 수 있도록 commit 때 만료시키지 않는다
+        self.Session = sessionmaker(bind=self.engine, expire_on_commit=False)
+        self.WriteSession = sessionmaker(bind=self.engine.execution_options(sqlite_immediate=True), expire_on_commit=False)
+        ensure_schema(self.engine)
+        self.usage = UsageRecorder(self)
 
     def get_session(self):
         return self.Session()
 
-    def add_message(self, room_name, user_id, user_name, user_message, chatbot_message, messages, model_name, total_tokens, cost):
-        session = self.get_session()
+    @contextmanager
+    def session_scope(self, write=False):
+        session = self.WriteSession() if write else self.Session()
+        try:
+            yield session
+            session.commit()
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+
+    def close(self):
+        self.usage.close()
+        self.engine.dispose()
 
-        room = session.query(Room).filter_by(name=room_name, user_id=user_id).first()
-        if room is None:
-            room = Room(
-                name=room_name,
+    def add_message(self, room_name, user_id, user_name, user_message, chatbot_message, model_name, total_tokens, cost,
+                    saved_prompt_tokens=0, saved_cost=0.0, latency_ms=None, prompt_tokens=0, completion_tokens=0,
+                    cache_hit=False, summary_usage=None):
+        # 방/사용자 생성과 메세지 저장을 한 트랜잭션, 한 번의 commit 으로 처리한다.
+        # cost 는 이 턴에서 만든 누적 요약의 비용(summary_usage['cost'])까지 합친 값이다
+        with self.session_scope(write=True) as session:
+            room = session.query(Room).filter_by(name=room_name, user_id=user_id).first()
+            if room is None:
+                room = Room(
+                    name=room_name,
+                    user_id=user_id,
+                    room_total_cost=0.0
+                )
+                session.add(room)
+
+            user = session.query(User).filter_by(name=user_name).first()
+            if user is None:
+                user = User(
+                    name=user_name,
+                    user_total_cost=0.0
+                )
+                session.add(user)
+            session.flush()
+
+            message = Message(
+                room_id=room.id,
                 user_id=user_id,
-                room_total_cost=0.0
+                user_message=user_message,
+                chatbot_message=chatbot_message,
+                model_name=model_name,
+                total_tokens=total_tokens,
+                cost=cost,
+                saved_prompt_tokens=saved_prompt_tokens,
+                saved_cost=saved_cost,
+                latency_ms=latency_ms
             )
-            session.add(room)
-            session.commit()
+            session.add(message)
 
-        user = session.query(User).filter_by(name=user_name).first()
-        if user is None:
-            user = User(
-                name=user_name,
-                user_total_cost=0.0
-            )
-            session.add(user)
-            session.commit()
+            # 다른 세션이 같은 방/사용자에 동시에 쓰더라도 합계가 덮어써지지 않도록 SQL 에서 더한다
+            room.room_total_cost = Room.room_total_cost + cost
+            room.last_active_at = datetime.datetime.now()
+            user.user_total_cost = User.user_total_cost + cost
+            room_id = room.id
 
-        message = Message(
-            room_id=room.id,
+        # 사용량 장부에는 요약 호출을 요약 모델 몫으로 따로 적는다
+        summary_cost = summary_usage['cost'] if summary_usage else 0.0
+        self.usage.record(
             user_id=user_id,
-            user_message=user_message,
-            chatbot_message=chatbot_message,
-            messages=messages,
+            room_id=room_id,
             model_name=model_name,
+            prompt_tokens=prompt_tokens,
+            completion_tokens=completion_tokens,
             total_tokens=total_tokens,
-            cost=cost
+            cost=cost - summary_cost,
+            saved_cost=saved_cost,
+            cache_hit=cache_hit
         )
-        session.add(message)
-
-        room.room_total_cost += cost
-        user.user_total_cost += cost
-
-        session.commit()
+        if summary_usage:
+            self.usage.record(user_id=user_id, room_id=room_id, **summary_usage)
+        return room_id
 
     def load_users(self):
-        session = self.get_session()
-        users = session.query(User).all()
-        users_data = {user.id: user.name for user in users}
-        return users_data
+        with self.session_scope() as session:
+            users = session.query(User).all()
+            return {user.id: user.name for user in users}
 
     def load_chat_rooms(self, user_id):
-        session = self.get_session()
-        rooms = session.query(Room).filter_by(user_id=user_id).all()
+        # 방 목록과 합계는 집계 쿼리 한 번으로 가져오고, 메세지는 방을 열 때 load_messages 로 불러온다.
+        # 보관된 턴은 블록에 적어 둔 개수와 토큰 합만 더한다
+        with self.session_scope() as session:
+            archived = session.query(
+                MessageArchive.room_id,
+                func.sum(MessageArchive.message_count).label('message_count'),
+                func.sum(MessageArchive.total_tokens).label('total_tokens')
+            ).group_by(MessageArchive.room_id).subquery()
+            rows = session.query(
+                Room.id,
+                Room.name,
+                Room.room_total_cost,
+                Room.summary,
+                func.count(Message.id),
+                func.coalesce(func.sum(Message.total_tokens), 0),
+                func.coalesce(archived.c.message_count, 0),
+                func.coalesce(archived.c.total_tokens, 0)
+            ).outerjoin(Message, Message.room_id == Room.id) \
+                .outerjoin(archived, archived.c.room_id == Room.id) \
+                .filter(Room.user_id == user_id) \
+                .group_by(Room.id) \
+                .order_by(Room.id) \
+                .all()
+
         room_list = []
         chat_rooms_data = {}
-        users_data = self.load_users()
-        for room in rooms:
-            room_list.append(room.name)
-            messages = session.query(Message).filter_by(room_id=room.id).order_by(Message.id).all()
-            chat_history = json.loads(messages[-1].messages)
-            chatbot_message_list = []
-            user_message_list = []
-            model_names = []
-            total_tokens_list = []
-            costs = []
-            for message in messages:
-                chatbot_message_list.append(message.chatbot_message)
-                user_message_list.append(message.user_message)
-                model_names.append(message.model_name)
-                total_tokens_list.append(message.total_tokens)
-                costs.append(message.cost)
-            chat_rooms_data[room.name] = {
-                'chatbot_message': chatbot_message_list,
-                'user_message': user_message_list,
-                'messages': chat_history,
-                'total_cost': room.room_total_cost,
-                'model_name': model_names,
-                'total_tokens': total_tokens_list,
-                'cost': costs,
+        for room_id, room_name, room_total_cost, summary, message_count, room_total_tokens, \
+                archived_count, archived_tokens in rows:
+            room_list.append(room_name)
+            chat_rooms_data[room_name] = {
+                'room_id': room_id,
+                'message_count': message_count + archived_count,
+                'room_total_tokens': room_total_tokens + archived_tokens,
+                'archive_summary': summary if archived_count else None,
+                'archive_loaded': False,
+                'loaded': False,
+                'oldest_message_id': None,
+                'chatbot_message': [],
+                'user_message': [],
+                'messages': [],
+                'total_cost': room_total_cost or 0.0,
+                'model_name': [],
+                'total_tokens': [],
+                'cost': [],
+                'saved_cost': [],
+                'latency_ms': [],
             }
 
-        return room_list, chat_rooms_data, users_data
+        return room_list, chat_rooms_data
+
+    def load_messages(self, room_id, before_id=None, limit=MESSAGE_PAGE_SIZE):
+        # (room_id, id) 인덱스를 타는 키셋 페이지네이션: before_id 보다 오래된 메세지 limit 개를 오래된 순으로 돌려준다.
+        # hot 메세지가 모자라면 보관 블록을 최신 것부터 풀어서 채운다(보관된 ID 는 모두 hot 메세지보다 작다)
+        with self.session_scope() as session:
+            query = session.query(Message).filter(Message.room_id == room_id)
+            if before_id is not None:
+                query = query.filter(Message.id < before_id)
+            messages = query.order_by(Message.id.desc()).limit(limit).all()
+            page = [
+                {
+                    'id': message.id,
+                    'user_message': message.user_message,
+                    'chatbot_message': message.chatbot_message,
+                    'model_name': message.model_name,
+                    'total_tokens': message.total_tokens,
+                    'cost': message.cost,
+                    'saved_cost': message.saved_cost,
+                    'latency_ms': message.latency_ms,
+                    'archived': False,
+                }
+                for message in reversed(messages)
+            ]
+            if len(page) < limit:
+                boundary = page[0]['id'] if page else before_id
+                page[:0] = self._load_archived_messages(session, room_id, boundary, limit - len(page))
+            return page
+
+    def _load_archived_messages(self, session, room_id, before_id, limit):
+        # 블록 본문은 필요한 만큼만 하나씩 읽어서 푼다
+        query = session.query(MessageArchive.id).filter(MessageArchive.room_id == room_id)
+        if before_id is not None:
+            query = query.filter(MessageArchive.first_message_id < before_id)
+        archived = []
+        for block_id, in query.order_by(MessageArchive.last_message_id.desc()).all():
+            block = session.query(MessageArchive.codec, MessageArchive.data).filter_by(id=block_id).one()
+            messages = [
+                message for message in decode_block(block.codec, block.data)
+                if before_id is None or message['id'] < before_id
+            ]
+            archived[:0] = messages
+            if len(archived) >= limit:
+                break
+        return [
+            {
+                'id': message['id'],
+                'user_message': message['user_message'],
+                'chatbot_message': message['chatbot_message'],
+                'model_name': message['model_name'],
+                'total_tokens': message['total_tokens'],
+                'cost': message['cost'],
+                'saved_cost': message['saved_cost'],
+                'latency_ms': message['latency_ms'],
+                'archived': True,
+            }
+            for message in archived[-limit:]
+        ]
+
+    def search_messages(self, user_id, query, limit=SEARCH_PAGE_SIZE, offset=0):
+        # messages_fts 에서 사용자의 메세지만 골라 bm25(user_id 컬럼 가중치 0) 순으로 돌려준다.
+        # 보관된 메세지는 검색 행만 있고 messages 에는 없어서 snippet() 을 쓸 수 없으므로,
+        # 순위를 먼저 정하고 hot 메세지는 snippet() 으로, 보관된 메세지는 블록을 풀어서 채운다
+        match = build_search_query(user_id, query)
+        if not match:
+            return []
+        with self.session_scope() as session:
+            ranked = session.execute(text(
+                "SELECT messages_fts.rowid, bm25(messages_fts, 1.0, 1.0, 0.0) AS rank, m.room_id "
+                "FROM messages_fts "
+                "LEFT JOIN messages m ON m.id = messages_fts.rowid "
+                "WHERE messages_fts MATCH :match "
+                "ORDER BY rank LIMIT :limit OFFSET :offset"
+            ), {"match": match, "limit": limit, "offset": offset}).all()
+            hits = {}
+            hot_ids = [message_id for message_id, _, room_id in ranked if room_id is not None]
+            if hot_ids:
+                rows = session.execute(text(
+                    "SELECT m.id, m.room_id, "
+                    "snippet(messages_fts, 0, '**', '**', '…', 12), "
+                    "snippet(messages_fts, 1, '**', '**', '…', 12) "
+                    "FROM messages_fts JOIN messages m ON m.id = messages_fts.rowid "
+                    "WHERE messages_fts MATCH :match AND messages_fts.rowid IN :ids"
+                ).bindparams(bindparam('ids', expanding=True)), {"match": match, "ids": hot_ids}).all()
+                hits.update((message_id, (room_id, user_snippet, chatbot_snippet))
+                            for message_id, room_id, user_snippet, chatbot_snippet in rows)
+            archived_ids = {message_id for message_id, _, room_id in ranked if room_id is None}
+            if archived_ids:
+                hits.update(self._search_archived(session, archived_ids, query))
+            room_names = dict(session.query(Room.id, Room.name).filter(
+                Room.id.in_({room_id for room_id, _, _ in hits.values()})
+            ).all())
+        return [
+            {
+                'id': message_id,
+                'room_id': hits[message_id][0],
+                'room_name': room_names.get(hits[message_id][0]),
+                'user_message': hits[message_id][1],
+                'chatbot_message': hits[message_id][2],
+                'rank': rank,
+            }
+            for message_id, rank, _ in ranked if message_id in hits
+        ]
+
+    def _search_archived(self, session, message_ids, query):
+        # 검색에 걸린 보관 메세지가 든 블록만 풀어서 {id: (room_id, 질문 요약, 답변 요약)}을 만든다
+        low, high = min(message_ids), max(message_ids)
+        blocks = session.query(MessageArchive.id, MessageArchive.first_message_id, MessageArchive.last_message_id) \
+            .filter(MessageArchive.first_message_id <= high, MessageArchive.last_message_id >= low).all()
+        terms = [term.replace('"', '').lower() for term in query.split() if term.replace('"', '')]
+        found = {}
+        for block_id, first_id, last_id in blocks:
+            if not any(first_id <= message_id <= last_id for message_id in message_ids):
+                continue
+            block = session.query(MessageArchive.room_id, MessageArchive.codec, MessageArchive.data) \
+                .filter_by(id=block_id).one()
+            for message in decode_block(block.codec, block.data):
+                if message['id'] in message_ids:
+                    found[message['id']] = (
+                        block.room_id,
+                        highlight(message['user_message'], terms),
+                        highlight(message['chatbot_message'], terms),
+                    )
+        return found
 
     def delete_room_and_messages(self, room):
-        session = self.get_session()
-        room = session.query(Room).filter_by(name=room).first()
-        if room:
-            session.query(Message).filter_by(room_id=room.id).delete()
-        else:
-            print("채팅방이 존재하지 않습니다.")
-            return
-        session.delete(room)
-        session.commit()
+        with self.session_scope(write=True) as session:
+            room_row = session.query(Room).filter_by(name=room).first()
+            if room_row is None:
+                log_event(logger, "warning", "room_not_found", room=room)
+                return
+            session.query(Message).filter_by(room_id=room_row.id).delete()
+            # 보관된 메세지의 검색 행은 트리거가 지우지 않으므로 블록을 풀어서 뺀다
+            for codec, data in session.query(MessageArchive.codec, MessageArchive.data) \
+                    .filter_by(room_id=room_row.id, search_indexed=True):
+                index_archived(session, decode_block(codec, data), delete=True)
+            session.query(MessageArchive).filter_by(room_id=room_row.id).delete()
+            session.delete(room_row)
 
     def user_login(self, user_name: str):
-        session = self.get_session()
-        try:
+        # 매 rerun 마다 불리므로 이미 있는 사용자는 쓰기 잠금 없이 읽기만 한다
+        with self.session_scope() as session:
+            user = session.query(User).filter_by(name=user_name).first()
+        if user is not None:
+            return user
+
+        with self.session_scope(write=True) as session:
             user = session.query(User).filter_by(name=user_name).first()
             if user is None:
                 user = User(name=user_name)
                 session.add(user)
-                session.commit()
-                user = session.query(User).filter_by(name=user_name).first()
+                session.flush()
             return user
-        except Exception as e:
-            session.rollback()
-            raise e
-        finally:
-            session.close()
 
     def get_default_user(self):
-        session = self.get_session()
-        default_user = session.query(User).filter_by(name='default').first()
-        if default_user is None:
-            default_user = User(name='default')
-            session.add(default_user)
-            session.commit()
-        return default_user
+        return self.user_login('default')
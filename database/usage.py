@@ -0,0 +1,202 @@
+"""모델별 단가표와 사용량 장부(usage ledger), 일별 롤업.
+
+사용량은 UsageRecorder 가 모아 두었다가 한 트랜잭션에서 usage_ledger 에 한꺼번에 넣고,
+같은 트랜잭션에서 usage_daily 롤업에 더한다. 대시보드 조회는 롤업만 읽는다.
+"""
+import datetime
+import threading
+from typing import Dict, List, Optional, Sequence
+
+from sqlalchemy import func, insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from database.models import UsageDaily, UsageLedger
+from observability.logs import get_logger, log_event
+
+# 1K 토큰당 달러 (prompt, completion). 가격이 바뀌면 적용 시작일과 함께 뒤에 추가한다
+PRICING = {
+    "gpt-3.5-turbo": [(datetime.date(2023, 3, 1), 0.002, 0.002)],
+    "gpt-3.5-turbo-1106": [(datetime.date(2023, 11, 6), 0.001, 0.002)],
+    "gpt-3.5-turbo-0125": [(datetime.date(2024, 1, 25), 0.0005, 0.0015)],
+    "gpt-4": [(datetime.date(2023, 3, 14), 0.03, 0.06)],
+    "gpt-4-1106-preview": [(datetime.date(2023, 11, 6), 0.01, 0.03)],
+    "gpt-4-0125-preview": [(datetime.date(2024, 1, 25), 0.01, 0.03)],
+    # 로컬에서 돌리는 모델은 토큰당 비용이 없다
+    "beomi/": [(datetime.date(2023, 1, 1), 0.0, 0.0)],
+}
+
+FLUSH_BATCH_SIZE = 100
+FLUSH_INTERVAL = 1.0
+ROLLUP_COLUMNS = ("prompt_tokens", "completion_tokens", "total_tokens", "cost", "saved_cost")
+GROUP_COLUMNS = ("day", "user_id", "room_id", "model_name")
+
+logger = get_logger(__name__)
+
+
+def get_price(model_name: str, day: Optional[datetime.date] = None):
+    # 정확히 같은 이름이 없으면 가장 길게 겹치는 이름(예: gpt-4-0613 -> gpt-4)의 가격을 쓴다
+    day = day or datetime.date.today()
+    matches = [name for name in PRICING if model_name.startswith(name)]
+    if not matches:
+        return None
+    versions = PRICING[max(matches, key=len)]
+    current = [version for version in versions if version[0] <= day] or versions[:1]
+    _, prompt_price, completion_price = current[-1]
+    return prompt_price, completion_price
+
+
+def compute_cost(model_name: str, prompt_tokens: int, completion_tokens: int,
+                 day: Optional[datetime.date] = None) -> float:
+    price = get_price(model_name, day)
+    if price is None:
+        log_event(logger, "warning", "missing_pricing", model=model_name)
+        return 0.0
+    prompt_price, completion_price = price
+    return (prompt_tokens * prompt_price + completion_tokens * completion_price) / 1000
+
+
+class UsageRecorder:
+    """사용량을 메모리에 모았다가 FLUSH_BATCH_SIZE 개가 차거나 FLUSH_INTERVAL 초가 지나면 한 번에 쓴다."""
+
+    def __init__(self, chat_db, batch_size: int = FLUSH_BATCH_SIZE, flush_interval: float = FLUSH_INTERVAL):
+        self.chat_db = chat_db
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._pending = []
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="usage-recorder", daemon=True)
+        self._thread.start()
+
+    def record(self, user_id: int, room_id: int, model_name: str, prompt_tokens: int, completion_tokens: int,
+               total_tokens: int, cost: float, saved_cost: float = 0.0, cache_hit: bool = False):
+        entry = {
+            "created_at": datetime.datetime.now(),
+            "user_id": user_id,
+            "room_id": room_id,
+            "model_name": model_name,
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": total_tokens,
+            "cost": cost,
+            "saved_cost": saved_cost,
+            "cache_hit": cache_hit,
+        }
+        with self._lock:
+            self._pending.append(entry)
+            if len(self._pending) >= self.batch_size:
+                self._wakeup.set()
+
+    def _run(self):
+        while not self._closed:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                log_event(logger, "error", "usage_flush_failed", error=str(e), pending=len(self._pending))
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                entries, self._pending = self._pending, []
+            if not entries:
+                return
+            try:
+                with self.chat_db.session_scope(write=True) as session:
+                    session.execute(insert(UsageLedger), entries)
+                    for row in rollup_rows(entries):
+                        session.execute(upsert_daily(row))
+            except Exception:
+                # 다음 flush 에서 다시 시도하도록 앞에 되돌려 놓는다
+                with self._lock:
+                    self._pending[:0] = entries
+                raise
+
+    def close(self):
+        self._closed = True
+        self._wakeup.set()
+        self._thread.join()
+        self.flush()
+
+
+def rollup_rows(entries: Sequence[dict]) -> List[dict]:
+    rows = {}
+    for entry in entries:
+        key = (entry["created_at"].date(), entry["user_id"], entry["room_id"] or 0, entry["model_name"])
+        row = rows.get(key)
+        if row is None:
+            row = rows[key] = {**dict(zip(GROUP_COLUMNS, key)), "requests": 0,
+                               **{column: 0 for column in ROLLUP_COLUMNS}}
+        row["requests"] += 1
+        for column in ROLLUP_COLUMNS:
+            row[column] += entry[column] or 0
+    return list(rows.values())
+
+
+def upsert_daily(row: dict):
+    statement = sqlite_insert(UsageDaily).values(**row)
+    return statement.on_conflict_do_update(
+        index_elements=list(GROUP_COLUMNS),
+        set_={
+            column: getattr(UsageDaily, column) + getattr(statement.excluded, column)
+            for column in ("requests",) + ROLLUP_COLUMNS
+        }
+    )
+
+
+def rebuild_daily_rollup(chat_db):
+    """장부에서 롤업 전체를 다시 만든다. 롤업이 어긋났을 때만 쓴다."""
+    with chat_db.session_scope(write=True) as session:
+        session.query(UsageDaily).delete()
+        day = func.date(UsageLedger.created_at)
+        rows = session.query(
+            day, UsageLedger.user_id, func.coalesce(UsageLedger.room_id, 0), UsageLedger.model_name,
+            func.count(UsageLedger.id),
+            *(func.coalesce(func.sum(getattr(UsageLedger, column)), 0) for column in ROLLUP_COLUMNS)
+        ).group_by(day, UsageLedger.user_id, UsageLedger.room_id, UsageLedger.model_name).all()
+        for row in rows:
+            values = dict(zip(GROUP_COLUMNS + ("requests",) + ROLLUP_COLUMNS, row))
+            values["day"] = datetime.date.fromisoformat(values["day"])
+            session.execute(insert(UsageDaily).values(**values))
+
+
+def usage_summary(chat_db, start: datetime.date, end: datetime.date, group_by: Sequence[str] = ("model_name",),
+                  user_id: Optional[int] = None, room_id: Optional[int] = None) -> List[Dict]:
+    """[start, end] 기간의 사용량을 group_by 컬럼(day, user_id, room_id, model_name)별로 합친다.
+
+    롤업 테이블의 (day, ...) 기본 키나 (user_id, day) 인덱스 범위만 읽으므로 장부 크기와 상관없이 빠르다.
+    """
+    unknown = set(group_by) - set(GROUP_COLUMNS)
+    if unknown:
+        raise ValueError(f"Cannot group usage by {sorted(unknown)}")
+
+    keys = [getattr(UsageDaily, column) for column in group_by]
+    with chat_db.session_scope() as session:
+        query = session.query(
+            *keys,
+            func.sum(UsageDaily.requests),
+            *(func.sum(getattr(UsageDaily, column)) for column in ROLLUP_COLUMNS)
+        ).filter(UsageDaily.day >= start, UsageDaily.day <= end)
+        if user_id is not None:
+            query = query.filter(UsageDaily.user_id == user_id)
+        if room_id is not None:
+            query = query.filter(UsageDaily.room_id == room_id)
+        rows = query.group_by(*keys).order_by(*keys).all()
+
+    return [dict(zip(tuple(group_by) + ("requests",) + ROLLUP_COLUMNS, row)) for row in rows]
+
+
+def ledger_entries(chat_db, user_id: int, before_id: Optional[int] = None, limit: int = 100) -> List[Dict]:
+    # (user_id, id) 인덱스를 타는 키셋 페이지네이션으로 최근 장부부터 돌려준다
+    with chat_db.session_scope() as session:
+        query = session.query(UsageLedger).filter(UsageLedger.user_id == user_id)
+        if before_id is not None:
+            query = query.filter(UsageLedger.id < before_id)
+        entries = query.order_by(UsageLedger.id.desc()).limit(limit).all()
+        return [
+            {column.name: getattr(entry, column.name) for column in UsageLedger.__table__.columns}
+            for entry in entries
+        ]
@@ -0,0 +1,61 @@
+"""한 줄에 JSON 하나씩 쓰는 구조화 로그.
+
+LOG_LEVEL 로 남길 최소 수준을 정하고, LOG_SAMPLE_RATE(0~1) 로 debug/info 이벤트 중 일부만 남긴다.
+warning 이상은 표본 추출 없이 항상 남긴다.
+"""
+import json
+import logging
+import os
+import random
+import sys
+import time
+from contextvars import ContextVar
+
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+LOG_SAMPLE_RATE = float(os.environ.get("LOG_SAMPLE_RATE", 1.0))
+
+# 한 요청에서 나온 로그를 묶어 볼 수 있도록 요청마다 정한다
+trace_id: ContextVar[str] = ContextVar("trace_id", default="")
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": round(record.created, 3),
+            "level": record.levelname.lower(),
+            "logger": record.name,
+            "event": record.getMessage(),
+        }
+        entry.update(getattr(record, "fields", {}))
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+def get_logger(name: str) -> logging.Logger:
+    root = logging.getLogger("chat")
+    if not root.handlers:
+        handler = logging.StreamHandler(sys.stderr)
+        handler.setFormatter(JsonFormatter())
+        root.addHandler(handler)
+        root.setLevel(LOG_LEVEL)
+        root.propagate = False
+    return root.getChild(name)
+
+
+def log_event(logger: logging.Logger, level: str, event: str, exc_info=None, **fields):
+    level_no = logging.getLevelName(level.upper())
+    if not logger.isEnabledFor(level_no):
+        return
+    if level_no < logging.WARNING and LOG_SAMPLE_RATE < 1.0 and random.random() >= LOG_SAMPLE_RATE:
+        return
+    current_trace = trace_id.get()
+    if current_trace:
+        fields.setdefault("trace_id", current_trace)
+    logger.log(level_no, event, exc_info=exc_info, extra={"fields": fields})
+
+
+def new_trace_id() -> str:
+    value = f"{time.time_ns():x}{random.getrandbits(16):04x}"
+    trace_id.set(value)
+    return value